@@ -13,24 +13,58 @@ This allows me to greatly save memory and also increase access speeds.
 
 At the same time, the game's field/canvas's state is calculated and drawn line by line using generators.
 Once again, this attempts to save space and reduce blocking computation.
+Drawing happens on its own thread, which only rewrites the cells that changed, and skips frames if the simulation is
+running faster than the frame rate. With --headless t nothing is drawn at all.
 
-The canvas can dynamically grow in the positive x and y direction, but not in the negative direction. This is a
-known limitation.
+The canvas can dynamically grow in every direction, including negative x and y coordinates. Between iterations the
+cells are stored in a Board, which keeps each row as a sorted array of 64 bit x coordinates (8 bytes per live cell) and
+keeps track of its bounding box as rows are added instead of recomputing it.
 
 Overall, the rough computational complexity of this I would put it around O(n) or O(n^2). Where n = number of active
 cells. It becomes worse if the cells are spaced apart. Again, this program is mainly optimised for memory efficiency.
 On windows, this script should use about ~5.1MB.
 
-The SLOC of this script is rather long due to additional checks when taking arguments from command lines.
+The "frontier" engine only looks at live cells and their neighbours, so a step costs O(live cells) no matter
+how far apart the cells are. The original row by row engine is still available as the "rows" engine.
+If numpy is installed, the "dense" engine keeps the canvas as a numpy array and steps the whole array at once, which is
+much faster for crowded canvases. The default "auto" engine switches between frontier and dense depending on how
+crowded the canvas is.
+The "bitwise" engine keeps each row as a python int bitmask and creates a whole row at a time with bitwise adders.
+The "parallel" engine splits a dense canvas into bands of rows and steps them on a pool of worker processes.
+For very long runs, the "hashlife" engine memoizes a quadtree of the canvas and can jump many iterations per frame.
+
+Other rules can be run with --rule: life-like rules in B/S notation (eg. B36/S23 HighLife, B3678/S34678 Day & Night),
+Generations rules (eg. B2/S/C3 Brian's Brain) and Larger than Life rules (eg. R5,C0,M1,S34..58,B34..45,NM). Each rule
+is compiled once into lookup tables (window counts, 512 entry 3x3 windows, 65536 entry 4x4 blocks for hashlife) that
+the engines use instead of hard coded if branches, so other rules run as fast as standard GOL.
+
+For census style workloads, run_batch and simulate_batch advance thousands of small boards together as one stacked
+numpy array (or split across worker processes), without going through main().
 
-Known potential optimisations that I have yet to do:
-Parallelize the calculating of the cell rows in the game field, rather than naively looping through it.
-Do not calculate for dead cells that are not within 1 square of a live cell to save computation.
+Runs can stop early, or jump straight to the last iteration, once the cells settle into a still life, an oscillator or
+a spaceship.
+Patterns can be loaded from and saved to RLE, plaintext and Life 1.06 files, and long runs can save binary checkpoints
+to resume from after a crash.
+
+The SLOC of this script is rather long due to additional checks when taking arguments from command lines.
 
 """
-from sys import argv, exit
+from sys import argv, exit, getsizeof
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import io
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
 import time
-import gc
 
 
 try:
@@ -38,17 +72,43 @@ try:
 except ImportError:
     exit("Colorama is required. You can find colorama in anaconda by default, or pip install it.")
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # the dense engine is optional
+
 
 SLIDING_WINDOW_SIZE = 3
+ENGINES = ("auto", "frontier", "dense", "parallel", "bitwise", "hashlife", "rows")
+ON_CYCLE_ACTIONS = ("report", "stop", "extrapolate")
+# The auto engine switches to dense storage once live cells fill this fraction of their bounding box, and back to sparse
+# storage once they drop below SPARSE_THRESHOLD. The gap stops it from converting back and forth every iteration.
+DENSE_THRESHOLD = 0.05
+SPARSE_THRESHOLD = 0.02
+OPTIONS = ("engine", "jump", "workers", "headless", "unthrottled", "load", "save", "checkpoint", "checkpoint-every",
+           "resume", "profile", "on-cycle", "rule")
+USAGE = ("Usage: python ConwayGOL.py [number of iterations <int>] [step? <bool>] [FPS <int>] [show background? <bool>]"
+         " [--engine <%s>] [--jump <iterations per frame int>] [--workers <int>] [--headless <bool>]"
+         " [--unthrottled <bool>] [--load <pattern file>] [--save <pattern file>] [--checkpoint <file>]"
+         " [--checkpoint-every <iterations int>] [--resume <bool>] [--profile <json file>]"
+         " [--on-cycle <%s>] [--rule <rule, eg. B3/S23>]" % ("|".join(ENGINES), "|".join(ON_CYCLE_ACTIONS)))
+
+
+CLEAR_SCREEN = "\x1b[2J"
+
+
+def _cursor_escape(y, x):
+    """ Returns the escape sequence that moves the cursor to row y, column x """
+    return "\033[%d;%dH" % (y, x)
 
 
 def _move_cursor(y, x):
-    print("\033[%d;%dH" % (y, x))
+    print(_cursor_escape(y, x))
 
 
 def _reset_screen():
     """Clears the terminal, resets the cursor """
-    print("\x1b[2J")
+    print(CLEAR_SCREEN)
     _move_cursor(0, 0)
 
 
@@ -84,17 +144,366 @@ def _parse_args(arg, arg_type, is_positive=True):
         return int(arg)
 
 
-def _respond_to_args(index, arg_type, is_positive=True):
+def _respond_to_args(arg, arg_type, is_positive=True):
     """ Helper function to respond to bad arguments. Will exit upon bad arguments, otherwise will return good args"""
-    if _parse_args(argv[index], arg_type, is_positive) == "bad":
-        exit("Invalid args\n"
-             "Usage: python ConwayGOL.py [number of iterations <int>] [step? <bool>] [FPS <int>] "
-             "[show background? <bool>]")
+    if _parse_args(arg, arg_type, is_positive) == "bad":
+        exit("Invalid args\n" + USAGE)
+    else:
+        return _parse_args(arg, arg_type, is_positive)
+
+
+def _split_options(args):
+    """ Helper to separate "--name value" options from the positional arguments.
+    Returns a tuple of (positional args list, options dict). Exits upon an option without a value."""
+    positional = []
+    options = dict()
+    args = iter(args)
+    for arg in args:
+        if arg.startswith("--"):
+            value = next(args, None)
+            if value is None:
+                exit("Missing value for %s\n" % arg + USAGE)
+            options[arg[2:]] = value
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+class PhaseTimer:
+    """ Opt-in profiling that splits the time of each iteration into phases:
+    line_buffer (building line buffers), neighbour_count, rule_application, dict_update (storing the next iteration's
+    cells) and render. Engines that fuse counting and rules (bitwise, parallel, hashlife) report their whole step as
+    neighbour_count. Rendering happens on its own thread, so render time is added to whichever iteration is running
+    (or the next one, if it happens in between iterations). Use enable_profiling() to turn it on.
+    """
+    PHASES = ("line_buffer", "neighbour_count", "rule_application", "dict_update", "render")
+
+    def __init__(self):
+        self.generations = []  # one {"generation": n, phase: seconds} dict per iteration
+        self._current = None
+        self._between_generations = dict.fromkeys(self.PHASES, 0.0)  # time reported while no iteration was running
+        self._lap_start = None
+        self._lock = threading.Lock()
+
+    def start_generation(self, generation):
+        with self._lock:
+            self._current, self._between_generations = self._between_generations, dict.fromkeys(self.PHASES, 0.0)
+            self._current["generation"] = generation
+        self._lap_start = time.perf_counter()
+
+    def lap(self, phase):
+        """ Adds the time since the last lap (or the start of the iteration) to a phase """
+        now = time.perf_counter()
+        if self._current is not None:
+            self.add(phase, now - self._lap_start)
+        self._lap_start = now
+
+    def add(self, phase, seconds):
+        """ Adds time to a phase of the current iteration. Safe to call from the renderer thread """
+        with self._lock:
+            (self._between_generations if self._current is None else self._current)[phase] += seconds
+
+    def end_generation(self):
+        with self._lock:
+            if self._current is not None:
+                self.generations.append(self._current)
+            self._current = None
+
+    def totals(self):
+        """ Returns the total seconds spent in each phase """
+        return {phase: sum(generation[phase] for generation in self.generations) for phase in self.PHASES}
+
+    def to_json(self):
+        return json.dumps({"totals": self.totals(), "generations": self.generations})
+
+
+_phase_timer = None  # the PhaseTimer that the engines report to, if profiling is enabled
+
+
+def enable_profiling():
+    """ Turns on per-phase profiling for every engine. Returns the PhaseTimer that the phases are reported to """
+    global _phase_timer
+    _phase_timer = PhaseTimer()
+    return _phase_timer
+
+
+def disable_profiling():
+    global _phase_timer
+    _phase_timer = None
+
+
+def _lap(phase):
+    """ Helper for the engines. Reports the time since the last lap to the PhaseTimer, if profiling is enabled """
+    if _phase_timer is not None:
+        _phase_timer.lap(phase)
+
+
+class Row(array):
+    """ The x coordinates of the live cells in a row, as a sorted array of 64 bit ints (8 bytes per live cell).
+    Membership tests are a binary search. """
+    __slots__ = ()
+
+    def __new__(cls, xs=()):
+        return super().__new__(cls, "q", sorted(xs))
+
+    def __contains__(self, x_val):
+        index = bisect_left(self, x_val)
+        return index < len(self) and self[index] == x_val
+
+
+class Board(Mapping):
+    """ Compact storage for cells with signed coordinates. Works like a read-only cell dictionary of {y: Row}, so
+    it can be passed to anything that takes a cell dictionary.
+    The population and bounding box are kept up to date as rows are set, instead of being recomputed every iteration.
+    """
+
+    def __init__(self, cells=None):
+        """
+        :param cells: optional dict containing the cell coordinates (or another Board) to copy
+        """
+        self._rows = dict()
+        self.population = 0
+        self._box = None  # (min_y, min_x, max_y, max_x)
+        self._box_stale = False  # set when a row is replaced, as the bounding box may have shrunk
+        for y_val, row in (cells or {}).items():
+            self.set_row(y_val, row)
+
+    def set_row(self, y_val, xs):
+        """ Replaces the row at y_val with the given x coordinates """
+        old_row = self._rows.pop(y_val, None)
+        if old_row is not None:
+            self.population -= len(old_row)
+            self._box_stale = True
+        row = xs if isinstance(xs, Row) else Row(xs)
+        if not row:
+            return
+        self._rows[y_val] = row
+        self.population += len(row)
+        if self._box_stale:
+            return
+        if self._box is None:
+            self._box = (y_val, row[0], y_val, row[-1])
+        else:
+            min_y, min_x, max_y, max_x = self._box
+            self._box = (min(min_y, y_val), min(min_x, row[0]), max(max_y, y_val), max(max_x, row[-1]))
+
+    def add(self, y_val, x_val):
+        row = self._rows.get(y_val)
+        if row is None or x_val not in row:
+            self.set_row(y_val, [*(row or ()), x_val])
+
+    def discard(self, y_val, x_val):
+        row = self._rows.get(y_val)
+        if row is not None and x_val in row:
+            self.set_row(y_val, [x for x in row if x != x_val])
+
+    def bounding_box(self):
+        """ Returns (min_y, min_x, max_y, max_x) of the live cells, or None if there are no live cells """
+        if self._box_stale:
+            self._box_stale = False
+            self._box = None
+            if self._rows:
+                self._box = (min(self._rows), min(row[0] for row in self._rows.values()),
+                             max(self._rows), max(row[-1] for row in self._rows.values()))
+        return self._box
+
+    def to_cells(self):
+        """ Converts the Board back to a dictionary of sets """
+        return {y_val: set(row) for y_val, row in self._rows.items()}
+
+    def memory_bytes(self):
+        """ Returns the approximate memory used by the Board in bytes """
+        return getsizeof(self._rows) + sum(getsizeof(row) for row in self._rows.values())
+
+    def __getitem__(self, y_val):
+        return self._rows[y_val]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return "Board(%r)" % self.to_cells()
+
+
+LIFE_RULE = "B3/S23"
+RULE_BS = re.compile(r"B(\d*)/S(\d*)(?:/C?(\d+))?$", re.IGNORECASE)  # B3/S23, or B2/S/C3 for Generations
+RULE_SB = re.compile(r"(\d*)/(\d*)(?:/(\d+))?$")  # the older survival/birth notation: 23/3, or 12/34/3 for Generations
+RULE_LTL = re.compile(r"R(\d+),C(\d+),M([01]),S([\d.,]*?),B([\d.,]*?)(?:,N([MN]))?$", re.IGNORECASE)
+
+
+class Rule:
+    """ A cellular automaton rule, compiled into lookup tables so that every engine can apply it with table lookups
+    instead of if branches. Standard GOL is B3/S23: a dead cell with 3 neighbours is born, and a live cell with 2 or 3
+    neighbours survives. Create one with parse_rule.
+
+    Besides the birth and survival counts, a rule can have:
+    - more than 2 states (Generations rules). A live cell that does not survive goes through states 2, 3, ...
+      states - 1 before it is dead, and these dying cells do not count as neighbours or come alive again.
+    - a radius above 1, or a von Neumann (diamond) neighbourhood (Larger than Life rules).
+
+    Tables:
+    - next_dead and next_alive map the live cells in a cell's window (including the middle cell, so the engines never
+      have to subtract it) to whether the cell is alive in the next iteration.
+    - lives, lives_if_alive and lives_if_dead split the window counts into the ones where a cell is always alive in
+      the next iteration, and the ones where it depends on whether the cell is alive now. For B3/S23 they are {3},
+      {4} and nothing.
+    - table maps each of the 512 3x3 windows (bit 3 * y + x, so bit 4 is the middle cell) to the middle cell's next
+      state. Only for radius 1 Moore rules.
+    - block_table maps each of the 65536 4x4 blocks (bit 4 * y + x) to the centre 2x2 block after one iteration
+      (bit 2 * y + x). Only for radius 1 Moore rules. Built the first time it is used.
+    """
+
+    def __init__(self, birth, survival, states=2, radius=1, neighbourhood="M"):
+        """
+        :param birth: neighbour counts (not including the middle cell) at which a dead cell is born
+        :param survival: neighbour counts (not including the middle cell) at which a live cell survives
+        :param states: number of states. 2 for life-like rules, more for Generations rules
+        :param radius: how far the neighbourhood reaches
+        :param neighbourhood: "M" for Moore (square) or "N" for von Neumann (diamond)
+        """
+        if neighbourhood not in ("M", "N"):
+            raise ValueError("Unknown neighbourhood %r, use M (Moore) or N (von Neumann)" % neighbourhood)
+        if radius < 1 or states < 2:
+            raise ValueError("A rule needs a radius of at least 1 and at least 2 states")
+        self.birth = frozenset(birth)
+        self.survival = frozenset(survival)
+        self.states = states
+        self.radius = radius
+        self.neighbourhood = neighbourhood
+        self.offsets = tuple((y_offset, x_offset) for y_offset in range(-radius, radius + 1)
+                             for x_offset in range(-radius, radius + 1)
+                             if neighbourhood == "M" or abs(y_offset) + abs(x_offset) <= radius)
+        neighbours = len(self.offsets) - 1
+        if not all(0 <= count <= neighbours for count in self.birth | self.survival):
+            raise ValueError("Neighbour counts must be between 0 and %d for this neighbourhood" % neighbours)
+        if 0 in self.birth:
+            raise ValueError("Rules where cells are born with 0 neighbours would fill the whole (infinite) canvas")
+        self.next_dead = tuple(count in self.birth for count in range(neighbours + 2))
+        self.next_alive = (False,) + tuple(count - 1 in self.survival for count in range(1, neighbours + 2))
+        self.lives = frozenset(count for count, alive in enumerate(self.next_alive) if alive and self.next_dead[count])
+        self.lives_if_alive = frozenset(count for count, alive in enumerate(self.next_alive)
+                                        if alive and not self.next_dead[count])
+        self.lives_if_dead = frozenset(count for count, alive in enumerate(self.next_alive)
+                                       if self.next_dead[count] and not alive)
+        self.is_life = self.birth == {3} and self.survival == {2, 3} and states == 2 and radius == 1 and \
+            neighbourhood == "M"
+        self.table = None
+        if radius == 1 and neighbourhood == "M":
+            self.table = bytes(self.next_alive[bin(window).count("1")] if window & 1 << 4 else
+                               self.next_dead[bin(window).count("1")] for window in range(512))
+        self._block_table = None
+
+    @property
+    def block_table(self):
+        """ The 65536 entry 4x4 -> 2x2 table, used by the hashlife engine """
+        if self.table is None:
+            raise ValueError("Rule %s has no 4x4 block table, as it is not a radius 1 Moore rule" % self)
+        if self._block_table is None:
+            table = self.table
+            block_table = bytearray(1 << 16)
+            for block in range(1 << 16):
+                rows = [block >> shift & 0xF for shift in (0, 4, 8, 12)]
+                centre = 0
+                for y_val in (1, 2):
+                    for x_val in (1, 2):
+                        shift = x_val - 1  # the 3 cells of each row around x_val, as a 3 bit row of the window
+                        window = (rows[y_val - 1] >> shift & 7) | (rows[y_val] >> shift & 7) << 3 | \
+                            (rows[y_val + 1] >> shift & 7) << 6
+                        centre |= table[window] << (2 * (y_val - 1) + x_val - 1)
+                block_table[block] = centre
+            self._block_table = bytes(block_table)
+        return self._block_table
+
+    def supports(self, engine):
+        """ Returns whether an engine (one of ENGINES) can run this rule """
+        if engine in ("dense", "auto"):
+            return True
+        if self.states > 2:
+            return False
+        return engine == "frontier" or self.table is not None
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __str__(self):
+        if self.radius == 1 and self.neighbourhood == "M":
+            rule = "B%s/S%s" % ("".join(map(str, sorted(self.birth))), "".join(map(str, sorted(self.survival))))
+            return rule + ("/C%d" % self.states if self.states > 2 else "")
+        return "R%d,C%d,M0,S%s,B%s,N%s" % (self.radius, self.states if self.states > 2 else 0,
+                                           _format_counts(self.survival), _format_counts(self.birth),
+                                           self.neighbourhood)
+
+    def __repr__(self):
+        return "Rule(%r)" % str(self)
+
+
+def _format_counts(counts):
+    """ Helper for Rule.__str__. Writes counts as comma separated ranges, eg. {2, 3, 4, 7} becomes 2..4,7 """
+    ranges = []
+    for count in sorted(counts):
+        if ranges and ranges[-1][1] == count - 1:
+            ranges[-1][1] = count
+        else:
+            ranges.append([count, count])
+    return ",".join("%d..%d" % (start, stop) if start != stop else str(start) for start, stop in ranges)
+
+
+def _parse_counts(text):
+    """ Helper for parse_rule. Reads comma separated counts and ranges, eg. 2..4,7 """
+    counts = set()
+    for part in filter(None, text.split(",")):
+        start, _, stop = part.partition("..")
+        counts.update(range(int(start), int(stop or start) + 1))
+    return counts
+
+
+_rules = dict()  # {rule string: Rule}, so each rule's tables are only built once
+
+
+def parse_rule(text=LIFE_RULE):
+    """ Compiles a rule string into a Rule. Compiled rules are cached, so parsing the same rule again is free.
+    Accepts:
+    - B/S notation, eg. B3/S23 (Life), B36/S23 (HighLife), B3678/S34678 (Day & Night), and the older S/B notation
+      such as 23/3
+    - Generations rules, eg. B2/S/C3 (Brian's Brain) or 12/34/3
+    - Larger than Life rules, eg. R5,C0,M1,S34..58,B34..45,NM (Bosco's Rule). M1 counts the middle cell as a neighbour
+      and NN uses a von Neumann neighbourhood
+
+    :param text: the rule string, or a Rule which is returned as it is
+    :return: Rule
+    """
+    if isinstance(text, Rule):
+        return text
+    text = text.strip()
+    if text in _rules:
+        return _rules[text]
+    match = RULE_BS.match(text)
+    if match:
+        birth, survival, states = match.groups()
+        rule = Rule(map(int, birth), map(int, survival), int(states or 2))
+    elif RULE_SB.match(text):
+        survival, birth, states = RULE_SB.match(text).groups()
+        rule = Rule(map(int, birth), map(int, survival), int(states or 2))
+    elif RULE_LTL.match(text):
+        radius, states, middle, survival, birth, neighbourhood = RULE_LTL.match(text).groups()
+        survival = _parse_counts(survival)
+        if middle == "1":  # a live cell counts itself, which Rule never does
+            survival = {count - 1 for count in survival if count > 0}
+        rule = Rule(_parse_counts(birth), survival, max(int(states), 2), int(radius), (neighbourhood or "M").upper())
     else:
-        return _parse_args(argv[index], arg_type, is_positive)
+        raise ValueError("Unknown rule %r. Use B/S notation such as B3/S23, B2/S/C3 for Generations, or "
+                         "R2,C0,M0,S2..3,B3..3,NM for Larger than Life" % text)
+    _rules[text] = rule
+    return rule
 
 
-def count_adjacent_cells(cells, max_x, y_val):
+def count_adjacent_cells(cells, max_x, y_val, min_x=0):
     """ Counts number of adjacent cells for each cell in a single line buffer (horizontal line). Returns a tuple of
     the number of adjacent cells each cell has
     Example:
@@ -104,10 +513,11 @@ def count_adjacent_cells(cells, max_x, y_val):
     :type cells: dict
     :param max_x: maximum x coordinate of the cells
     :param y_val: the y-index to check Eg. the first row will be 0, second row will be 1, and so on.
+    :param min_x: minimum x coordinate of the cells
     :return: tuple
     """
     adj_cell_count = []
-    for x_val in range(0, max_x + 1): # loop through (cell) in each row
+    for x_val in range(min_x, max_x + 1): # loop through (cell) in each row
         window = [0] * SLIDING_WINDOW_SIZE ** 2  # the sliding window, like a mask
         for offset in range(0, len(window)):
             cell_offset_x = offset % SLIDING_WINDOW_SIZE - 1
@@ -122,34 +532,32 @@ def count_adjacent_cells(cells, max_x, y_val):
     return tuple(adj_cell_count)
 
 
-def create_next_cells(cell_adjnum_pair, max_x):
-    """ Creates the next iteration's cells based on how many adjacent cells a cell has. This applies the GOL rules.
+def create_next_cells(cell_adjnum_pair, max_x, min_x=0, rule=None):
+    """ Creates the next iteration's cells based on how many adjacent cells a cell has. This applies the GOL rules, or
+    any other radius 1 life-like rule.
 
     :param cell_adjnum_pair: an iterable containing the (cell, adjacent num 0f cells)
     :type cell_adjnum_pair: iterable
     :param max_x: maximum x coordinate of the cells
+    :param min_x: minimum x coordinate of the cells
+    :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
     :return: list which contains the next iteration of cells for that specific row/line buffer
     """
-    # zeroes out buffer to fulfil these 2 rules:
-    # Rule 1. Overpopulation: if a living cell is surrounded by more than three living cells, it dies.
-    # 3. Underpopulation: if a living cell is surrounded by fewer than two living cells, it dies.
-    line_buffer_mask = [0] * (max_x + 1)
+    rule = parse_rule(rule or LIFE_RULE)
+    # for B3/S23, next_alive is only true for 2 or 3 neighbours (stasis), anything else is over or underpopulation,
+    # and next_dead is only true for 3 neighbours (reproduction). The window counts include the middle cell, hence + 1
+    next_alive, next_dead = rule.next_alive, rule.next_dead
+    line_buffer_mask = [0] * (max_x - min_x + 1)
 
     x_index = 0
     for cell_type, adj_cell_count in cell_adjnum_pair:
-        if cell_type == 1:
-            # 2. Stasis: if a living cell is surrounded by two or three living cells, it survives.
-            if 2 <= adj_cell_count <= 3:
-                line_buffer_mask[x_index] = 1
-        else:
-            # 4. Reproduction: if a dead cell is surrounded by exactly three cells, it becomes a live cell.
-            if adj_cell_count == 3:
-                line_buffer_mask[x_index] = 1
+        if next_alive[adj_cell_count + 1] if cell_type == 1 else next_dead[adj_cell_count]:
+            line_buffer_mask[x_index] = 1
         x_index += 1
     return line_buffer_mask
 
 
-def create_line_buffer(cells, max_y, max_x):
+def create_line_buffer(cells, max_y, max_x, min_y=0, min_x=0):
     """ Generator which returns a list for each row of cells. Requires the cell coordinate dictionary to work.
 
     :param cells: dict containing the cell coordinates
@@ -161,22 +569,25 @@ def create_line_buffer(cells, max_y, max_x):
     :type cells: dict
     :param max_y: maximum y coordinate of the cells
     :param max_x: maximum x coordinate of the cells
+    :param min_y: minimum y coordinate of the cells
+    :param min_x: minimum x coordinate of the cells
     :return: list
     """
-    for row_num in range(0, max_y + 1):
-        line_buffer = [0] * (max_x + 1)
+    for row_num in range(min_y, max_y + 1):
+        line_buffer = [0] * (max_x - min_x + 1)
         cell_ys = cells.get(row_num)
         if cell_ys is not None:  # if row num exists inside the dictionary of cells
-            line_buffer = [1 if _ in cell_ys else 0 for _ in range(max_x + 1)]
+            line_buffer = [1 if _ in cell_ys else 0 for _ in range(min_x, max_x + 1)]
         yield line_buffer
 
 
-def _update_next_iter_cells(next_iter_cells, new_cells_hor, y_val):
+def _update_next_iter_cells(next_iter_cells, new_cells_hor, y_val, min_x=0):
     """ Updates the dictionary that contains the next iteration's cells
 
     :param next_iter_cells: an empty dict; the dictionary that contains the next iteration's cells
     :param new_cells_hor: a new row of cells
     :param y_val: the y-index that the row of cells belongs to
+    :param min_x: the x coordinate of the first cell in the row
     :return: None
     """
     # adds the new cells back to the dictionary
@@ -187,36 +598,1391 @@ def _update_next_iter_cells(next_iter_cells, new_cells_hor, y_val):
             if y_val not in next_iter_cells:
                 next_iter_cells[y_val] = set()  # using sets to prevent duplicate entries
             # add that living cell's coordinates to the dictionary
-            next_iter_cells[y_val].add(x_index)
+            next_iter_cells[y_val].add(min_x + x_index)
+
+
+def count_neighbourhoods(cells, rule=None):
+    """ Counts the number of live cells in the window around every cell that is within reach of a live cell (the 3x3
+    window for GOL, or the rule's larger or diamond shaped neighbourhood).
+    Unlike count_adjacent_cells, the live cell in the middle of the window is counted as well, and dead cells that are
+    far away from any live cell are never visited.
+    Example:
+    a single row of OXXXO will return {y-1: {x: 1, x+1: 2, x+2: 3, x+3: 2, x+4: 1}, y: {...}, y+1: {...}}
+
+    :param cells: dict containing the cell coordinates
+    :param rule: the Rule (or rule string) whose neighbourhood to count. Defaults to B3/S23
+    :return: dict of {y: Counter({x: live cells in window})}
+    """
+    rule = parse_rule(rule or LIFE_RULE)
+    radius = rule.radius
+    window_xs = defaultdict(list)  # {y: the x of every window a live cell counts towards, once per live cell}
+    for y_val, row in cells.items():
+        row_xs = dict()  # {half width: xs}, von Neumann windows get narrower away from the middle row
+        for y_offset in range(-radius, radius + 1):
+            width = radius if rule.neighbourhood == "M" else radius - abs(y_offset)
+            if width not in row_xs:
+                # each live cell counts towards the windows of itself and the cells either side of it...
+                xs = row_xs[width] = []
+                for x_offset in range(-width, width + 1):
+                    xs.extend(map(x_offset.__add__, row))
+            # ...and so do the cells of the rows above and below it
+            window_xs[y_val + y_offset].extend(row_xs[width])
+    # the lists are built and counted in C (map, extend and Counter), instead of one Python level update per cell
+    return {y_val: Counter(xs) for y_val, xs in window_xs.items()}
+
+
+def step_frontier(cells, rule=None):
+    """ Creates the next iteration's cell dictionary by only looking at live cells and their neighbours, so the cost
+    scales with the number of live cells instead of the area of the canvas. Gives the same result as
+    operate_on_each_row.
+
+    As the window counts include the middle cell, the GOL rules become:
+    a cell is alive in the next iteration if its window has 3 live cells,
+    or if it is a living cell and its window has 4 live cells.
+    Other rules are split the same way into the window counts where a cell always lives, only lives if it was alive,
+    or only lives if it was dead, so only the counts that need it look the cell up in its row.
+
+    :param cells: dict containing the cell coordinates
+    :param rule: the Rule (or rule string) to apply. Defaults to B3/S23. Generations rules are not supported
+    :return: dict
+    """
+    rule = parse_rule(rule or LIFE_RULE)
+    if rule.states > 2:
+        raise ValueError("The frontier engine can not run Generations rules such as %s" % rule)
+    lives, lives_if_alive, lives_if_dead = rule.lives, rule.lives_if_alive, rule.lives_if_dead
+    next_iter_cells = dict()
+    window_counts = count_neighbourhoods(cells, rule)
+    _lap("neighbour_count")
+    for y_val, row_counts in window_counts.items():
+        row = cells.get(y_val, ())
+        if isinstance(row, Row):  # a Board's rows are searched with bisect, so one set per row makes lookups cheaper
+            row = set(row)
+        new_row = {x_val for x_val, count in row_counts.items()
+                   if count in lives or (count in lives_if_alive and x_val in row) or
+                   (count in lives_if_dead and x_val not in row)}
+        if new_row:
+            next_iter_cells[y_val] = new_row
+    _lap("rule_application")
+    return next_iter_cells
+
+
+def _bounding_box(cells):
+    """ Helper that returns (min_y, min_x, max_y, max_x) of the live cells, or None if there are no live cells"""
+    if isinstance(cells, Board):
+        return cells.bounding_box()
+    rows = [y_val for y_val, row in cells.items() if row]
+    if not rows:
+        return None
+    return (min(rows), min(min(cells[y_val]) for y_val in rows),
+            max(rows), max(max(cells[y_val]) for y_val in rows))
+
+
+def cell_density(cells):
+    """ Returns the fraction of the live cells' bounding box that is filled with live cells
+
+    :param cells: dict containing the cell coordinates
+    :return: float
+    """
+    box = _bounding_box(cells)
+    if box is None:
+        return 0.0
+    min_y, min_x, max_y, max_x = box
+    population = cells.population if isinstance(cells, Board) else sum(len(row) for row in cells.values())
+    return population / ((max_y - min_y + 1) * (max_x - min_x + 1))
+
+
+def _count_ranges(rule):
+    """ Helper for DenseGrid and ParallelGrid. Returns the rule's lives, lives_if_alive and lives_if_dead window
+    counts as lists of (lowest, highest) ranges, as comparing whole arrays against a few ranges is much faster than
+    looking every cell up in a table """
+    groups = []
+    for counts in (rule.lives, rule.lives_if_alive, rule.lives_if_dead):
+        ranges = []
+        for count in sorted(counts):
+            if ranges and ranges[-1][1] == count - 1:
+                ranges[-1][1] = count
+            else:
+                ranges.append([count, count])
+        groups.append([tuple(count_range) for count_range in ranges])
+    return groups
+
+
+def _apply_rule(counts, alive, count_ranges):
+    """ Helper for DenseGrid and ParallelGrid. Returns a numpy bool array of the cells that are alive in the next
+    iteration, given the window counts, the numpy array of the live cells, and the rule's _count_ranges """
+    lives, lives_if_alive, lives_if_dead = count_ranges
+    alive = alive.view(bool)  # the array only holds 1s and 0s
+    next_alive = np.zeros(counts.shape, dtype=bool)
+    for ranges, mask in ((lives, None), (lives_if_alive, alive), (lives_if_dead, ~alive if lives_if_dead else None)):
+        matches = None
+        for lowest, highest in ranges:
+            match = counts == lowest if lowest == highest else (counts >= lowest) & (counts <= highest)
+            matches = match if matches is None else np.logical_or(matches, match, out=matches)
+        if matches is not None:
+            if mask is not None:
+                matches &= mask
+            next_alive |= matches
+    return next_alive
+
+
+def _window_counts(alive, rule):
+    """ Helper for DenseGrid and BoardBatch. Returns the number of live cells in the window around every cell of a
+    numpy array of 1s and 0s (or of every board in a stack of them), including the middle cell """
+    radius = rule.radius
+    if len(rule.offsets) > 255:
+        alive = alive.astype(np.uint16)  # so the counts do not overflow
+    height, width = alive.shape[-2:]
+    padded = np.pad(alive, [(0, 0)] * (alive.ndim - 2) + [(radius, radius)] * 2)
+    if rule.neighbourhood == "N":
+        return sum(padded[..., radius + y_offset:radius + y_offset + height,
+                          radius + x_offset:radius + x_offset + width] for y_offset, x_offset in rule.offsets)
+    # sum the rows, then the columns
+    vertical = sum(padded[..., y_offset:y_offset + height, :] for y_offset in range(2 * radius + 1))
+    return sum(vertical[..., x_offset:x_offset + width] for x_offset in range(2 * radius + 1))
+
+
+def _next_states(array, alive, counts, rule, count_ranges):
+    """ Helper for DenseGrid and BoardBatch. Returns the next iteration of a numpy array of cell states, given its live
+    cells and their window counts """
+    # for B3/S23, a cell is alive if its window has 3 live cells, or if it is a living cell and its window has 4
+    # live cells
+    next_alive = _apply_rule(counts, alive, count_ranges)
+    if rule.states == 2:
+        return next_alive.view(np.uint8)
+    # every cell that is not dead ages by one state (so live cells that do not survive start dying), until it runs
+    # out of states and is dead. Only dead cells can be born
+    next_array = array + (array > 0)
+    next_array[next_array == rule.states] = 0
+    next_array[next_alive & (array <= 1)] = 1
+    return next_array
+
+
+class DenseGrid:
+    """ Keeps the cells as a 2d numpy uint8 array instead of a dictionary, and creates the next iteration of the whole
+    array at once using shifted array sums and a lookup into the rule's transition table. Requires numpy.
+    The array covers the live cells plus a margin of dead cells, and grows whenever a live cell comes within reach of
+    its edge.
+    This is the only engine that runs Generations rules. Their dying cells are kept in the array as states 2 and up,
+    but to_cells (and so checkpoints and saved patterns) only has the live cells.
+    """
+    MARGIN = 8
+
+    def __init__(self, array, y_offset=0, x_offset=0, rule=None):
+        """
+        :param array: 2d numpy uint8 array of 1s (live cells) and 0s (dead cells), or the states of a Generations rule
+        :param y_offset: y coordinate of array[0, 0]
+        :param x_offset: x coordinate of array[0, 0]
+        :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+        """
+        if np is None:
+            raise ImportError("numpy is required for the dense engine. pip install it.")
+        self.array = array
+        self.y_offset = y_offset
+        self.x_offset = x_offset
+        self.rule = parse_rule(rule or LIFE_RULE)
+        self._count_ranges = _count_ranges(self.rule)
+
+    @classmethod
+    def from_cells(cls, cells, rule=None):
+        """ Creates a DenseGrid from a cell dictionary """
+        if np is None:
+            raise ImportError("numpy is required for the dense engine. pip install it.")
+        box = _bounding_box(cells)
+        if box is None:
+            return cls(np.zeros((1, 1), dtype=np.uint8), rule=rule)
+        margin = max(cls.MARGIN, parse_rule(rule or LIFE_RULE).radius)
+        min_y, min_x, max_y, max_x = box
+        y_offset, x_offset = min_y - margin, min_x - margin
+        array = np.zeros((max_y - y_offset + margin + 1, max_x - x_offset + margin + 1), dtype=np.uint8)
+        ys = [y_val for y_val, row in cells.items() for _ in row]
+        xs = [x_val for row in cells.values() for x_val in row]
+        array[np.array(ys, dtype=np.intp) - y_offset, np.array(xs, dtype=np.intp) - x_offset] = 1
+        return cls(array, y_offset, x_offset, rule)
+
+    def _alive(self):
+        """ Returns the array with only the live cells set, leaving out the dying cells of Generations rules """
+        return self.array if self.rule.states == 2 else (self.array == 1).view(np.uint8)
+
+    def to_cells(self):
+        """ Converts the DenseGrid back to a cell dictionary """
+        cells = dict()
+        ys, xs = np.nonzero(self._alive())
+        for y_val, x_val in zip((ys + self.y_offset).tolist(), (xs + self.x_offset).tolist()):
+            if y_val not in cells:
+                cells[y_val] = set()
+            cells[y_val].add(x_val)
+        return cells
+
+    def population(self):
+        return int(np.count_nonzero(self._alive()))
+
+    def density(self):
+        """ Returns the fraction of the live cells' bounding box that is filled with live cells """
+        alive = self._alive()
+        rows, cols = np.nonzero(alive.any(axis=1))[0], np.nonzero(alive.any(axis=0))[0]
+        if not len(rows):
+            return 0.0
+        return self.population() / ((rows[-1] - rows[0] + 1) * (cols[-1] - cols[0] + 1))
+
+    def _grow(self):
+        """ Pads the array with dead cells on every side that a live cell is within reach of, so births are not cut
+        off """
+        array, reach = self.array, self.rule.radius
+        margin = max(self.MARGIN, reach)
+        top = margin if array[:reach].any() else 0
+        left = margin if array[:, :reach].any() else 0
+        bottom = margin if array[-reach:].any() else 0
+        right = margin if array[:, -reach:].any() else 0
+        if top or left or bottom or right:
+            self.array = np.pad(array, ((top, bottom), (left, right)))
+            self.y_offset -= top
+            self.x_offset -= left
+
+    def step(self):
+        """ Creates the next iteration of cells in place. Returns self """
+        self._grow()
+        # live cells in each window, including the middle cell
+        alive = self._alive()
+        counts = _window_counts(alive, self.rule)
+        _lap("neighbour_count")
+        self.array = _next_states(self.array, alive, counts, self.rule, self._count_ranges)
+        _lap("rule_application")
+        return self
+
+
+_shared_arrays = dict()  # {shared memory name: (SharedMemory, numpy array)} attached by a worker process
+
+
+def _attach_shared_array(name, shape, keep):
+    """ Helper for worker processes. Returns a numpy array backed by the named shared memory block, attaching to it the
+    first time it is used. Blocks whose names are not in keep are from a canvas that has since grown, so they are
+    closed."""
+    for stale_name in set(_shared_arrays) - set(keep):
+        _shared_arrays.pop(stale_name)[0].close()
+    if name not in _shared_arrays:
+        block = shared_memory.SharedMemory(name=name)
+        _shared_arrays[name] = (block, np.ndarray(shape, dtype=np.uint8, buffer=block.buf))
+    return _shared_arrays[name][1]
+
+
+def _step_band(source_name, target_name, shape, row_start, row_stop, count_ranges):
+    """ Worker process task for ParallelGrid. Creates the next iteration of rows row_start to row_stop - 1 of the shared
+    source array and writes them into the shared target array. The rows just above and below the band (the halo rows)
+    belong to the neighbouring bands, and are read straight from the shared source array.
+    count_ranges are the rule's window counts, as returned by _count_ranges."""
+    source = _attach_shared_array(source_name, shape, (source_name, target_name))
+    target = _attach_shared_array(target_name, shape, (source_name, target_name))
+    window = source[row_start - 1:row_stop + 1]  # the band plus a halo row on either side
+    vertical = window[:-2] + window[1:-1] + window[2:]
+    counts = vertical[:, :-2] + vertical[:, 1:-1] + vertical[:, 2:]
+    target[row_start:row_stop, 1:-1] = _apply_rule(counts, source[row_start:row_stop, 1:-1], count_ranges)
+
+
+class ParallelGrid(DenseGrid):
+    """ A DenseGrid that is stepped in horizontal bands by a pool of worker processes. Requires numpy.
+    The canvas lives in two shared memory blocks (the current and the next iteration) with a border of dead cells, so
+    only the band boundaries are sent to the workers each iteration, never the cells themselves.
+    Call close() (or use it as a context manager) to stop the workers and free the shared memory.
+    Only runs radius 1 life-like rules.
+    """
+
+    def __init__(self, array, y_offset=0, x_offset=0, workers=None, rule=None):
+        """
+        :param array: 2d numpy uint8 array of 1s (live cells) and 0s (dead cells)
+        :param y_offset: y coordinate of array[0, 0]
+        :param x_offset: x coordinate of array[0, 0]
+        :param workers: number of worker processes. Defaults to the number of CPUs
+        :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+        """
+        if np is None:
+            raise ImportError("numpy is required for the parallel engine. pip install it.")
+        self.rule = parse_rule(rule or LIFE_RULE)
+        if not self.rule.supports("parallel"):
+            raise ValueError("The parallel engine can not run rule %s" % self.rule)
+        self._count_ranges = _count_ranges(self.rule)
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._blocks = []
+        self._allocate(array)
+        self.y_offset = y_offset
+        self.x_offset = x_offset
+
+    @classmethod
+    def from_cells(cls, cells, workers=None, rule=None):
+        """ Creates a ParallelGrid from a cell dictionary """
+        grid = DenseGrid.from_cells(cells, rule)
+        return cls(grid.array, grid.y_offset, grid.x_offset, workers, rule)
+
+    def _allocate(self, array):
+        """ Copies an array into a fresh pair of shared memory blocks, freeing the old pair """
+        shape = (array.shape[0] + 2, array.shape[1] + 2)  # room for the border of dead cells
+        blocks = [shared_memory.SharedMemory(create=True, size=shape[0] * shape[1]) for _ in range(2)]
+        arrays = [np.ndarray(shape, dtype=np.uint8, buffer=block.buf) for block in blocks]
+        for shared_array in arrays:
+            shared_array[:] = 0
+        arrays[0][1:-1, 1:-1] = array
+        self._free()
+        self._blocks, self._shared_arrays = blocks, arrays
+
+    def _free(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks, self._shared_arrays = [], []
+
+    @property
+    def array(self):
+        """ The current iteration's cells, without the border """
+        return self._shared_arrays[0][1:-1, 1:-1]
+
+    def _grow(self):
+        """ Reallocates the shared memory with a margin of dead cells on every side that a live cell has reached """
+        array = self.array
+        top = self.MARGIN if array[0].any() else 0
+        left = self.MARGIN if array[:, 0].any() else 0
+        bottom = self.MARGIN if array[-1].any() else 0
+        right = self.MARGIN if array[:, -1].any() else 0
+        if top or left or bottom or right:
+            self._allocate(np.pad(array, ((top, bottom), (left, right))))
+            self.y_offset -= top
+            self.x_offset -= left
+
+    def step(self):
+        """ Creates the next iteration of cells, one band of rows per task. Returns self """
+        self._grow()
+        shape = self._shared_arrays[0].shape
+        rows = shape[0] - 2
+        bands = min(self.workers, rows)
+        bounds = [1 + rows * band // bands for band in range(bands + 1)]
+        source_name, target_name = self._blocks[0].name, self._blocks[1].name
+        futures = [self._executor.submit(_step_band, source_name, target_name, shape, row_start, row_stop,
+                                         self._count_ranges)
+                   for row_start, row_stop in zip(bounds, bounds[1:])]
+        for future in futures:  # wait for every band before the next iteration reads the halo rows
+            future.result()
+        _lap("neighbour_count")
+        self._blocks.reverse()
+        self._shared_arrays.reverse()
+        return self
+
+    def close(self):
+        """ Stops the worker processes and frees the shared memory """
+        self._executor.shutdown()
+        self._free()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BoardBatch:
+    """ Many independent boards stacked into one 3d numpy uint8 array of (board, y, x), so a whole batch of small
+    boards (eg. thousands of random soups for census statistics) is created in one go with the same few array
+    operations as a single DenseGrid, instead of paying for a mainloop (or a process) per board. Requires numpy.
+    Every board gets the same height and width, big enough for the largest board plus a margin, and the whole stack
+    grows whenever a live cell on any board comes within reach of the edge.
+    """
+    MARGIN = 8
+
+    def __init__(self, array, y_offsets, x_offsets, rule=None):
+        """
+        :param array: 3d numpy uint8 array of (board, y, x), 1s for live cells and 0s for dead cells (or the states of
+        a Generations rule)
+        :param y_offsets: numpy array of the y coordinate of array[board, 0, 0] for every board
+        :param x_offsets: numpy array of the x coordinate of array[board, 0, 0] for every board
+        :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+        """
+        if np is None:
+            raise ImportError("numpy is required for batches. pip install it.")
+        self.array = array
+        self.y_offsets = y_offsets
+        self.x_offsets = x_offsets
+        self.rule = parse_rule(rule or LIFE_RULE)
+        self._count_ranges = _count_ranges(self.rule)
+
+    @classmethod
+    def from_boards(cls, boards, rule=None):
+        """ Creates a BoardBatch from an iterable of cell dictionaries """
+        if np is None:
+            raise ImportError("numpy is required for batches. pip install it.")
+        boards = list(boards)
+        boxes = [_bounding_box(cells) or (0, 0, 0, 0) for cells in boards]
+        margin = max(cls.MARGIN, parse_rule(rule or LIFE_RULE).radius)
+        height = max((max_y - min_y for min_y, _, max_y, _ in boxes), default=0) + 2 * margin + 1
+        width = max((max_x - min_x for _, min_x, _, max_x in boxes), default=0) + 2 * margin + 1
+        y_offsets = np.array([box[0] - margin for box in boxes], dtype=np.int64)
+        x_offsets = np.array([box[1] - margin for box in boxes], dtype=np.int64)
+        array = np.zeros((len(boards), height, width), dtype=np.uint8)
+        # set the live cells of every board with a single assignment
+        indices, ys, xs = [], [], []
+        for index, cells in enumerate(boards):
+            for y_val, row in cells.items():
+                indices.extend([index] * len(row))
+                ys.extend([y_val] * len(row))
+                xs.extend(row)
+        indices = np.array(indices, dtype=np.intp)
+        array[indices, np.array(ys, dtype=np.intp) - y_offsets[indices],
+              np.array(xs, dtype=np.intp) - x_offsets[indices]] = 1
+        return cls(array, y_offsets, x_offsets, rule)
+
+    def __len__(self):
+        return len(self.array)
+
+    def _alive(self):
+        """ Returns the array with only the live cells set, leaving out the dying cells of Generations rules """
+        return self.array if self.rule.states == 2 else (self.array == 1).view(np.uint8)
+
+    def to_cells(self):
+        """ Converts the BoardBatch back to a list of cell dictionaries, one per board """
+        boards = [dict() for _ in range(len(self))]
+        indices, ys, xs = np.nonzero(self._alive())
+        ys = ys + self.y_offsets[indices]
+        xs = xs + self.x_offsets[indices]
+        for index, y_val, x_val in zip(indices.tolist(), ys.tolist(), xs.tolist()):
+            cells = boards[index]
+            if y_val not in cells:
+                cells[y_val] = set()
+            cells[y_val].add(x_val)
+        return boards
+
+    def populations(self):
+        """ Returns a numpy array of the number of live cells on every board """
+        return np.count_nonzero(self._alive(), axis=(1, 2))
+
+    def _grow(self):
+        """ Pads every board with dead cells on every side that a live cell on any board is within reach of """
+        array, reach = self.array, self.rule.radius
+        margin = max(self.MARGIN, reach)
+        top = margin if array[:, :reach].any() else 0
+        left = margin if array[:, :, :reach].any() else 0
+        bottom = margin if array[:, -reach:].any() else 0
+        right = margin if array[:, :, -reach:].any() else 0
+        if top or left or bottom or right:
+            self.array = np.pad(array, ((0, 0), (top, bottom), (left, right)))
+            self.y_offsets = self.y_offsets - top
+            self.x_offsets = self.x_offsets - left
+
+    def step(self):
+        """ Creates the next iteration of every board in place. Returns self """
+        self._grow()
+        alive = self._alive()
+        self.array = _next_states(self.array, alive, _window_counts(alive, self.rule), self.rule, self._count_ranges)
+        return self
+
+    def advance(self, generations):
+        """ Advances every board by the given number of iterations.
+
+        :param generations: number of iterations to advance by
+        :return: numpy array of (iteration, board) of the number of live cells on every board after each iteration
+        """
+        populations = np.empty((generations, len(self)), dtype=np.int64)
+        for generation in range(generations):
+            self.step()
+            populations[generation] = self.populations()
+        return populations
+
+
+def _advance_batch(array, y_offsets, x_offsets, rule, generations):
+    """ Worker process task for BatchPool. Advances one chunk of boards, and returns its new array and offsets along
+    with the populations of every iteration """
+    batch = BoardBatch(array, y_offsets, x_offsets, rule)
+    populations = batch.advance(generations)
+    return batch.array, batch.y_offsets, batch.x_offsets, populations
+
+
+class BatchPool:
+    """ Splits a batch of boards into one BoardBatch per worker process, so big batches use every CPU. Requires numpy.
+    The chunks live in this process, and are sent to the workers (and back) on every call to advance, so advancing by
+    many iterations at a time keeps that cost down.
+    Call close() (or use it as a context manager) to stop the workers.
+    """
+
+    def __init__(self, boards, rule=None, workers=None):
+        """
+        :param boards: iterable of cell dictionaries
+        :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+        :param workers: number of worker processes. Defaults to the number of CPUs
+        """
+        boards = list(boards)
+        self.rule = parse_rule(rule or LIFE_RULE)
+        self.workers = max(min(workers or os.cpu_count() or 1, len(boards)), 1)
+        bounds = [len(boards) * chunk // self.workers for chunk in range(self.workers + 1)]
+        self._chunks = [BoardBatch.from_boards(boards[start:stop], self.rule)
+                        for start, stop in zip(bounds, bounds[1:])]
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def advance(self, generations):
+        """ Advances every board by the given number of iterations, one chunk per worker.
+
+        :param generations: number of iterations to advance by
+        :return: numpy array of (iteration, board) of the number of live cells on every board after each iteration
+        """
+        futures = [self._executor.submit(_advance_batch, chunk.array, chunk.y_offsets, chunk.x_offsets,
+                                         str(self.rule), generations) for chunk in self._chunks]
+        populations = []
+        for chunk, future in zip(self._chunks, futures):
+            chunk.array, chunk.y_offsets, chunk.x_offsets, chunk_populations = future.result()
+            populations.append(chunk_populations)
+        return np.concatenate(populations, axis=1)
+
+    def populations(self):
+        """ Returns a numpy array of the number of live cells on every board """
+        return np.concatenate([chunk.populations() for chunk in self._chunks])
+
+    def to_cells(self):
+        """ Returns a list of cell dictionaries, one per board """
+        return [cells for chunk in self._chunks for cells in chunk.to_cells()]
+
+    def close(self):
+        """ Stops the worker processes """
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def simulate_batch(boards, generations, rule=None, workers=None, block=64):
+    """ Advances a batch of independent boards together, and yields the number of live cells on every board after each
+    iteration, as a stream. No arguments are parsed and nothing is printed, so it is cheap to call from other code.
+
+    :param boards: iterable of cell dictionaries
+    :param generations: number of iterations to advance by
+    :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+    :param workers: number of worker processes to split the batch across (see BatchPool). None steps the whole batch
+    as a single BoardBatch in this process
+    :param block: number of iterations to advance between handing out results. With workers, this is also how many
+    iterations each worker runs per task
+    :return: generator of numpy arrays, one per iteration, of the number of live cells on every board
+    """
+    batch = BatchPool(boards, rule, workers) if workers else BoardBatch.from_boards(boards, rule)
+    try:
+        for start in range(0, generations, block):
+            yield from batch.advance(min(block, generations - start))
+    finally:
+        if isinstance(batch, BatchPool):
+            batch.close()
 
 
-def operate_on_each_row(cells, max_y, max_x, background_char):
+def run_batch(boards, generations, rule=None, workers=None):
+    """ Advances a batch of independent boards together and returns their final iterations. See simulate_batch.
+
+    :param boards: iterable of cell dictionaries
+    :param generations: number of iterations to advance by
+    :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+    :param workers: number of worker processes to split the batch across. None steps the whole batch in this process
+    :return: list of cell dictionaries, one per board
+    """
+    if not workers:
+        batch = BoardBatch.from_boards(boards, rule)
+        for _ in range(generations):
+            batch.step()
+        return batch.to_cells()
+    with BatchPool(boards, rule, workers) as batch:
+        if generations:
+            batch.advance(generations)
+        return batch.to_cells()
+
+
+class BitRowGrid:
+    """ Keeps each row of cells as a single python int bitmask, and creates the next iteration of a whole row at once
+    with bitwise adder logic across the row and the rows above and below it. As python ints have no fixed size, every
+    cell in the row is handled by the same few operations, without needing numpy.
+    Bit i of a row is the cell at x_offset + i. Rows grow to the right on their own, and x_offset is moved left
+    whenever a live cell reaches bit 0.
+    Only runs radius 1 life-like rules. Rules other than B3/S23 pick out their birth and survival counts from the bit
+    planes of the neighbour counts.
+    """
+    MARGIN = 64
+
+    def __init__(self, rows, x_offset=0, rule=None):
+        """
+        :param rows: dict of {y: int bitmask of the row's live cells}
+        :param x_offset: x coordinate of bit 0 of every row
+        :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+        """
+        self.rows = rows
+        self.x_offset = x_offset
+        self.rule = parse_rule(rule or LIFE_RULE)
+        if not self.rule.supports("bitwise"):
+            raise ValueError("The bitwise engine can not run rule %s" % self.rule)
+
+    @classmethod
+    def from_cells(cls, cells, rule=None):
+        """ Creates a BitRowGrid from a cell dictionary """
+        box = _bounding_box(cells)
+        x_offset = box[1] - cls.MARGIN if box is not None else 0
+        rows = dict()
+        for y_val, row in cells.items():
+            bitmask = 0
+            for x_val in row:
+                bitmask |= 1 << (x_val - x_offset)
+            if bitmask:
+                rows[y_val] = bitmask
+        return cls(rows, x_offset, rule)
+
+    def to_cells(self):
+        """ Converts the BitRowGrid back to a cell dictionary """
+        cells = dict()
+        for y_val, bitmask in self.rows.items():
+            row = cells[y_val] = set()
+            while bitmask:
+                lowest_bit = bitmask & -bitmask
+                row.add(self.x_offset + lowest_bit.bit_length() - 1)
+                bitmask ^= lowest_bit
+        return cells
+
+    def population(self):
+        return sum(bin(bitmask).count("1") for bitmask in self.rows.values())
+
+    @staticmethod
+    def _count_planes(above, row, below):
+        """ Returns the neighbour counts of every cell in a row as bit planes (ones, twos, fours, eights), so that
+        count = ones + 2*twos + 4*fours + 8*eights """
+        # add up the 8 neighbours of every cell at once
+        above_left, above_right = above << 1, above >> 1
+        below_left, below_right = below << 1, below >> 1
+        row_left, row_right = row << 1, row >> 1
+        # full adders for the three cells above, the three cells below, and the two cells either side
+        above_sum = above_left ^ above ^ above_right
+        above_carry = (above_left & above) | (above_right & (above_left ^ above))
+        below_sum = below_left ^ below ^ below_right
+        below_carry = (below_left & below) | (below_right & (below_left ^ below))
+        row_sum = row_left ^ row_right
+        row_carry = row_left & row_right
+        ones = above_sum ^ below_sum ^ row_sum
+        ones_carry = (above_sum & below_sum) | (row_sum & (above_sum ^ below_sum))
+        carries = above_carry ^ below_carry ^ row_carry
+        twos_carry = (above_carry & below_carry) | (row_carry & (above_carry ^ below_carry))
+        twos = carries ^ ones_carry
+        fours_carry = carries & ones_carry
+        return ones, twos, fours_carry ^ twos_carry, fours_carry & twos_carry
+
+    def _next_row(self, above, row, below):
+        """ Returns the next iteration of a row, given the rows above and below it """
+        ones, twos, fours, eights = self._count_planes(above, row, below)
+        if self.rule.is_life:
+            # 2. Stasis: a living cell with two or three neighbours survives.
+            # 4. Reproduction: a dead cell with exactly three neighbours comes alive.
+            return twos & ~(fours | eights) & (ones | row)
+        planes = (ones, twos, fours, eights)
+        born = survives = 0
+        for count in self.rule.birth | self.rule.survival:
+            # the cells whose count is exactly count: every plane must match the count's bits
+            matches = -1
+            for bit, plane in enumerate(planes):
+                matches &= plane if count >> bit & 1 else ~plane
+            if count in self.rule.birth:
+                born |= matches
+            if count in self.rule.survival:
+                survives |= matches
+        return (born & ~row) | (survives & row)
+
+    def step(self):
+        """ Creates the next iteration of cells. Returns self """
+        rows = self.rows
+        if any(bitmask & 1 for bitmask in rows.values()):
+            # make room on the left for cells to come alive at bit -1
+            rows = {y_val: bitmask << self.MARGIN for y_val, bitmask in rows.items()}
+            self.x_offset -= self.MARGIN
+        next_rows = dict()
+        for y_val in {y_val + y_offset for y_val in rows for y_offset in (-1, 0, 1)}:
+            bitmask = self._next_row(rows.get(y_val - 1, 0), rows.get(y_val, 0), rows.get(y_val + 1, 0))
+            if bitmask:
+                next_rows[y_val] = bitmask
+        self.rows = next_rows
+        _lap("neighbour_count")
+        return self
+
+
+def _pick_storage(state, rule):
+    """ Helper for the auto engine. Converts between a cell dictionary and a DenseGrid when the density crosses
+    DENSE_THRESHOLD or SPARSE_THRESHOLD. Sticks to cell dictionaries if numpy is not installed, and to the DenseGrid
+    for Generations rules, as only it keeps their dying cells."""
+    if isinstance(state, DenseGrid):
+        if rule.states == 2 and state.density() < SPARSE_THRESHOLD:
+            return Board(state.to_cells())
+    elif np is not None and cell_density(state) > DENSE_THRESHOLD:
+        return DenseGrid.from_cells(state, rule)
+    return state
+
+
+class _Node:
+    """ A square of 2^level x 2^level cells in the HashLife quadtree. Level 0 nodes are single cells.
+    Nodes are canonical (see HashLife.join), so two nodes are the same object if and only if they hold the same cells,
+    which lets nodes be compared and hashed by identity."""
+    __slots__ = ("nw", "ne", "sw", "se", "level", "population", "results")
+
+    def __init__(self, nw, ne, sw, se, level, population):
+        self.nw, self.ne, self.sw, self.se = nw, ne, sw, se
+        self.level = level
+        self.population = population
+        self.results = None  # {j: centre of this node after 2^j iterations}, filled in by HashLife._successor
+
+
+class HashLife:
+    """ Runs GOL with Gosper's HashLife algorithm. The canvas is stored as a quadtree of canonical nodes, and the
+    centre of every node after 2^j iterations is memoized on the node, so repetitive patterns (pulsars, guns, gliders)
+    can be advanced millions of iterations in a few jumps.
+
+    The node cache is bounded with generational eviction: once it holds more than max_nodes nodes, everything that is
+    not part of the current canvas is dropped along with all memoized results.
+    Only runs radius 1 life-like rules, stepping the 4x4 leaf squares with the rule's block table.
+    """
+    DEFAULT_MAX_NODES = 1 << 20
+
+    def __init__(self, max_nodes=DEFAULT_MAX_NODES, rule=None):
+        """
+        :param max_nodes: number of nodes the cache can hold before it is collected
+        :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
+        """
+        self.rule = parse_rule(rule or LIFE_RULE)
+        if not self.rule.supports("hashlife"):
+            raise ValueError("The hashlife engine can not run rule %s" % self.rule)
+        self._block_table = self.rule.block_table
+        self.max_nodes = max_nodes
+        self._nodes = dict()  # {(nw, ne, sw, se): node}, the canonicalising node cache
+        self._empty_nodes = []  # the empty node of each level
+        self._off = _Node(None, None, None, None, 0, 0)
+        self._on = _Node(None, None, None, None, 0, 1)
+        self.node_hits = self.node_misses = 0
+        self.result_hits = self.result_misses = 0
+        self.collections = 0
+
+    def join(self, nw, ne, sw, se):
+        """ Returns the canonical node made up of the 4 given quadrants """
+        key = (nw, ne, sw, se)
+        node = self._nodes.get(key)
+        if node is not None:
+            self.node_hits += 1
+            return node
+        self.node_misses += 1
+        node = _Node(nw, ne, sw, se, nw.level + 1, nw.population + ne.population + sw.population + se.population)
+        self._nodes[key] = node
+        return node
+
+    def empty(self, level):
+        """ Returns the canonical node of the given level with no live cells """
+        while len(self._empty_nodes) <= level:
+            if not self._empty_nodes:
+                self._empty_nodes.append(self._off)
+            else:
+                child = self._empty_nodes[-1]
+                self._empty_nodes.append(self.join(child, child, child, child))
+        return self._empty_nodes[level]
+
+    def _centre(self, node):
+        """ Returns the centre half of a node, one level down, without advancing it """
+        return self.join(node.nw.se, node.ne.sw, node.sw.ne, node.se.nw)
+
+    def _expand(self, node):
+        """ Returns a node one level up with the given node in its centre """
+        border = self.empty(node.level - 1)
+        return self.join(self.join(border, border, border, node.nw),
+                         self.join(border, border, node.ne, border),
+                         self.join(border, node.sw, border, border),
+                         self.join(node.se, border, border, border))
+
+    def _base_step(self, node):
+        """ Returns the centre 2x2 of a 4x4 node after 1 iteration """
+        nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+        cells = (nw.nw, nw.ne, ne.nw, ne.ne,
+                 nw.sw, nw.se, ne.sw, ne.se,
+                 sw.nw, sw.ne, se.nw, se.ne,
+                 sw.sw, sw.se, se.sw, se.se)
+        block = 0
+        for bit, cell in enumerate(cells):
+            block |= cell.population << bit
+        centre = self._block_table[block]
+        return self.join(*[self._on if centre >> bit & 1 else self._off for bit in range(4)])
+
+    def _successor(self, node, j):
+        """ Returns the centre half of a node after 2^j iterations. j can be at most node.level - 2 """
+        if node.population == 0:
+            return self.empty(node.level - 1)
+        if node.results is None:
+            node.results = dict()
+        result = node.results.get(j)
+        if result is not None:
+            self.result_hits += 1
+            return result
+        self.result_misses += 1
+
+        if node.level == 2:
+            result = self._base_step(node)
+        else:
+            join = self.join
+            nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+            # the 9 overlapping quadrants of the node, each one level down
+            parts = (nw, join(nw.ne, ne.nw, nw.se, ne.sw), ne,
+                     join(nw.sw, nw.se, sw.nw, sw.ne), join(nw.se, ne.sw, sw.ne, se.nw), join(ne.sw, ne.se, se.nw, se.ne),
+                     sw, join(sw.ne, se.nw, sw.se, se.sw), se)
+            if j == node.level - 2:
+                # full speed: each half of the jump is done by a successor call
+                parts = [self._successor(part, j - 1) for part in parts]
+                inner_j = j - 1
+            else:
+                # slower than full speed: only the second half advances in time
+                parts = [self._centre(part) for part in parts]
+                inner_j = j
+            result = join(self._successor(join(parts[0], parts[1], parts[3], parts[4]), inner_j),
+                          self._successor(join(parts[1], parts[2], parts[4], parts[5]), inner_j),
+                          self._successor(join(parts[3], parts[4], parts[6], parts[7]), inner_j),
+                          self._successor(join(parts[4], parts[5], parts[7], parts[8]), inner_j))
+        node.results[j] = result
+        return result
+
+    def _build(self, points, level, y_origin, x_origin):
+        """ Builds the node of the given level whose top left corner is (y_origin, x_origin) from a list of (y, x) """
+        if not points:
+            return self.empty(level)
+        if level == 0:
+            return self._on
+        half = 1 << (level - 1)
+        quadrants = ([], [], [], [])
+        for y_val, x_val in points:
+            quadrants[(y_val >= y_origin + half) * 2 + (x_val >= x_origin + half)].append((y_val, x_val))
+        return self.join(self._build(quadrants[0], level - 1, y_origin, x_origin),
+                         self._build(quadrants[1], level - 1, y_origin, x_origin + half),
+                         self._build(quadrants[2], level - 1, y_origin + half, x_origin),
+                         self._build(quadrants[3], level - 1, y_origin + half, x_origin + half))
+
+    def _collect_cells(self, node, y_origin, x_origin, cells):
+        """ Adds the live cells of a node whose top left corner is (y_origin, x_origin) to a cell dictionary """
+        if node.population == 0:
+            return
+        if node.level == 0:
+            if y_origin not in cells:
+                cells[y_origin] = set()
+            cells[y_origin].add(x_origin)
+            return
+        half = 1 << (node.level - 1)
+        self._collect_cells(node.nw, y_origin, x_origin, cells)
+        self._collect_cells(node.ne, y_origin, x_origin + half, cells)
+        self._collect_cells(node.sw, y_origin + half, x_origin, cells)
+        self._collect_cells(node.se, y_origin + half, x_origin + half, cells)
+
+    def _collect_garbage(self, root):
+        """ Drops every node that is not part of root from the node cache, and forgets all memoized results """
+        self.collections += 1
+        for node in self._nodes.values():
+            node.results = None
+        self._nodes = dict()
+        self._empty_nodes = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.level == 0 or (node.nw, node.ne, node.sw, node.se) in self._nodes:
+                continue
+            self._nodes[(node.nw, node.ne, node.sw, node.se)] = node
+            stack.extend((node.nw, node.ne, node.sw, node.se))
+
+    def advance(self, cells, generations):
+        """ Advances a cell dictionary by the given number of iterations, jumping 2^k iterations at a time for every
+        bit k that is set in generations.
+
+        :param cells: dict containing the cell coordinates
+        :param generations: number of iterations to advance by
+        :return: dict
+        """
+        points = [(y_val, x_val) for y_val, row in cells.items() for x_val in row]
+        if not points or generations <= 0:
+            return {y_val: set(row) for y_val, row in cells.items() if row}
+        y_origin = min(y_val for y_val, _ in points)
+        x_origin = min(x_val for _, x_val in points)
+        size = max(max(y_val for y_val, _ in points) - y_origin, max(x_val for _, x_val in points) - x_origin) + 1
+        root = self._build(points, max(size - 1, 1).bit_length(), y_origin, x_origin)
+
+        j = 0
+        while generations >> j:
+            if generations >> j & 1:
+                # make sure the pattern stays inside the result's square during the jump
+                while root.level < j + 3 or self._centre(self._centre(root)).population != root.population:
+                    y_origin -= 1 << (root.level - 1)
+                    x_origin -= 1 << (root.level - 1)
+                    root = self._expand(root)
+                y_origin += 1 << (root.level - 2)
+                x_origin += 1 << (root.level - 2)
+                root = self._successor(root, j)
+                if len(self._nodes) > self.max_nodes:
+                    self._collect_garbage(root)
+            j += 1
+
+        next_cells = dict()
+        self._collect_cells(root, y_origin, x_origin, next_cells)
+        return next_cells
+
+    def stats(self):
+        """ Returns a dictionary of the node cache's size, hit rates and approximate memory use in bytes """
+        node_lookups = self.node_hits + self.node_misses
+        result_lookups = self.result_hits + self.result_misses
+        memory = getsizeof(self._nodes)
+        for key, node in self._nodes.items():
+            memory += getsizeof(key) + getsizeof(node) + (getsizeof(node.results) if node.results else 0)
+        return {
+            "nodes": len(self._nodes),
+            "max_nodes": self.max_nodes,
+            "node_hit_rate": self.node_hits / node_lookups if node_lookups else 0.0,
+            "result_hit_rate": self.result_hits / result_lookups if result_lookups else 0.0,
+            "node_hits": self.node_hits,
+            "node_misses": self.node_misses,
+            "result_hits": self.result_hits,
+            "result_misses": self.result_misses,
+            "collections": self.collections,
+            "memory_bytes": memory,
+        }
+
+
+def advance(cells, generations, hashlife=None, rule=None):
+    """ Advances a cell dictionary by the given number of iterations with HashLife.
+    Pass the same HashLife instance to reuse its node cache between calls.
+
+    :param cells: dict containing the cell coordinates
+    :param generations: number of iterations to advance by
+    :param hashlife: optional HashLife instance
+    :param rule: the Rule (or rule string) to apply when no HashLife instance is given. Defaults to B3/S23
+    :return: dict
+    """
+    return (hashlife or HashLife(rule=rule)).advance(cells, generations)
+
+
+HASH_MODULUS = 2 ** 61 - 1  # a Mersenne prime
+HASH_X_BASE = 0x1F3A5C7E9B2D4F61 % HASH_MODULUS
+HASH_Y_BASE = 0x5E8D2B7C1A9F3E47 % HASH_MODULUS
+# grids sum their x powers in numpy as two float64 halves of at most 31 bits, which add up exactly (below 2^53) for
+# rows of up to 2^22 cells
+HASH_LOW_BITS = 31
+
+
+class _Powers(dict):
+    """ Table of base^exponent modulo HASH_MODULUS, which fills itself in the first time an exponent is looked up, so a
+    cell's hash term costs a lookup instead of a modular pow. Negative exponents are the inverse powers """
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def __missing__(self, exponent):
+        power = self[exponent] = pow(self.base, exponent, HASH_MODULUS)
+        return power
+
+
+_X_POWERS = _Powers(HASH_X_BASE)
+_Y_POWERS = _Powers(HASH_Y_BASE)
+
+
+class CycleDetector:
+    """ Detects when the cells repeat themselves: still lifes, oscillators with period p, and spaceships that come back
+    to the same shape p iterations later, moved by some displacement.
+
+    Each iteration is hashed Zobrist style, as the sum of a term for every live cell (x_base^x * y_base^y modulo a
+    prime). The hash is kept up to date by adding and removing the terms of the cells that changed since the last
+    iteration, instead of hashing every live cell again. The powers come from tables that are filled in as they are
+    needed, and the x powers of a row's changed cells are summed before they are multiplied by the row's y power.
+    The grid engines are diffed as they are, the DenseGrid's array against a copy of the last one and the BitRowGrid's
+    rows against the last rows with XOR, without converting them to cells, and the changed cells are summed 8 at a time
+    from numpy tables of every byte's x powers. Dividing the hash by the term of the
+    bounding box's top left corner gives the same value wherever the shape is on the canvas, which is what lets
+    spaceships be detected.
+    Equal hashes only suggest a cycle, since two different iterations can collide, so a suggested cycle is confirmed by
+    comparing the cells themselves one period later. That keeps a single iteration in memory instead of max_period.
+    """
+
+    def __init__(self, max_period=1000):
+        """
+        :param max_period: longest period to look for. Only this many iterations of hashes are kept
+        """
+        self.max_period = max_period
+        self.period = None  # set once a cycle is found
+        self.displacement = None  # (y, x) that the cells move by every period
+        self.found_at = None  # the iteration at which the cycle was found
+        self._hash = 0
+        self._population = 0  # live cells, kept up to date from the diffs of the grids
+        self._previous = None  # (kind, ...) of the last iteration, to diff the next one against
+        self._x_table = None  # (first x, bytes, numpy arrays of the sums of every byte's x powers), for the grids
+        self._history = dict()  # {(normalised hash, population): (iteration, min_y, min_x)} of the latest iteration
+        self._history_order = deque()  # (key, iteration) of the last max_period iterations
+        self._candidate = None  # (iteration, cells, period, displacement) of a cycle suggested by the hashes
+
+    def update(self, state, generation):
+        """ Hashes an iteration of cells, and checks whether it has been seen before.
+        A cell dictionary must not be changed afterwards, as the next update compares against it. Grids can go on
+        stepping, as only their diffs are needed.
+
+        :param state: dict containing the cell coordinates, Board, DenseGrid (or ParallelGrid) or BitRowGrid
+        :param generation: the iteration that the cells are at
+        :return: bool, True if a cycle was found
+        """
+        # grids are only converted to cells to confirm a suggested cycle
+        if isinstance(state, DenseGrid):
+            population, min_y, min_x = self._update_dense(state)
+            cells_of = state.to_cells
+        elif isinstance(state, BitRowGrid):
+            population, min_y, min_x = self._update_bitwise(state)
+            cells_of = state.to_cells
+        else:
+            population, min_y, min_x = self._update_cells(state)
+            cells_of = lambda: state
+        self._hash %= HASH_MODULUS
+
+        key = (self._hash * _X_POWERS[-min_x] * _Y_POWERS[-min_y] % HASH_MODULUS, population)
+        if self._candidate is not None:
+            candidate_generation, candidate_cells, period, displacement = self._candidate
+            if generation >= candidate_generation + period:
+                self._candidate = None
+                if generation == candidate_generation + period and \
+                        self._same_cells(candidate_cells, cells_of(), displacement):
+                    self.period, self.displacement, self.found_at = period, displacement, generation
+                    return True
+        seen = self._history.get(key)
+        if seen is not None and self._candidate is None:
+            seen_generation, seen_y, seen_x = seen
+            self._candidate = (generation, cells_of(), generation - seen_generation, (min_y - seen_y, min_x - seen_x))
+        # the latest iteration with a hash is kept, so after a collision the next match is one period back again
+        self._history[key] = (generation, min_y, min_x)
+        self._history_order.append((key, generation))
+        if len(self._history_order) > self.max_period:
+            old_key, old_generation = self._history_order.popleft()
+            if self._history[old_key][0] == old_generation:
+                del self._history[old_key]
+        return False
+
+    def _update_cells(self, cells):
+        """ Helper for update. Adds the terms of a cell dictionary's changed cells to the hash, and returns its
+        (population, min y, min x) """
+        previous = self._previous[1] if self._previous is not None and self._previous[0] == "cells" else None
+        if previous is None:
+            self._hash = 0
+            previous = dict()
+        x_powers, y_powers = _X_POWERS, _Y_POWERS
+        for y_val in previous.keys() | cells.keys():
+            old_row, new_row = previous.get(y_val, ()), cells.get(y_val, ())
+            if old_row == new_row:
+                continue
+            old_row, new_row = set(old_row), set(new_row)
+            self._hash += y_powers[y_val] * (sum(map(x_powers.__getitem__, new_row - old_row)) -
+                                             sum(map(x_powers.__getitem__, old_row - new_row)))
+        self._previous = ("cells", cells)
+        box = _bounding_box(cells)
+        population = cells.population if isinstance(cells, Board) else sum(len(row) for row in cells.values())
+        return (population,) + (box[:2] if box is not None else (0, 0))
+
+    def _update_dense(self, grid):
+        """ Helper for update. Adds the terms of the cells that differ from the last DenseGrid to the hash, and
+        returns the grid's (population, min y, min x). The array only grows between iterations, so the last one is a
+        window of it """
+        alive = grid._alive()
+        previous = self._previous if self._previous is not None and self._previous[0] == "dense" else None
+        if previous is not None:
+            _, old_alive, old_y_offset, old_x_offset = previous
+            top, left = old_y_offset - grid.y_offset, old_x_offset - grid.x_offset
+            bottom, right = top + old_alive.shape[0], left + old_alive.shape[1]
+            if top < 0 or left < 0 or bottom > alive.shape[0] or right > alive.shape[1]:
+                previous = None
+            elif old_alive.shape != alive.shape:  # the array grew, so line the last one up with it
+                grown = np.zeros_like(alive)
+                grown[top:bottom, left:right] = old_alive
+                old_alive = grown
+        if previous is None:
+            self._hash = self._population = 0
+            old_alive = np.zeros_like(alive)
+        changed_rows = np.flatnonzero((alive != old_alive).any(axis=1))
+        new_rows, old_rows = alive[changed_rows], old_alive[changed_rows]
+        self._add_rows((changed_rows + grid.y_offset).tolist(),
+                       np.packbits(new_rows > old_rows, axis=1, bitorder="little"),
+                       np.packbits(old_rows > new_rows, axis=1, bitorder="little"), grid.x_offset)
+        self._previous = ("dense", alive.copy(), grid.y_offset, grid.x_offset)
+
+        rows, columns = np.flatnonzero(alive.any(axis=1)), np.flatnonzero(alive.any(axis=0))
+        if not len(rows):
+            return 0, 0, 0
+        return self._population, int(rows[0]) + grid.y_offset, int(columns[0]) + grid.x_offset
+
+    def _update_bitwise(self, grid):
+        """ Helper for update. Adds the terms of the cells that differ from the last BitRowGrid's rows to the hash,
+        and returns the grid's (population, min y, min x). x_offset only moves left, so the last rows are lined up
+        with the new ones by shifting them left """
+        rows, x_offset = grid.rows, grid.x_offset
+        previous = self._previous if self._previous is not None and self._previous[0] == "bitwise" else None
+        if previous is None or previous[2] < x_offset:
+            self._hash = self._population = 0
+            old_rows, shift = dict(), 0
+        else:
+            _, old_rows, old_x_offset = previous
+            shift = old_x_offset - x_offset
+        changes = []  # (y, born cells, dead cells) bitmasks of the rows that changed
+        for y_val in old_rows.keys() | rows.keys():
+            old, new = old_rows.get(y_val, 0) << shift, rows.get(y_val, 0)
+            if old != new:
+                changes.append((y_val, new & ~old, old & ~new))
+        self._previous = ("bitwise", rows, x_offset)
+        if np is not None and changes:
+            nbytes = (max((born | dead).bit_length() for _, born, dead in changes) + 7) // 8
+            born, dead = (np.frombuffer(b"".join(change[index].to_bytes(nbytes, "little") for change in changes),
+                                        dtype=np.uint8).reshape(len(changes), nbytes) for index in (1, 2))
+            self._add_rows([y_val for y_val, _, _ in changes], born, dead, x_offset)
+        else:
+            x_powers, y_powers = _X_POWERS, _Y_POWERS
+            for y_val, born, dead in changes:
+                row_sum = 0
+                self._population += bin(born).count("1") - bin(dead).count("1")
+                for bitmask, sign in ((born, 1), (dead, -1)):
+                    while bitmask:
+                        lowest_bit = bitmask & -bitmask
+                        row_sum += sign * x_powers[x_offset + lowest_bit.bit_length() - 1]
+                        bitmask ^= lowest_bit
+                self._hash += y_powers[y_val] * row_sum
+
+        if not rows:
+            return 0, 0, 0
+        min_x = min((bitmask & -bitmask).bit_length() for bitmask in rows.values()) - 1 + x_offset
+        return self._population, min(rows), min_x
+
+    def _add_rows(self, y_vals, born, dead, x_start):
+        """ Helper for the grids. Adds the terms of the cells that were born or died in the changed rows to the hash,
+        and their number to the population
+
+        :param y_vals: y coordinate of every row of born and dead
+        :param born: 2d numpy uint8 array of the rows' cells that were born, 8 cells a byte with the lowest bit first
+        :param dead: the same for the cells that died
+        :param x_start: x coordinate of the lowest bit of born[:, 0] and dead[:, 0]
+        """
+        if not y_vals:
+            return
+        nbytes = born.shape[1]
+        table_start, table_bytes, tables = self._x_table or (x_start, 0, None)
+        first, misaligned = divmod(x_start - table_start, 8)
+        if misaligned or first < 0 or first + nbytes > table_bytes:
+            # with room for as many bytes again on either side, so the grids growing (by whole bytes) or their rows
+            # getting longer does not rebuild it every iteration
+            first, table_bytes = nbytes, 3 * nbytes
+            table_start = x_start - 8 * first
+            powers = np.array([_X_POWERS[x_val] for x_val in range(table_start, table_start + 8 * table_bytes)],
+                              dtype=np.int64)
+            halves = np.stack([powers & ((1 << HASH_LOW_BITS) - 1), powers >> HASH_LOW_BITS, np.ones_like(powers)],
+                              axis=1).astype(np.float64).reshape(table_bytes, 8, 3)
+            bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder="little")
+            # [low halves, high halves, cells] of the byte at position p with value v, at index 256 * p + v
+            tables = [np.ascontiguousarray(table.ravel()) for table in
+                      np.moveaxis(bits.astype(np.float64) @ halves, 2, 0)]
+            self._x_table = (table_start, table_bytes, tables)
+        # looked up for every byte, and summed for every row
+        born, dead = (np.arange(256 * first, 256 * (first + nbytes), 256) + cells for cells in (born, dead))
+        low_sums, high_sums, counts = ((table.take(born).sum(axis=1) - table.take(dead).sum(axis=1))
+                                       .astype(np.int64).tolist() for table in tables)
+        y_powers = _Y_POWERS
+        self._hash += sum(y_powers[y_val] * ((high_sum << HASH_LOW_BITS) + low_sum)
+                          for y_val, low_sum, high_sum in zip(y_vals, low_sums, high_sums))
+        self._population += sum(counts)
+
+    @staticmethod
+    def _same_cells(cells, other, displacement):
+        """ Returns whether other holds exactly the live cells of cells, moved by displacement """
+        y_shift, x_shift = displacement
+        rows = {y_val: row for y_val, row in cells.items() if len(row)}
+        other_rows = {y_val: row for y_val, row in other.items() if len(row)}
+        return len(rows) == len(other_rows) and all(
+            sorted(x_val + x_shift for x_val in row) == sorted(other_rows.get(y_val + y_shift, ()))
+            for y_val, row in rows.items())
+
+    def report(self):
+        """ Returns a sentence describing the cycle that was found """
+        if self.period is None:
+            return "No cycle found"
+        if self.displacement != (0, 0):
+            kind = "Spaceship"
+        else:
+            kind = "Still life" if self.period == 1 else "Oscillator"
+        return "%s found at iteration %d: period %d, displacement (y=%d, x=%d) per period" % (
+            kind, self.found_at, self.period, self.displacement[0], self.displacement[1])
+
+
+def _extrapolate(state, engine, rule, hashlife, cycle_detector, generation, end_generation):
+    """ Helper for _run_frames. Jumps from a state that is in a cycle straight to the state at end_generation, by
+    stepping through the leftover part of a period and then moving the cells by the displacement of the skipped periods.
+    Returns a Board"""
+    periods, leftover = divmod(end_generation - generation, cycle_detector.period)
+    if engine == "hashlife":
+        state = Board(hashlife.advance(state, leftover))
+    else:
+        for _ in range(leftover):
+            state = state.step() if not isinstance(state, Board) else \
+                Board(step_rows(state, rule) if engine == "rows" else step_frontier(state, rule))
+    y_shift, x_shift = (periods * offset for offset in cycle_detector.displacement)
+    return Board({y_val + y_shift: [x_val + x_shift for x_val in row] for y_val, row in _as_cells(state).items()})
+
+
+class Renderer:
+    """ Draws frames of cells on its own thread, so the simulation never waits on the terminal.
+    At most fps frames are drawn per second. If the simulation submits frames faster than that, only the latest one is
+    drawn and the ones in between are dropped.
+    Only cells that changed since the last frame are rewritten, by moving the cursor to them, and each frame is written
+    to the terminal in one go.
+    """
+    LIVE_CHAR = u"\u25A0"
+
+    def __init__(self, fps=1, background_char=' '):
+        """
+        :param fps: maximum frames per second to draw
+        :param background_char: The character to use for the background
+        """
+        self.frame_budget = 1 / fps if fps else 0
+        self.background_char = background_char
+        self.frames_drawn = 0
+        self.frames_dropped = 0
+        self._drawn = dict()  # the cells currently on screen
+        self._view = None  # (min_y, min_x, max_y, max_x) of the canvas currently on screen
+        self._pending = None
+        self._last_frame_time = 0.0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="Renderer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wants_frame(self):
+        """ Returns whether a frame submitted now would be drawn, so the caller can skip building frames that would be
+        dropped anyway """
+        return self._pending is None and time.monotonic() - self._last_frame_time >= self.frame_budget
+
+    def submit(self, cells):
+        """ Hands a frame of cells to the renderer thread, replacing any frame that has not been drawn yet.
+        The cell dictionary must not be changed afterwards """
+        with self._condition:
+            if self._pending is not None:
+                self.frames_dropped += 1
+            self._pending = cells
+            self._condition.notify()
+
+    def draw(self, cells):
+        """ Draws a frame of cells right away, on the calling thread. Used by step mode """
+        with self._condition:
+            self._write(cells)
+
+    def stop(self):
+        """ Draws the last submitted frame, stops the renderer thread and moves the cursor below the canvas """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._pending is not None:
+            self._write(self._pending)
+            self._pending = None
+        if self._view is not None:
+            min_y, _, max_y, _ = self._view
+            sys.stdout.write(_cursor_escape(max_y - min_y + 2, 1))
+            sys.stdout.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                cells, self._pending = self._pending, None
+                self._write(cells)
+            # sleep out the rest of the frame budget, so frames submitted meanwhile are coalesced into the latest one
+            time.sleep(max(self._last_frame_time + self.frame_budget - time.monotonic(), 0))
+
+    def _write(self, cells):
+        """ Writes one frame to the terminal with a single write call """
+        self._last_frame_time = time.monotonic()
+        # the canvas on screen starts at 0, 0 unless cells have gone into negative coordinates
+        min_y, min_x, max_y, max_x = _bounding_box(cells) or (0, 0, -1, -1)
+        view = self._view or (0, 0, 0, 0)
+        if (self._view is None or min_y < view[0] or min_x < view[1]
+                or max_y + 1 > view[2] or max_x + 1 > view[3]):
+            # the canvas grew, so the whole screen is redrawn
+            view = self._view = (min(min_y, view[0]), min(min_x, view[1]), max(max_y + 1, view[2]),
+                                 max(max_x + 1, view[3]))
+            frame = [CLEAR_SCREEN, _cursor_escape(1, 1)]
+            for line_buffer in create_line_buffer(cells, view[2], view[3], view[0], view[1]):
+                frame.append(" ".join(self.LIVE_CHAR if cell == 1 else self.background_char for cell in line_buffer))
+                frame.append("\n")
+        else:
+            frame = []
+            for y_val in set(cells) | set(self._drawn):
+                row, drawn_row = cells.get(y_val, ()), self._drawn.get(y_val, ())
+                for x_val in set(row).symmetric_difference(drawn_row):
+                    frame.append(_cursor_escape(y_val - view[0] + 1, 2 * (x_val - view[1]) + 1))
+                    frame.append(self.LIVE_CHAR if x_val in row else self.background_char)
+        self._drawn = cells
+        self.frames_drawn += 1
+        sys.stdout.write("".join(frame))  # looked up on every write, as colorama.init() replaces sys.stdout
+        sys.stdout.flush()
+        if _phase_timer is not None:
+            _phase_timer.add("render", time.monotonic() - self._last_frame_time)
+
+
+def operate_on_each_row(cells, max_y, max_x, background_char=None, min_y=0, min_x=0, rule=None):
     """ Carries out the following operations on each row of cells:
-    1. Print out each row.
+    1. Print out each row, unless background_char is None.
     2. Create the next iteration's cell dictionary (same format as the original cell dictionary)
     3. Return the new iteration's dictionary that was created in 2.
 
     :param cells: dict containing the cell coordinates
     :param max_y: maximum y coordinate of the cells
     :param max_x: maximum x coordinate of the cells
-    :param background_char: The character to use for the background
+    :param background_char: The character to use for the background, or None to not print anything
+    :param min_y: minimum y coordinate of the cells
+    :param min_x: minimum x coordinate of the cells
+    :param rule: the Rule (or rule string) to apply. Defaults to B3/S23
     :return: dict
     """
-    y_val = 0  # the y-index to create a line buffer and print out
+    rule = parse_rule(rule or LIFE_RULE)
+    y_val = min_y  # the y-index to create a line buffer and print out
     next_iter_cells = dict()
-    for line_buffer in create_line_buffer(cells, max_y, max_x):
+    for line_buffer in create_line_buffer(cells, max_y, max_x, min_y, min_x):
+        _lap("line_buffer")
         # draw row to screen
-        print(*[u"\u25A0" if cell == 1 else background_char for cell in line_buffer])
+        if background_char is not None:
+            print(*[u"\u25A0" if cell == 1 else background_char for cell in line_buffer])
+            _lap("render")
         # generate next iteration of cells
-        cell_adjnum_pair = zip(line_buffer, count_adjacent_cells(cells, max_x, y_val))
-        new_cells_hor = create_next_cells(cell_adjnum_pair, max_x)
-        _update_next_iter_cells(next_iter_cells, new_cells_hor, y_val)
+        cell_adjnum_pair = zip(line_buffer, count_adjacent_cells(cells, max_x, y_val, min_x))
+        _lap("neighbour_count")
+        new_cells_hor = create_next_cells(cell_adjnum_pair, max_x, min_x, rule)
+        _lap("rule_application")
+        _update_next_iter_cells(next_iter_cells, new_cells_hor, y_val, min_x)
+        _lap("dict_update")
         y_val += 1
     return next_iter_cells
 
 
-def mainloop(cells, ntimes=1, step=True, fps=1, show_background=False):
-    """ Loops and prints the game's values ntimes number of iterations.
+def step_rows(cells, rule=None):
+    """ Creates the next iteration's cell dictionary by visiting the whole canvas row by row, without printing
+
+    :param cells: dict containing the cell coordinates
+    :param rule: the Rule (or rule string) to apply. Defaults to B3/S23. Only radius 1 life-like rules are supported
+    :return: dict
+    """
+    rule = parse_rule(rule or LIFE_RULE)
+    if not rule.supports("rows"):
+        raise ValueError("The rows engine can not run rule %s" % rule)
+    box = _bounding_box(cells)
+    if box is None:
+        return dict()
+    min_y, min_x, max_y, max_x = box
+    # the cells just outside the bounding box can come alive too
+    return operate_on_each_row(cells, max_y + 1, max_x + 1, min_y=min_y - 1, min_x=min_x - 1, rule=rule)
+
+
+def mainloop(cells, ntimes=1, step=True, fps=1, show_background=False, engine="auto", generations_per_frame=1,
+             workers=None, headless=False, unthrottled=False, checkpoint_path=None, checkpoint_every=0,
+             start_generation=0, profile_path=None, on_cycle=None, cycle_detector=None, rule=None):
+    """ Loops and prints the game's values ntimes number of frames.
+    Frames are drawn by a Renderer on its own thread, so drawing never holds up the simulation.
 
     :param cells: dict containing the cell coordinates
     Format is:
@@ -228,24 +1994,139 @@ def mainloop(cells, ntimes=1, step=True, fps=1, show_background=False):
     :param step: step mode or auto mode
     :param fps: frames(iterations per second to render)
     :param show_background: whether to print out something for the background or leave it as empty
-    :return: None
+    :param engine: "frontier" only visits live cells and their neighbours, "dense" steps a numpy array of the whole
+    canvas, "auto" switches between frontier and dense depending on the density of the cells, "parallel" steps
+    bands of a numpy array on worker processes, "bitwise" steps whole rows at once as int bitmasks, "hashlife" jumps
+    through iterations with a memoized quadtree, and "rows" visits the whole canvas row by row
+    :param generations_per_frame: number of iterations to advance by between frames
+    :param workers: number of worker processes for the parallel engine. Defaults to the number of CPUs
+    :param headless: compute-only mode. Nothing is drawn and the simulation runs as fast as it can
+    :param unthrottled: run the simulation as fast as it can instead of at fps frames per second. The renderer still
+    draws at most fps frames per second, dropping the frames in between
+    :param checkpoint_path: file to save a checkpoint to (see save_checkpoint) every checkpoint_every iterations and at
+    the end of the run
+    :param checkpoint_every: number of iterations between checkpoints. 0 only saves at the end of the run
+    :param start_generation: the iteration that cells are at, eg. when resuming from a checkpoint
+    :param profile_path: file to write per-phase timings of every iteration to as JSON (see PhaseTimer)
+    :param on_cycle: what to do once the cells repeat themselves (see CycleDetector): "report" keeps going, "stop"
+    stops at the iteration the cycle was found at, and "extrapolate" jumps straight to the final iteration.
+    None does not look for cycles. The hashlife engine only checks once per frame, so with generations_per_frame > 1
+    the period it finds is a multiple of generations_per_frame
+    :param cycle_detector: optional CycleDetector to use, eg. to read the period and displacement after the run
+    :param rule: the Rule or rule string to run (see parse_rule). Defaults to B3/S23. Generations rules only run on
+    the dense and auto engines, Larger than Life rules on the frontier, dense and auto engines
+    :return: dict of the final iteration's cells
     """
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine %r, pick one of %s" % (engine, ", ".join(ENGINES)))
+    rule = parse_rule(rule or LIFE_RULE)
+    if not rule.supports(engine):
+        raise ValueError("The %s engine can not run rule %s" % (engine, rule))
+    if on_cycle is not None and rule.states > 2:
+        raise ValueError("Cycles can not be detected for Generations rules, as their dying cells are not hashed")
+    if on_cycle is not None and on_cycle not in ON_CYCLE_ACTIONS:
+        raise ValueError("Unknown on_cycle %r, pick one of %s" % (on_cycle, ", ".join(ON_CYCLE_ACTIONS)))
+    if on_cycle is not None and cycle_detector is None:
+        cycle_detector = CycleDetector()
     background_char = ' '
     if show_background:
         background_char = u'\u00B7'  # Block character found in both DOS and Unix
+    phase_timer = enable_profiling() if profile_path else None
+    renderer = None if headless else Renderer(fps, background_char).start()
+    state = Board(cells)  # either a Board, or a grid (DenseGrid, ParallelGrid or BitRowGrid)
+    if engine == "dense" or rule.states > 2:
+        state = DenseGrid.from_cells(cells, rule)
+    elif engine == "bitwise":
+        state = BitRowGrid.from_cells(cells, rule)
+    elif engine == "parallel":
+        state = ParallelGrid.from_cells(cells, workers, rule)
+    try:
+        return _run_frames(state, ntimes, step, 0 if headless or unthrottled else fps, renderer, engine,
+                           generations_per_frame, checkpoint_path, checkpoint_every, start_generation, on_cycle,
+                           cycle_detector, rule)
+    finally:
+        if renderer is not None:
+            renderer.stop()
+        if isinstance(state, ParallelGrid):
+            state.close()
+        if phase_timer is not None:
+            disable_profiling()
+            with open(profile_path, "w") as file:
+                file.write(phase_timer.to_json())
+
+
+def _as_cells(state):
+    """ Helper that returns the cells of either a Board or a grid as a cell dictionary (or Board) """
+    return state if isinstance(state, Board) else state.to_cells()
+
+
+def _run_frames(state, ntimes, step, fps, renderer, engine, generations_per_frame, checkpoint_path, checkpoint_every,
+                generation, on_cycle, cycle_detector, rule):
+    """ Helper for mainloop function. Steps the cells ntimes number of frames, handing them to the renderer (if any)
+    before each frame. Paces the frames to fps frames per second unless fps is 0. Returns the final cells"""
+    hashlife = HashLife(rule=rule) if engine == "hashlife" else None
+    end_generation = generation + ntimes * generations_per_frame
+    next_frame_time = time.monotonic()
+    if cycle_detector is not None:
+        cycle_detector.update(state, generation)
     for _ in range(0, ntimes):
-        start_time = time.time()  # used to time each frame/iteration
-        _reset_screen()
-        max_x = max(cells[max(cells, key=lambda key_y: max(cells[key_y]))]) + 1
-        max_y = max(cells, key=lambda key_y: key_y) + 1
-        cells = operate_on_each_row(cells, max_y, max_x, background_char).copy()
-        gc.collect()
-        end_time = time.time()  # used to time each frame/iteration
-        if (end_time - start_time) < 1/fps:
-            time.sleep(1/fps - (end_time - start_time))
+        if engine == "auto":
+            state = _pick_storage(state, rule)
+        if renderer is not None:
+            if step:
+                renderer.draw(_as_cells(state))
+            elif renderer.wants_frame():
+                renderer.submit(_as_cells(state))
+        frame_start_generation = generation
+        found_cycle = False
+        if engine == "hashlife":
+            if _phase_timer is not None:
+                _phase_timer.start_generation(generation)
+            state = hashlife.advance(state, generations_per_frame)
+            _lap("neighbour_count")
+            state = Board(state)
+            _lap("dict_update")
+            if _phase_timer is not None:
+                _phase_timer.end_generation()
+            generation += generations_per_frame
+            if cycle_detector is not None and cycle_detector.period is None:
+                found_cycle = cycle_detector.update(state, generation)
+        else:
+            for _ in range(generations_per_frame):
+                if _phase_timer is not None:
+                    _phase_timer.start_generation(generation)
+                if not isinstance(state, Board):
+                    state = state.step()
+                else:
+                    state = Board(step_rows(state, rule) if engine == "rows" else step_frontier(state, rule))
+                    _lap("dict_update")
+                if _phase_timer is not None:
+                    _phase_timer.end_generation()
+                generation += 1
+                if cycle_detector is not None and cycle_detector.period is None:
+                    found_cycle = cycle_detector.update(state, generation)
+                    if found_cycle and on_cycle in ("stop", "extrapolate"):
+                        break
+        if found_cycle and on_cycle in ("stop", "extrapolate"):
+            if on_cycle == "extrapolate":
+                state = _extrapolate(state, engine, rule, hashlife, cycle_detector, generation, end_generation)
+                generation = end_generation
+            break
+        if checkpoint_path and checkpoint_every and \
+                generation // checkpoint_every > frame_start_generation // checkpoint_every:
+            save_checkpoint(checkpoint_path, _as_cells(state), generation)
+        if fps:
+            next_frame_time += 1 / fps
+            time.sleep(max(next_frame_time - time.monotonic(), 0))
         if step:
             if not _step_iterations():
                 step = False
+    cells = _as_cells(state)
+    if checkpoint_path:
+        save_checkpoint(checkpoint_path, cells, generation)
+    if renderer is not None:
+        renderer.submit(cells)
+    return cells.to_cells() if isinstance(cells, Board) else cells
 
 
 def create_predefined_structure(structure_name, y_start, x_start):
@@ -290,6 +2171,267 @@ def merge_dicts(dict1, dict2):
     return dict3
 
 
+RLE_TOKEN = re.compile(r"(\d*)([^\d\s])")
+CHECKPOINT_MAGIC = b"GOLSNAP1"
+CHECKPOINT_HEADER = struct.Struct("<8sqqq")  # magic, generation, population, number of rows
+CHECKPOINT_ROW = struct.Struct("<qq")  # y, number of cells in the row, followed by that many 64 bit x coordinates
+
+
+def read_rle(file, y_start=0, x_start=0):
+    """ Reads a pattern in the RLE format (https://conwaylife.com/wiki/Run_Length_Encoded) into a Board.
+    The file is read line by line, and each row of cells goes straight into the Board once it is complete, so large
+    patterns never need to be held in memory as one string.
+
+    :param file: an open text file (or any iterable of lines)
+    :param y_start: y position of the top left corner of the pattern
+    :param x_start: x position of the top left corner of the pattern
+    :return: Board
+    """
+    board = Board()
+    y_val, x_val = y_start, x_start
+    row_xs = []
+    in_body = False
+    pending_count = ""  # digits of a run count that were split across two lines
+    for line in file:
+        # blank lines, comments and the "x = m, y = n, rule = abc" header come before the pattern
+        if not in_body and (not line.strip() or line.lstrip()[:1] in ("#", "x")):
+            continue
+        in_body = True
+        tokens = RLE_TOKEN.finditer(line)
+        for match in tokens:
+            count, tag = match.groups()
+            count = int(pending_count + count or 1)
+            pending_count = ""
+            if tag in "b.":  # dead cells
+                x_val += count
+            elif tag == "$":  # end of row(s)
+                board.set_row(y_val, row_xs)
+                row_xs = []
+                y_val += count
+                x_val = x_start
+            elif tag == "!":  # end of pattern
+                board.set_row(y_val, row_xs)
+                return board
+            else:  # "o", or any other state of a multi-state pattern, is a live cell
+                row_xs.extend(range(x_val, x_val + count))
+                x_val += count
+        trailing_digits = line.rstrip()[len(line.rstrip().rstrip("0123456789")):]
+        pending_count += trailing_digits
+    board.set_row(y_val, row_xs)
+    return board
+
+
+def write_rle(cells, file, rule=LIFE_RULE):
+    """ Writes the cells to a file in the RLE format, with lines of at most 70 characters.
+    The top left corner of the cells' bounding box becomes the top left corner of the pattern.
+
+    :param cells: dict containing the cell coordinates
+    :param file: an open text file
+    :param rule: the rule to put in the header
+    :return: None
+    """
+    box = _bounding_box(cells) or (0, 0, -1, -1)
+    min_y, min_x, max_y, max_x = box
+    file.write("x = %d, y = %d, rule = %s\n" % (max_x - min_x + 1, max_y - min_y + 1, rule))
+    line = []
+    line_length = 0
+
+    def write_token(count, tag):
+        nonlocal line_length
+        token = tag if count == 1 else "%d%s" % (count, tag)
+        if line_length + len(token) > 70:
+            file.write("".join(line) + "\n")
+            line.clear()
+            line_length = 0
+        line.append(token)
+        line_length += len(token)
+
+    previous_y = min_y
+    for y_val in sorted(y_val for y_val, row in cells.items() if row):
+        if y_val > previous_y:
+            write_token(y_val - previous_y, "$")
+        previous_y = y_val
+        x_val = min_x
+        run_start = None
+        for live_x in sorted(cells[y_val]):
+            if run_start is not None and live_x == x_val:  # the run of live cells continues
+                x_val += 1
+                continue
+            if run_start is not None:
+                write_token(x_val - run_start, "o")
+            if live_x > x_val:
+                write_token(live_x - x_val, "b")
+            run_start, x_val = live_x, live_x + 1
+        if run_start is not None:
+            write_token(x_val - run_start, "o")
+    write_token(1, "!")
+    file.write("".join(line) + "\n")
+
+
+def read_plaintext(file, y_start=0, x_start=0):
+    """ Reads a pattern in the plaintext (.cells) format into a Board. Lines starting with ! are comments, and O or *
+    is a live cell.
+
+    :param file: an open text file (or any iterable of lines)
+    :param y_start: y position of the top left corner of the pattern
+    :param x_start: x position of the top left corner of the pattern
+    :return: Board
+    """
+    board = Board()
+    y_val = y_start
+    for line in file:
+        if line.startswith("!"):
+            continue
+        board.set_row(y_val, [x_start + x_index for x_index, char in enumerate(line) if char in "O*"])
+        y_val += 1
+    return board
+
+
+def write_plaintext(cells, file):
+    """ Writes the cells to a file in the plaintext (.cells) format.
+
+    :param cells: dict containing the cell coordinates
+    :param file: an open text file
+    :return: None
+    """
+    box = _bounding_box(cells)
+    if box is None:
+        return
+    min_y, min_x, max_y, max_x = box
+    for line_buffer in create_line_buffer(cells, max_y, max_x, min_y, min_x):
+        file.write("".join("O" if cell == 1 else "." for cell in line_buffer).rstrip(".") + "\n")
+
+
+def read_life106(file, y_start=0, x_start=0):
+    """ Reads a pattern in the Life 1.06 format (a "#Life 1.06" header, then one "x y" pair per line) into a Board.
+
+    :param file: an open text file (or any iterable of lines)
+    :param y_start: offset added to every y coordinate
+    :param x_start: offset added to every x coordinate
+    :return: Board
+    """
+    rows = defaultdict(list)
+    for line in file:
+        if line.startswith("#") or not line.strip():
+            continue
+        x_val, y_val = line.split()
+        rows[y_start + int(y_val)].append(x_start + int(x_val))
+    return Board(rows)
+
+
+def write_life106(cells, file):
+    """ Writes the cells to a file in the Life 1.06 format.
+
+    :param cells: dict containing the cell coordinates
+    :param file: an open text file
+    :return: None
+    """
+    file.write("#Life 1.06\n")
+    for y_val, row in cells.items():
+        for x_val in row:
+            file.write("%d %d\n" % (x_val, y_val))
+
+
+PATTERN_FORMATS = {
+    ".rle": (read_rle, write_rle),
+    ".cells": (read_plaintext, write_plaintext),
+    ".txt": (read_plaintext, write_plaintext),
+    ".lif": (read_life106, write_life106),
+    ".life": (read_life106, write_life106),
+}
+
+
+def _pattern_format(path):
+    """ Helper that returns the (reader, writer) for a pattern file, going by its extension """
+    pattern_format = PATTERN_FORMATS.get(os.path.splitext(path)[1].lower())
+    if pattern_format is None:
+        raise ValueError("Unknown pattern format for %s, use one of %s" % (path, ", ".join(PATTERN_FORMATS)))
+    return pattern_format
+
+
+def load_pattern(path, y_start=0, x_start=0):
+    """ Loads a pattern file into a Board. The format (RLE, plaintext or Life 1.06) is picked by the file extension.
+
+    :param path: path of the pattern file
+    :param y_start: y position of the top left corner of the pattern
+    :param x_start: x position of the top left corner of the pattern
+    :return: Board
+    """
+    reader, _ = _pattern_format(path)
+    with open(path) as file:
+        return reader(file, y_start, x_start)
+
+
+def save_pattern(cells, path, rule=LIFE_RULE):
+    """ Saves the cells to a pattern file. The format (RLE, plaintext or Life 1.06) is picked by the file extension.
+
+    :param cells: dict containing the cell coordinates
+    :param path: path of the pattern file
+    :param rule: the rule to put in the header of RLE files
+    :return: None
+    """
+    _, writer = _pattern_format(path)
+    with open(path, "w") as file:
+        if writer is write_rle:
+            writer(cells, file, str(rule))
+        else:
+            writer(cells, file)
+
+
+def save_checkpoint(path, cells, generation):
+    """ Saves a binary snapshot of the cells, so a long run can be resumed with load_checkpoint.
+    Each row is stored as its y coordinate and length followed by its sorted 64 bit x coordinates, so rows can be
+    loaded straight into a Board. The snapshot is written to a temporary file first and then moved over path, so a
+    crash while saving never leaves a broken checkpoint behind.
+
+    :param path: path of the checkpoint file
+    :param cells: dict containing the cell coordinates
+    :param generation: the iteration that the cells are at
+    :return: None
+    """
+    board = cells if isinstance(cells, Board) else Board(cells)
+    with open(path + ".tmp", "wb") as file:
+        file.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, generation, board.population, len(board)))
+        for y_val, row in board.items():
+            file.write(CHECKPOINT_ROW.pack(y_val, len(row)))
+            if sys.byteorder == "big":
+                row = Row(row)
+                row.byteswap()
+            file.write(row.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    """ Loads a snapshot saved by save_checkpoint. The file is memory mapped, and each row is copied straight from the
+    mapping into the Board without being parsed.
+
+    :param path: path of the checkpoint file
+    :return: tuple of (Board, generation)
+    """
+    board = Board()
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        snapshot = memoryview(mapping)
+        try:
+            magic, generation, _, row_count = CHECKPOINT_HEADER.unpack_from(snapshot)
+            if magic != CHECKPOINT_MAGIC:
+                raise ValueError("%s is not a checkpoint file" % path)
+            offset = CHECKPOINT_HEADER.size
+            for _ in range(row_count):
+                y_val, length = CHECKPOINT_ROW.unpack_from(snapshot, offset)
+                offset += CHECKPOINT_ROW.size
+                row = Row()
+                row.frombytes(snapshot[offset:offset + length * row.itemsize])
+                if sys.byteorder == "big":
+                    row.byteswap()
+                offset += length * row.itemsize
+                board.set_row(y_val, row)
+        finally:
+            snapshot.release()
+    return board, generation
+
+
 def main():
     colorama.init()
     """
@@ -305,19 +2447,101 @@ def main():
     cells = merge_dicts(cells, create_predefined_structure("pulsar", 3, 3))
     cells = merge_dicts(cells, create_predefined_structure("pulsar", 20, 20))
     cells = merge_dicts(cells, create_predefined_structure("glider", 20, 40))
-    if len(argv) != 5:
-        exit("Usage: python ConwayGOL.py [number of iterations <int>] [step? <bool>] [FPS <int>] [show background? <bool>]"
-             "\n Eg. python ./conwayGOL.py 50 f 8 f")
+    args, options = _split_options(argv[1:])
+    if len(args) != 4:
+        exit(USAGE + "\n Eg. python ./conwayGOL.py 50 f 8 f --engine auto")
     else:
-        ntimes = _respond_to_args(1, int, is_positive=True)
-        step = _respond_to_args(2, bool)
-        fps = _respond_to_args(3, float, is_positive=True)
-        show_background = _respond_to_args(4, bool)
+        ntimes = _respond_to_args(args[0], int, is_positive=True)
+        step = _respond_to_args(args[1], bool)
+        fps = _respond_to_args(args[2], float, is_positive=True)
+        show_background = _respond_to_args(args[3], bool)
+        if set(options) - set(OPTIONS):
+            exit("Unknown option(s) %s\n" % ", ".join(set(options) - set(OPTIONS)) + USAGE)
+        engine = options.get("engine", "auto")
+        if engine not in ENGINES:
+            exit("Invalid engine\n" + USAGE)
+        if engine in ("dense", "parallel") and np is None:
+            exit("numpy is required for the %s engine. pip install it." % engine)
+        jump = _respond_to_args(options.get("jump", "1"), int, is_positive=True)
+        if jump < 1:
+            exit("Invalid jump\n" + USAGE)
+        workers = None
+        if "workers" in options:
+            workers = _respond_to_args(options["workers"], int, is_positive=True)
+            if workers < 1 or engine != "parallel":
+                exit("Invalid workers. --workers needs at least 1 worker and --engine parallel\n" + USAGE)
+
+        headless = _respond_to_args(options.get("headless", "f"), bool)
+        unthrottled = _respond_to_args(options.get("unthrottled", "f"), bool)
+        checkpoint_path = options.get("checkpoint")
+        checkpoint_every = _respond_to_args(options.get("checkpoint-every", "0"), int, is_positive=True)
+        resume = _respond_to_args(options.get("resume", "f"), bool)
+        on_cycle = options.get("on-cycle")
+        if on_cycle is not None and on_cycle not in ON_CYCLE_ACTIONS:
+            exit("Invalid on-cycle\n" + USAGE)
+        cycle_detector = CycleDetector() if on_cycle else None
+        try:
+            rule = parse_rule(options.get("rule", LIFE_RULE))
+        except ValueError as e:
+            exit("Invalid rule: %s\n" % e + USAGE)
+        if not rule.supports(engine):
+            exit("The %s engine can not run rule %s\n" % (engine, rule) + USAGE)
+        if rule.states > 2 and np is None:
+            exit("numpy is required for Generations rules. pip install it.")
+        if rule.states > 2 and on_cycle:
+            exit("--on-cycle can not be used with Generations rules\n" + USAGE)
+        generation = 0
+        try:
+            if "load" in options:
+                cells = load_pattern(options["load"])
+            if resume:
+                if not checkpoint_path:
+                    exit("--resume needs a --checkpoint file\n" + USAGE)
+                if os.path.exists(checkpoint_path):
+                    cells, generation = load_checkpoint(checkpoint_path)
+                    ntimes = max(ntimes - generation // jump, 0)  # only run the frames that are left
+                    print("Resuming from iteration %d" % generation)
+            if "save" in options:
+                _pattern_format(options["save"])  # complain about a bad extension before the run, not after it
+        except (OSError, ValueError) as e:
+            exit("Invalid pattern file: %s" % e)
 
-        mainloop(cells, ntimes=ntimes, step=step, fps=fps, show_background=show_background)
+        cells = mainloop(cells, ntimes=ntimes, step=step, fps=fps, show_background=show_background, engine=engine,
+                         generations_per_frame=jump, workers=workers, headless=headless, unthrottled=unthrottled,
+                         checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every,
+                         start_generation=generation, profile_path=options.get("profile"), on_cycle=on_cycle,
+                         cycle_detector=cycle_detector, rule=rule)
+        if "save" in options:
+            save_pattern(cells, options["save"], rule)
+        if cycle_detector is not None:
+            print(cycle_detector.report())
         print("End")
 
 
+def test_pattern_io():
+    """ Checks that patterns survive a round trip through every pattern format, including an RLE file with blank
+    lines before its header. Run with python -c "import ConwayGOL; ConwayGOL.test_pattern_io()" """
+    glider = create_predefined_structure("glider", -1, -2)
+    expected = {y_val: sorted(row) for y_val, row in glider.items() if row}
+
+    def cells_of(board):
+        return {y_val: sorted(row) for y_val, row in board.items() if row}
+
+    rle = io.StringIO()
+    write_rle(glider, rle)
+    assert cells_of(read_rle(io.StringIO(rle.getvalue()), -1, -2)) == expected
+    for prefix in ("\n", "  \n#C a comment\n\n", "#N glider\n\t\n"):
+        assert cells_of(read_rle(io.StringIO(prefix + rle.getvalue()), -1, -2)) == expected, repr(prefix)
+    assert cells_of(read_rle(io.StringIO("\nx = 3, y = 3, rule = B3/S23\nbo$2bo$3o!"))) == \
+        {0: [1], 1: [2], 2: [0, 1, 2]}
+    plaintext = io.StringIO()
+    write_plaintext(glider, plaintext)
+    assert cells_of(read_plaintext(io.StringIO(plaintext.getvalue()), -1, -2)) == expected
+    life106 = io.StringIO()
+    write_life106(glider, life106)
+    assert cells_of(read_life106(io.StringIO(life106.getvalue()))) == expected
+
+
 if __name__ == "__main__":
     main()
 
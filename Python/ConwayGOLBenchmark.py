@@ -0,0 +1,192 @@
+"""
+Benchmarks for the Conway's Game of Life engines in ConwayGOL.py.
+
+Runs a set of standard workloads (a field of pulsars, a swarm of gliders, and random soups at several densities and
+sizes) against every engine in headless mode, and reports for each run:
+- generations/sec and cells/sec (average live cells of the first and last iteration, times generations/sec)
+- peak RSS of the process that ran it (each run gets a fresh process, so runs do not inflate each other's numbers)
+- memory blocks still allocated after the run, and the peak memory traced by tracemalloc, from a second, shorter run
+  (tracemalloc slows everything down, so it is kept out of the timed run)
+- with --cycle-detector, how much slower the run gets with the CycleDetector hashing every iteration (on_cycle
+  "report"), from a third timed run
+
+Usage:
+python ConwayGOLBenchmark.py [--engines frontier,dense] [--generations 20] [--sizes 64,256] [--densities 0.1,0.3]
+                             [--json results.json] [--phases <directory for per-phase JSON of every run>]
+                             [--cycle-detector]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on windows
+
+import ConwayGOL
+
+
+def pulsar_field(count):
+    """ Returns a count x count field of pulsars, spaced so they do not touch """
+    cells = dict()
+    for y_index in range(count):
+        for x_index in range(count):
+            cells = ConwayGOL.merge_dicts(cells, ConwayGOL.create_predefined_structure("pulsar", y_index * 16,
+                                                                                    x_index * 16))
+    return cells
+
+
+def glider_swarm(count, seed=0):
+    """ Returns count gliders scattered at random over a canvas that grows with the number of gliders """
+    generator = random.Random(seed)
+    spread = int(count ** 0.5) * 12
+    cells = dict()
+    for _ in range(count):
+        glider = ConwayGOL.create_predefined_structure("glider", generator.randrange(spread), generator.randrange(spread))
+        cells = ConwayGOL.merge_dicts(cells, glider)
+    return cells
+
+
+def random_soup(size, density, seed=0):
+    """ Returns a size x size square where each cell is alive with the given probability """
+    generator = random.Random(seed)
+    cells = dict()
+    for y_val in range(size):
+        row = {x_val for x_val in range(size) if generator.random() < density}
+        if row:
+            cells[y_val] = row
+    return cells
+
+
+def workloads(sizes, densities):
+    """ Returns a list of (name, function, args) for every standard workload """
+    standard = [("pulsar-field-8x8", pulsar_field, (8,)), ("glider-swarm-200", glider_swarm, (200,))]
+    for size in sizes:
+        for density in densities:
+            standard.append(("soup-%d-%.2f" % (size, density), random_soup, (size, density)))
+    return standard
+
+
+def _population(cells):
+    return sum(len(row) for row in cells.values())
+
+
+def _peak_rss():
+    """ Returns the peak resident set size of this process in bytes, or None if it can not be measured """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # linux reports kilobytes, macOS reports bytes
+
+
+def run_benchmark(workload, engine, generations, phases_path=None, cycle_detector=False):
+    """ Runs one workload with one engine in headless mode. Meant to be run in a fresh process.
+
+    :param workload: (name, function, args) of the workload, as returned by workloads()
+    :param engine: name of the engine, one of ConwayGOL.ENGINES
+    :param generations: number of iterations to run
+    :param phases_path: optional file to write the per-phase timings of every iteration to
+    :param cycle_detector: also time the run with cycle detection on, and report the detector's overhead
+    :return: dict of results
+    """
+    name, function, args = workload
+    cells = function(*args)
+    start_population = _population(cells)
+
+    start_time = time.perf_counter()
+    final_cells = ConwayGOL.mainloop(cells, ntimes=1, step=False, engine=engine, generations_per_frame=generations,
+                                     headless=True, profile_path=phases_path)
+    seconds = time.perf_counter() - start_time
+    peak_rss = _peak_rss()
+
+    # a second, shorter run under tracemalloc for the allocation numbers
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    ConwayGOL.mainloop(cells, ntimes=1, step=False, engine=engine, generations_per_frame=max(generations // 10, 1),
+                       headless=True)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated_blocks = sys.getallocatedblocks() - blocks_before
+
+    average_population = (start_population + _population(final_cells)) / 2
+    result = {
+        "workload": name,
+        "engine": engine,
+        "generations": generations,
+        "seconds": seconds,
+        "generations_per_sec": generations / seconds if seconds else float("inf"),
+        "cells_per_sec": average_population * generations / seconds if seconds else float("inf"),
+        "peak_rss_bytes": peak_rss,
+        "allocated_blocks": allocated_blocks,
+        "peak_traced_bytes": peak_traced,
+    }
+    if cycle_detector:
+        # a cycle is only reported, so both runs step through every generation
+        start_time = time.perf_counter()
+        ConwayGOL.mainloop(cells, ntimes=1, step=False, engine=engine, generations_per_frame=generations,
+                           headless=True, on_cycle="report")
+        result["cycle_detector_seconds"] = time.perf_counter() - start_time
+        result["cycle_detector_overhead"] = result["cycle_detector_seconds"] / seconds - 1 if seconds else 0.0
+    return result
+
+
+def _print_result(result):
+    rss = "%.1f" % (result["peak_rss_bytes"] / 2 ** 20) if result["peak_rss_bytes"] is not None else "n/a"
+    overhead = " %+9.0f%%" % (result["cycle_detector_overhead"] * 100) if "cycle_detector_overhead" in result else ""
+    print("%-20s %-9s %12.1f %14.0f %10s %12d %12.1f%s" % (
+        result["workload"], result["engine"], result["generations_per_sec"], result["cells_per_sec"], rss,
+        result["allocated_blocks"], result["peak_traced_bytes"] / 1024, overhead))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the ConwayGOL engines in headless mode")
+    available = [engine for engine in ConwayGOL.ENGINES
+                 if ConwayGOL.np is not None or engine not in ("dense", "parallel")]
+    parser.add_argument("--engines", default=",".join(available),
+                        help="comma separated engines to benchmark (default: %(default)s)")
+    parser.add_argument("--generations", type=int, default=20, help="iterations per run (default: %(default)s)")
+    parser.add_argument("--sizes", default="64,256", help="comma separated random soup sizes (default: %(default)s)")
+    parser.add_argument("--densities", default="0.1,0.3,0.5",
+                        help="comma separated random soup densities (default: %(default)s)")
+    parser.add_argument("--json", help="file to write all results to as JSON")
+    parser.add_argument("--phases", help="directory to write the per-phase timings of every run to as JSON")
+    parser.add_argument("--cycle-detector", action="store_true",
+                        help="also time every run with cycle detection on, and print how much slower it is")
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    for engine in engines:
+        if engine not in available:
+            parser.error("unknown or unavailable engine %s, pick from %s" % (engine, ", ".join(available)))
+    if args.phases:
+        os.makedirs(args.phases, exist_ok=True)
+
+    print("%-20s %-9s %12s %14s %10s %12s %12s%s" % ("workload", "engine", "gens/sec", "cells/sec", "RSS MB",
+                                                    "alloc blocks", "traced KB",
+                                                    " %10s" % "detector" if args.cycle_detector else ""))
+    results = []
+    context = multiprocessing.get_context("spawn")  # a fresh process per run, so peak RSS is not shared
+    for workload in workloads([int(size) for size in args.sizes.split(",")],
+                              [float(density) for density in args.densities.split(",")]):
+        for engine in engines:
+            phases_path = os.path.join(args.phases, "%s-%s.json" % (workload[0], engine)) if args.phases else None
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_benchmark, workload, engine, args.generations, phases_path,
+                                         args.cycle_detector).result()
+            _print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,22 @@
 import asyncio
 import json
 import logging
+import time
 
 
-import aiohttp
 import aiodns
-from .ratelimiter import RateLimiter
-from .async_lru import alru_cache
+from ratelimiter import RateLimiter, map_as_completed
+import dnswire
+from dnsclient import DNSClient
+from dnscache import DNSCache, doh_json_ttl
+from sessions import ManagedClient
+from upstreams import UpstreamError, UpstreamScheduler
 
 # logging.basicConfig(level=logging.INFO)
 
 GOOGLE_HEADERS = {"accept": "application/x-javascript"}
 CLOUDFLARE_HEADERS = {"accept": "application/dns-json"}
+DNS_MESSAGE_HEADERS = {"accept": "application/dns-message"}
 
 DOH_REST_ENDPOINTS = [{"url": "https://1.1.1.1/dns-query",  # Cloudflare
                        "headers": CLOUDFLARE_HEADERS
@@ -24,59 +29,267 @@ DOH_REST_ENDPOINTS = [{"url": "https://1.1.1.1/dns-query",  # Cloudflare
                       #  }
                       ]
 
+# RFC 8484 endpoints, that take and return binary DNS messages: smaller than JSON, cheaper to parse, and with every
+# record's TTL and type
+DOH_WIRE_ENDPOINTS = [{"url": "https://1.1.1.1/dns-query",  # Cloudflare
+                       "headers": DNS_MESSAGE_HEADERS,
+                       "format": "wire"
+                       },
+                      {"url": "https://8.8.8.8/dns-query",  # Google DNS servers
+                       "headers": DNS_MESSAGE_HEADERS,
+                       "format": "wire"
+                       },
+                      ]
+
 DNS_ENDPOINTS = [
                 "1.1.1.1",
                  #"8.8.8.8"
 ]
 
 DNS_RETRY_CODES = [2, 5, 8, 9]  # try another server if receiving these codes
+NXDOMAIN = 3  # the name does not exist, which is cached like an answer
 
 
 class DNSResolver:
     """ Provides asynchronous querying for tradiitional DNS and DNS-over-HTTPS(DoH)"""
     CACHE_SIZE = 128
 
-    def __init__(self, dns_name_servers: list, doh_name_servers: list, *, doh_client: aiohttp.ClientSession = None):
+    def __init__(self, dns_name_servers: list, doh_name_servers: list, *, doh_client=None,
+                 cache: DNSCache = None, raw_dns: bool = False, raw_dns_options: dict = None):
+        """
+        :param dns_name_servers: list of traditional DNS name server IPs
+        :param doh_name_servers: list of DoH endpoints, like DOH_REST_ENDPOINTS (JSON) or DOH_WIRE_ENDPOINTS (RFC 8484),
+        or both. The same URL can be given once per format
+        :param doh_client: optional aiohttp session (or ManagedClient) to use for DoH. It is left open by
+        stop_session, for its owner to close. Defaults to a ManagedClient of the DoH endpoints, with the pool options of
+        each endpoint's "pool" entry
+        :param cache: DNSCache to look answers up in before asking a name server. Pass the same one to several
+        resolvers (or give it a path) to share answers between them. Defaults to a cache of CACHE_SIZE entries
+        :param raw_dns: send traditional DNS queries with a dnsclient.DNSClient per name server, which keeps thousands
+        of queries outstanding over a few UDP sockets, instead of with aiodns. Name servers can then be given as
+        "ip:port", eg. a stubdns.StubNameServer's address
+        :param raw_dns_options: keyword arguments for every DNSClient, eg. {"sockets": 8, "timeout": 0.5}
+        """
         self._doh_name_servers = doh_name_servers or []
         self._dns_name_servers = dns_name_servers or []
         self._doh_client = doh_client or None
-        self._dns_client = aiodns.DNSResolver(loop=asyncio.get_running_loop(), nameservers=dns_name_servers, tries=2)
+        self._owns_doh_client = doh_client is None
         self._loop = asyncio.get_running_loop()
+        self._raw_dns = raw_dns
+        # one client per name server, so the scheduler can pick between them. "system" uses the system's name servers
+        if raw_dns:
+            if not self._dns_name_servers:
+                raise ValueError("raw_dns needs the name servers to be given")
+            self._dns_clients = {server: DNSClient(server, **(raw_dns_options or dict()))
+                                 for server in self._dns_name_servers}
+        else:
+            self._dns_clients = {server: aiodns.DNSResolver(loop=self._loop, nameservers=[server], tries=2)
+                                 for server in self._dns_name_servers} or \
+                {"system": aiodns.DNSResolver(loop=self._loop, tries=2)}
+        # keyed by (url, format), as a JSON and a wire format endpoint can share a URL, eg. Cloudflare's
+        self._doh_endpoints = {(endpoint.get("url"), endpoint.get("format", "json")): endpoint
+                               for endpoint in self._doh_name_servers}
+        self.doh_scheduler = UpstreamScheduler(list(self._doh_endpoints))
+        self.dns_scheduler = UpstreamScheduler(list(self._dns_clients))
+        self.cache = cache if cache is not None else DNSCache(self.CACHE_SIZE)
+        self._in_flight = dict()  # {(name, type): task of the lookup that every concurrent caller waits on}
+        self.upstream_queries = 0  # lookups that went out to a name server
+        self.coalesced_queries = 0  # lookups that waited on an identical lookup already in flight instead
+
+    async def start_session(self, *, warm: int = 1):
+        """ Creates the DoH client, unless one was given, and opens warm connections to every DoH endpoint
 
-    async def start_session(self):
-        self._doh_client = self._doh_client or aiohttp.ClientSession()
+        :param warm: connections to open to each endpoint ahead of the first queries, 0 for none
+        """
+        if self._doh_client is None:
+            self._doh_client = ManagedClient.for_endpoints(self._doh_name_servers)
+            self._owns_doh_client = True
+            await self._doh_client.start(warm=warm)
 
     async def stop_session(self):
-        await self._doh_client.close()
+        if self._doh_client is not None and self._owns_doh_client:
+            await self._doh_client.close()
+            self._doh_client = None
+        if self._raw_dns:
+            for client in self._dns_clients.values():
+                await client.close()
+
+    async def __aenter__(self):
+        await self.start_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop_session()
+
+    async def _single_flight(self, target_domain: str, dns_type: str, lookup):
+        """ Runs lookup() unless the same (name, type) is already being looked up, DoH or not, in which case it waits
+        for that lookup's answer instead of sending another identical query.
+
+        :param lookup: function returning the coroutine that asks the name server for (answers, server)
+        """
+        key = DNSCache.key(target_domain, dns_type)
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced_queries += 1
+        else:
+            self.upstream_queries += 1
+            task = self._loop.create_task(lookup())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shielded, so a caller that gets cancelled does not cancel the lookup for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self):
+        """ Returns a dictionary of how many lookups went out to name servers, how many were saved by waiting on an
+        identical lookup, the cache's stats, every server's latency and error statistics, and with raw_dns every
+        DNSClient's packet counts and the DoH connection pools' usage """
+        report = {"upstream_queries": self.upstream_queries, "coalesced_queries": self.coalesced_queries,
+                  "cache": self.cache.stats(), "doh_servers": self.doh_scheduler.report(),
+                  "dns_servers": self.dns_scheduler.report()}
+        if self._raw_dns:
+            report["dns_clients"] = [client.stats() for client in self._dns_clients.values()]
+        if isinstance(self._doh_client, ManagedClient):
+            report["pools"] = self._doh_client.stats()
+        return report
+
+    async def resolve(self, target_domain: str, *, dns_type: str = "A", doh: bool = True, client=None,
+                      retry_if_fail: bool = True):
+        """ Looks a domain up in the cache, then over DoH or traditional DNS.
+
+        :return: (answers, server), where server is the DoH URL or name servers that answered, "cache" if the answers
+        were cached, or None if no server answered
+        :raises ValueError: if dns_type is not a record type, before any server is asked
+        """
+        dnswire.type_code(dns_type)
+        cached = self.cache.get(target_domain, dns_type)
+        if cached is not DNSCache.MISSING:
+            return cached, "cache"
+        if doh:
+            lookup = lambda: self._fetch_doh(target_domain, dns_type, client or self._doh_client, retry_if_fail)
+        else:
+            lookup = lambda: self._fetch_dns(target_domain, dns_type)
+        return await self._single_flight(target_domain, dns_type, lookup)
+
+    async def stream_query(self, target_domains, *, dns_type: str = "A", doh: bool = True, concurrency: int = 100,
+                           rate=20, max_tokens=20, retry_if_fail: bool = True):
+        """ Resolves domains from any iterable or async iterable (eg. an open file, read line by line), keeping at most
+        concurrency lookups in flight, and yields the results as they complete, in whatever order that is.
+        Domains are read while the lookups run, so a slow source never holds finished results back, but only while there
+        is room for another lookup, so memory stays flat however many domains there are, and a slow consumer slows down
+        the reading too.
+
+        :param target_domains: iterable or async iterable of domains. Whitespace around them and blank lines are skipped
+        :param doh: look the domains up over DoH, or over traditional DNS if False
+        :param concurrency: maximum lookups in flight at once
+        :param rate: maximum DoH requests per second
+        :param max_tokens: maximum DoH requests in a burst
+        :return: async generator of (domain, answers, latency in seconds, server) tuples
+        """
+        client = RateLimiter(self._doh_client, rate=rate, max_tokens=max_tokens) if doh else None
+
+        async def lookup(target_domain):
+            start = time.monotonic()
+            answers, server = await self.resolve(target_domain, dns_type=dns_type, doh=doh, client=client,
+                                                 retry_if_fail=retry_if_fail)
+            return target_domain, answers, time.monotonic() - start, server
+
+        def start(target_domain):
+            target_domain = target_domain.strip()
+            return lookup(target_domain) if target_domain else None
+
+        async for result in map_as_completed(target_domains, start, concurrency):
+            yield result
 
     """ DNS over HTTPS """
-    @alru_cache(maxsize=max(CACHE_SIZE, 0))
     async def query_doh_json(self, target_domain: str, *, dns_type: str = "A", client=None, retry_if_fail: bool = True):
-        client = client or self._doh_client
-        for endpoint in self._doh_name_servers:
-            url, headers = endpoint.get("url"), endpoint.get("headers")
+        answers, _ = await self.resolve(target_domain, dns_type=dns_type, client=client, retry_if_fail=retry_if_fail)
+        return answers
+
+    async def query_doh_message(self, target_domain: str, *, dns_type: str = "A", client=None,
+                                retry_if_fail: bool = True):
+        """ Looks a domain up over the wire format DoH endpoints only, bypassing the cache, and returns the whole
+        decoded response, with every record's name, type and TTL and the authority section.
+
+        :return: dnswire.Message, or None if no server answered
+        """
+        servers = [server for server in self._doh_endpoints if server[1] == "wire"]
+        try:
+            _, message = await self.doh_scheduler.race(
+                lambda server: self._ask_doh_wire(server, target_domain, dns_type, client or self._doh_client),
+                retry=retry_if_fail, servers=servers)
+            return message
+        except UpstreamError as e:
+            logging.warning(f"Err: {e} for {target_domain}")
+        return None
+
+    async def _fetch_doh(self, target_domain: str, dns_type: str, client, retry_if_fail: bool):
+        async def ask(server):
+            if server[1] == "wire":
+                message = await self._ask_doh_wire(server, target_domain, dns_type, client)
+                status, answers, ttl = message.rcode, message.answer_data(), message.ttl()
+            else:
+                json_reply = await self._ask_doh_json(server, target_domain, dns_type, client)
+                status, ttl = json_reply.get("Status"), doh_json_ttl(json_reply)
+                answers = [answer.get("data") for answer in json_reply.get("Answer") or []]
+            return self._cache_reply(target_domain, dns_type, status, answers, ttl)
+
+        try:
+            (url, _), answers = await self.doh_scheduler.race(ask, retry=retry_if_fail)
+            return answers, url
+        except UpstreamError as e:
+            logging.warning(f"Err: {e} for {target_domain}")
+        return None, None
+
+    def _cache_reply(self, target_domain: str, dns_type: str, status: int, answers: list, ttl):
+        """ Caches a name server's reply by its DNS status, and returns its answers (None for a failed lookup)
+
+        :raises UpstreamError: if the status says another server should be asked
+        """
+        if not status:  # error code 0 means success
+            # no answers means the name has no records of this type, which is cached like a failure
+            self.cache.set(target_domain, dns_type, answers,
+                           ttl if ttl is not None or answers else self.cache.negative_ttl)
+            return answers
+        if status in DNS_RETRY_CODES:
+            raise UpstreamError(f"DNS status {status}")
+        if status == NXDOMAIN:
+            self.cache.set(target_domain, dns_type, None, ttl)
+        return None
+
+    def _check_doh_status(self, server, resp):
+        logging.info(f"Using {server[0]}; Response: {resp.status}")
+        if resp.status == 429:  # too many requests, so leave this server alone for a while
+            self.doh_scheduler.back_off(server, int(resp.headers.get("X-Ttl") or resp.headers.get("Retry-After") or 1))
+        if resp.status != 200:
+            raise UpstreamError(f"HTTP {resp.status}")
+
+    async def _ask_doh_json(self, server, target_domain: str, dns_type: str, client):
+        """ Asks a JSON DoH endpoint, given by its (url, format) key, and returns its decoded reply """
+        # passing param instead of json due to inconsistent MIME types :(
+        async with await client.get(server[0], params={"name": target_domain, "type": dns_type},
+                                    headers=self._doh_endpoints[server].get("headers")) as resp:
+            self._check_doh_status(server, resp)
             try:
-                # passing param instead of json due to inconsistent MIME types :(
-                async with await client.get(url, params={"name": target_domain, "type": dns_type},
-                                            headers=headers) as resp:
-                    logging.info(f"Using {url}; Response: {resp.status}")
-                    if resp.status == 200:
-                        pass
-                    elif resp.status == 429:
-                        await asyncio.sleep(int(resp.headers.get("X-Ttl") or resp.headers.get("Retry-After") or 1))
-                    else:
-                        continue
-                    json_reply = json.loads(await resp.text())
-                    logging.info(f"Text: {json_reply}")
-                    status = json_reply.get("Status")
-                    if not status:  # error code 0 means success
-                        return [answer.get("data") for answer in json_reply.get("Answer")]
-                    if status in DNS_RETRY_CODES and retry_if_fail:
-                        continue
-                    else:
-                        return None
-            except Exception as e:
-                logging.warning(f"Err: {e} for {url}:{target_domain}")
+                json_reply = json.loads(await resp.text())
+            except ValueError as e:
+                raise UpstreamError(f"Bad JSON reply: {e}")
+        logging.info(f"Text: {json_reply}")
+        return json_reply
+
+    async def _ask_doh_wire(self, server, target_domain: str, dns_type: str, client):
+        """ Asks an RFC 8484 DoH endpoint, given by its (url, format) key, with a GET request, and returns its decoded
+        dnswire.Message """
+        query = dnswire.encode_query(target_domain, dns_type)
+        async with await client.get(server[0], params={"dns": dnswire.doh_get_param(query)},
+                                    headers=self._doh_endpoints[server].get("headers")) as resp:
+            self._check_doh_status(server, resp)
+            packet = await resp.read()
+        try:
+            message = dnswire.decode_message(packet)
+        except dnswire.DNSWireError as e:
+            raise UpstreamError(f"Bad DNS message: {e}")
+        logging.info(f"Message: {message}")
+        return message
 
     async def mass_query_doh_json(self, target_domains: list, *, dns_type: str = "A", rate=20, max_tokens=20,
                                   retry_if_fail: bool = True):
@@ -86,26 +299,51 @@ class DNSResolver:
               target_domain in target_domains])
 
     """ Traditional DNS """
-    @alru_cache(maxsize=max(CACHE_SIZE, 0))
     async def query_dns(self, target_domain, *, dns_type: str = "A"):
+        answers, _ = await self.resolve(target_domain, dns_type=dns_type, doh=False)
+        return answers
+
+    async def _fetch_dns(self, target_domain, dns_type):
+        async def ask_raw(server):
+            try:
+                message = await self._dns_clients[server].query(target_domain, dns_type)
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                raise UpstreamError(f"DNS error {e!r}")
+            return self._cache_reply(target_domain, dns_type, message.rcode, message.answer_data(), message.ttl())
+
+        async def ask(server):
+            try:
+                answers = await self._dns_clients[server].query(target_domain, dns_type)
+            except aiodns.error.DNSError as e:
+                if e.args and e.args[0] in (aiodns.error.ARES_ENOTFOUND, aiodns.error.ARES_ENODATA):
+                    self.cache.set(target_domain, dns_type, None)  # c-ares does not hand out the SOA's TTL
+                    return None
+                raise UpstreamError(f"DNS error {e}")  # eg. SERVFAIL, REFUSED or a timeout
+            ttls = [answer.ttl for answer in answers if getattr(answer, "ttl", None) is not None]
+            answers = [getattr(answer, "host", None) for answer in answers]
+            self.cache.set(target_domain, dns_type, answers, min(ttls) if ttls else None)
+            return answers
+
         try:
-            answers = await self._dns_client.query(target_domain, dns_type)
-            return [getattr(answer, "host", None) for answer in answers]
-        except Exception as e:
+            server, answers = await self.dns_scheduler.race(ask_raw if self._raw_dns else ask)
+            return answers, server
+        except UpstreamError as e:
             logging.warning(f"Err: {e} for {target_domain}")
+        return None, None
 
     async def mass_query_dns(self, target_domains: list):
         return await asyncio.gather(*[self.query_dns(target_domain) for target_domain in target_domains])
 
 
 async def test_dns():
-    resolver = DNSResolver(DNS_ENDPOINTS, DOH_REST_ENDPOINTS)
-    await resolver.start_session()
-    res = await resolver.mass_query_doh_json([""], retry_if_fail=False, rate=1, max_tokens=1)
-    print(res)
-    #res = await resolver.mass_query_dns(["google.com"]*100)
-    #print(res)
-    await resolver.stop_session()
+    async with DNSResolver(DNS_ENDPOINTS, DOH_REST_ENDPOINTS) as resolver:
+        res = await resolver.mass_query_doh_json([""], retry_if_fail=False, rate=1, max_tokens=1)
+        print(res)
+        async with DNSResolver(DNS_ENDPOINTS, DOH_WIRE_ENDPOINTS) as wire_resolver:
+            print(await wire_resolver.query_doh_message("google.com"))
+        print(resolver.stats())
+        #res = await resolver.mass_query_dns(["google.com"]*100)
+        #print(res)
 
 
 if __name__ == "__main__":
@@ -1,78 +1,249 @@
-import aiohttp
 import logging
 import json
 import asyncio
 import time
-from itertools import chain
+from collections import defaultdict, deque
+from ipaddress import ip_address
 
-from ratelimiter import RateLimiter
+from ipcache import IPCache
+from ratelimiter import RateLimiter, iterate, map_as_completed, retry_after_seconds
+from sessions import ManagedClient
 
 IP_API_HEADERS = {"Content-Type": "application/json"}
 IP_API_RESP_HEADERS = {
     "X-Rl": int,
     "X-Ttl": int,
+    "Retry-After": retry_after_seconds,
 }
+IP_API_BATCH_QUOTA = 15  # ip-api allows 15 batch requests per minute
+IP_API_QUOTA_WINDOW = 60
+IP_API_BATCH_SIZE = 99  # IPs per batch request, ip-api allows up to 100
 IP_REST_ENDPOINTS = [
     {"url": "http://ip-api.com/batch",
      "method": "POST",
      "headers": IP_API_HEADERS,
-     "response-headers": IP_API_RESP_HEADERS
+     "response-headers": IP_API_RESP_HEADERS,
+     # batches in flight are few, the quota allows 15 a minute, and a warm-up request would count against it
+     "pool": {"limit": 4, "warm": False},
      },
 ]
 
 
 class IPResolver:
     """ Provides asynchronous querying for tradiitional DNS and DNS-over-HTTPS(DoH)"""
-    CACHE_SIZE = 128
+    CACHE_SIZE = 65536  # IP ranges to cache results for, 16 bytes each (1 MB), so a long run's IPs stay cached
 
-    def __init__(self, ip_rest_endpoints):
-        self._http_client = None
+    def __init__(self, ip_rest_endpoints, *, http_client=None, cache: IPCache = None):
+        """
+        :param ip_rest_endpoints: list of REST endpoints, like IP_REST_ENDPOINTS
+        :param http_client: optional aiohttp session (or ManagedClient) to use. It is left open by stop_session, for its
+        owner to close. Defaults to a ManagedClient of the endpoints, with the pool options of each endpoint's "pool"
+        entry
+        :param cache: IPCache to look IPs up in first, eg. one loaded from a snapshot or one with aggregate=24 so a
+        result answers for its whole /24. Defaults to a new IPCache of CACHE_SIZE ranges
+        """
+        self._http_client = http_client
+        self._owns_http_client = http_client is None
         self._ip_rest_endpoints = ip_rest_endpoints
-        self._latest_ip_api_resp = {"X-Ttl": "0", "X-Rl": "15"}
+        self.cache = cache if cache is not None else IPCache(self.CACHE_SIZE)
+        self.rate_limiter = None  # the RateLimiter of the last mass query, for its stats()
 
-    async def start_session(self):
-        self._http_client = self._http_client or aiohttp.ClientSession()
+    async def start_session(self, *, warm: int = 1):
+        """ Creates the HTTP client, unless one was given, and opens warm connections to every endpoint
+
+        :param warm: connections to open to each endpoint ahead of the first queries, 0 for none
+        """
+        if self._http_client is None:
+            self._http_client = ManagedClient.for_endpoints(self._ip_rest_endpoints)
+            self._owns_http_client = True
+            await self._http_client.start(warm=warm)
 
     async def stop_session(self):
-        await self._http_client.close()
+        if self._http_client is not None and self._owns_http_client:
+            await self._http_client.close()
+            self._http_client = None
 
-    async def query_http(self, method="GET", client=None, *args, **kwargs):
-        query_methods = {
-            "get": client.get or self._http_client.get,
-            "post": client.post or self._http_client.post,
-            "put": client.put or self._http_client.put,
-        }
+    async def __aenter__(self):
+        await self.start_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop_session()
+
+    def stats(self):
+        """ Returns a dictionary of the cache's stats, the last mass query's rate limits, and the connection pools'
+        usage """
+        report = {"cache": self.cache.stats()}
+        if self.rate_limiter is not None:
+            report["rate_limiter"] = self.rate_limiter.stats()
+        if isinstance(self._http_client, ManagedClient):
+            report["pools"] = self._http_client.stats()
+        return report
 
-        query = query_methods.get(method.lower())
+    async def query_http(self, method="GET", client=None, *args, **kwargs):
+        query = getattr(client or self._http_client, method.lower())
         try:
             async with await query(*args, **kwargs) as resp:
                 logging.info(f"Using {args[0]}; Response: {resp.status}; Headers: {resp.headers}")
                 if resp.status == 200:
                     return await resp.text(), resp.headers
-                elif resp.status == 429:  # too many requests
+                elif resp.status == 429 and not isinstance(client, RateLimiter):  # too many requests
+                    # a RateLimiter has already paused the host for as long as the server asked
                     await asyncio.sleep(int(resp.headers.get("X-Ttl") or resp.headers.get("Retry-After") or 1))
         except Exception as e:
             logging.warning(e)
         return None, None
 
     async def query_json(self, rest_endpoint: dict, client=None, **kwargs):
-        while int(self._latest_ip_api_resp.get("X-Rl")) < 2:
-            await asyncio.sleep(int(self._latest_ip_api_resp.get("X-Ttl")) // 2)
+        """ Returns the decoded JSON reply of a REST endpoint, or None if the request or the decoding failed """
         method = rest_endpoint.get("method")
         url = rest_endpoint.get("url")
         headers = rest_endpoint.get("headers")
         text, headers = await self.query_http(method, client, url, headers=headers, **kwargs)
-        print(headers)
-        self._latest_ip_api_resp = headers
-        return json.loads(text)
+        if text is None:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            logging.warning(f"Could not decode the reply of {url}: {e}")
+            return None
+
+    async def stream_query_ip_api(self, target_ips, *, batch_size: int = IP_API_BATCH_SIZE, concurrency: int = 2,
+                                  retries: int = 3, fields: str = "status,message,countryCode,query",
+                                  dedupe: bool = True, rate=0.75, use_cache: bool = True, linger: float = None):
+        """ Looks IPs up with ip-api's batch endpoint, from any iterable or async iterable (eg. an open file, read line
+        by line), keeping at most concurrency batches in flight and yielding every IP's result as soon as its batch is
+        answered.
+        IPs are read while the batches are in flight, so a slow source never holds answered batches back, but only while
+        there is room for another batch, so only the batches in flight are held in memory, however many IPs there are
+        (apart from the IPs already seen, if dedupe is on). A batch that fails is retried on its own, with a growing
+        pause, and the rest of the run carries on.
+        IPs with a fresh result in the cache are answered from it without being sent, and successful results are
+        cached. Cached results have the fields they were looked up with, which may not be the fields asked for now.
+
+        :param target_ips: iterable or async iterable of IPs. Whitespace around them and blank lines are skipped
+        :param batch_size: IPs per request, ip-api allows up to 100
+        :param concurrency: maximum batches in flight at once. The rate limiter also keeps them within ip-api's quota
+        :param retries: how many more times to send a batch that failed
+        :param fields: the fields ip-api should return for every IP
+        :param dedupe: look each IP up only once. Takes about 60 bytes per distinct IP
+        :param rate: maximum batch requests per second
+        :param use_cache: look IPs up in self.cache first, and cache the results
+        :param linger: seconds an IP may wait for its batch to fill up before the batch is sent as it is, eg. when the
+        IPs come from a stream that pauses. None waits for full batches (or the end of the IPs), which spends the least
+        of ip-api's quota
+        :return: async generator of ip-api's result dictionaries. IPs of batches that failed every try get
+        {"status": "fail", "message": "request failed", "query": ip}
+        """
+        client = RateLimiter(self._http_client, rate=rate, max_tokens=concurrency, x_rl=IP_API_BATCH_QUOTA,
+                             x_ttl=IP_API_QUOTA_WINDOW, response_headers=IP_API_RESP_HEADERS)
+        self.rate_limiter = client
+        params = {"fields": fields}
+
+        async def query_batch(batch):
+            for attempt in range(retries + 1):
+                results = await self.query_json(rest_endpoint=self._ip_rest_endpoints[0], client=client, json=batch,
+                                                params=params)
+                if isinstance(results, list):
+                    if use_cache:
+                        for result in results:
+                            if isinstance(result, dict) and result.get("status") == "success":
+                                self.cache.set(result.get("query"), result)
+                    return results
+                if attempt < retries:
+                    logging.warning(f"Batch of {len(batch)} IPs from {batch[0]} failed, retrying")
+                    await asyncio.sleep(2 ** attempt)
+            logging.warning(f"Batch of {len(batch)} IPs from {batch[0]} failed {retries + 1} times, giving up")
+            return [{"status": "fail", "message": "request failed", "query": ip} for ip in batch]
+
+        async def answered(hits):
+            return hits
+
+        def start(entry):
+            batch, hits = entry
+            return query_batch(batch) if batch else answered(hits)
+
+        async for results in map_as_completed(self._batches(target_ips, batch_size, dedupe, use_cache, linger), start,
+                                              concurrency):
+            for result in results:
+                yield result
 
     async def mass_query_json_ip_api(self, target_ips: list):
-        params = {"fields": "status,countryCode,query"}
-        client = RateLimiter(self._http_client, rate=0.75, max_tokens=2)
-        ip_api_results = await asyncio.gather(
-            *[self.query_json(rest_endpoint=IP_REST_ENDPOINTS[0], client=client, json=ip_chunk, params=params) for ip_chunk in
-              self.chunks(target_ips, 99)])
-        return ((result.get("query"), result.get("countryCode")) for result in chain(*ip_api_results))
+        """ Returns (ip, country code) of every IP, in the order of target_ips and once per IP even if it is repeated """
+        results = defaultdict(deque)  # {IP's key: its results, in the order they came back}
+        async for result in self.stream_query_ip_api(target_ips, fields="status,countryCode,query", dedupe=False):
+            results[_ip_key(result.get("query"))].append(result)
+        ip_api_results = [results[_ip_key(ip.strip())].popleft() for ip in target_ips if ip.strip()]
+        return ((result.get("query"), result.get("countryCode")) for result in ip_api_results)
+
+    async def _batches(self, target_ips, batch_size: int, dedupe: bool, use_cache: bool, linger: float = None):
+        """ Helper for stream_query_ip_api. Groups IPs from an iterable or async iterable into lists of batch_size,
+        skipping blank lines and, if dedupe is on, IPs that were already seen. Yields (batch, []) tuples of the IPs to
+        send, and ([], cached results) tuples of the IPs that were in the cache. With linger, what has been gathered
+        is yielded once its first IP has waited linger seconds, full or not """
+        loop = asyncio.get_running_loop()
+        source = iterate(target_ips)
+        seen = set()
+        batch = []
+        hits = []
+        deadline = None  # loop.time() at which the IPs gathered so far are yielded, if linger is set
+        reading = None  # task reading the next IP, while the IPs gathered so far wait for the deadline
+        try:
+            while True:
+                if deadline is None:
+                    try:
+                        ip = await (reading or source.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    reading = None
+                else:
+                    reading = reading or asyncio.ensure_future(source.__anext__())
+                    done, _ = await asyncio.wait({reading}, timeout=max(deadline - loop.time(), 0))
+                    if not done:  # the source paused, so send what there is instead of waiting for a full batch
+                        if hits:
+                            yield [], hits
+                        if batch:
+                            yield batch, []
+                        batch, hits, deadline = [], [], None
+                        continue
+                    try:
+                        ip = reading.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        reading = None
+                ip = ip.strip()
+                if not ip:
+                    continue
+                if dedupe:
+                    key = _ip_key(ip)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                if linger is not None and deadline is None:
+                    deadline = loop.time() + linger
+                cached = self.cache.get(ip) if use_cache else None
+                if cached is not None:
+                    hits.append(cached)
+                    if len(hits) >= batch_size:
+                        yield [], hits
+                        hits = []
+                else:
+                    batch.append(ip)
+                    if len(batch) >= batch_size:
+                        if hits:
+                            yield [], hits
+                        yield batch, []
+                        batch, hits = [], []
+                if not batch and not hits:
+                    deadline = None
+        finally:
+            if reading is not None:
+                reading.cancel()
+        if hits:
+            yield [], hits
+        if batch:
+            yield batch, []
 
     @staticmethod
     def chunks(lst, n):
@@ -80,23 +251,32 @@ class IPResolver:
             yield lst[i:i + n]
 
 
-async def test_ip():
+def _ip_key(ip: str):
+    """ Returns a small hashable key of an IP for deduplicating: the IP as an int (IPv6 ones offset so they can not
+    collide with IPv4 ones), or the string itself if it is not an IP """
+    try:
+        address = ip_address(ip)
+    except ValueError:
+        return ip
+    return int(address) if address.version == 4 else int(address) | 1 << 128
 
-    ip_resolver = IPResolver(IP_REST_ENDPOINTS)
 
-    await ip_resolver.start_session()
-    start = time.time()
+async def test_ip():
 
-    test_data = [
-        "208.80.152.201",
-        "8.8.8.8"
-    ]
-    ip_res = await ip_resolver.mass_query_json_ip_api(test_data)
-    print(list(ip_res))
-    end = time.time()
-    print(f"Time taken: {end - start}")
+    async with IPResolver(IP_REST_ENDPOINTS) as ip_resolver:
+        start = time.time()
 
-    await ip_resolver.stop_session()
+        test_data = [
+            "208.80.152.201",
+            "8.8.8.8"
+        ]
+        ip_res = await ip_resolver.mass_query_json_ip_api(test_data)
+        print(list(ip_res))
+        end = time.time()
+        print(f"Time taken: {end - start}")
+        print(f"Throttled for: {ip_resolver.rate_limiter.throttled():.2f}s, {ip_resolver.rate_limiter.stats()}")
+        print(f"Cache: {ip_resolver.cache.stats()}")
+        print(f"Pools: {ip_resolver.stats().get('pools')}")
 
 
 if __name__ == "__main__":
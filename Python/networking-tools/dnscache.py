@@ -0,0 +1,151 @@
+"""
+A DNS answer cache keyed on (name, type), shared by every DNSResolver that is given it.
+Answers are kept for as long as their TTL says, failed lookups (NXDOMAIN, or a name without records of that type) are
+cached as negative entries, and the number of entries is bounded with LRU eviction.
+Give it a path to also keep the entries in an SQLite file, so several processes can share warm entries.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 60  # how long to cache answers for when the reply does not say
+NEGATIVE_TTL = 300  # how long to cache a failed lookup for when the reply does not say (RFC 2308 suggests 1-3 hours)
+MAX_TTL = 86400  # never cache anything for longer than a day, whatever the TTL says
+
+
+class DNSCache:
+    """ Caches DNS answers by (name, type) until their TTL runs out. Not thread-safe. """
+    MISSING = object()  # returned by get() when there is no fresh entry
+
+    def __init__(self, maxsize: int = 1024, *, path: str = None, negative_ttl: int or float = NEGATIVE_TTL,
+                 default_ttl: int or float = DEFAULT_TTL, max_ttl: int or float = MAX_TTL):
+        """
+        :param maxsize: maximum entries to keep in memory. The least recently used entry is evicted first
+        :param path: optional SQLite file to keep the entries in as well, shared with other processes
+        :param negative_ttl: seconds to cache a failed lookup for if the reply does not give a TTL
+        :param default_ttl: seconds to cache answers for if the reply does not give a TTL
+        :param max_ttl: maximum seconds to cache anything for
+        """
+        self.maxsize = max(maxsize, 0)
+        self.negative_ttl = negative_ttl
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict()  # {(name, type): (expires at, answers or None)}
+        self.hits = self.misses = self.evictions = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=10, isolation_level=None)  # autocommit, each write is atomic
+            self._db.execute("PRAGMA journal_mode=WAL")  # readers in other processes do not block writers
+            self._db.execute("CREATE TABLE IF NOT EXISTS dns_cache (name TEXT, type TEXT, expires REAL, answers TEXT, "
+                             "PRIMARY KEY (name, type))")
+
+    @staticmethod
+    def key(name: str, dns_type: str = "A"):
+        """ Returns the cache key of a name: names are case insensitive, and example.com. is the same as example.com """
+        return name.rstrip(".").lower(), dns_type.upper()
+
+    def get(self, name: str, dns_type: str = "A"):
+        """ Returns the cached answers of a name, None for a cached failed lookup, or DNSCache.MISSING """
+        key = self.key(name, dns_type)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= now:
+            del self._entries[key]
+            entry = None
+        if entry is None and self._db is not None:
+            row = self._db.execute("SELECT expires, answers FROM dns_cache WHERE name = ? AND type = ? AND expires > ?",
+                                   (*key, now)).fetchone()
+            if row is not None:
+                entry = (row[0], json.loads(row[1]))
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return self.MISSING
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, name: str, dns_type: str, answers: list or None, ttl: int or float = None):
+        """ Caches the answers of a name for ttl seconds. None answers cache a failed lookup
+
+        :param name: the domain name
+        :param dns_type: the record type, eg. "A"
+        :param answers: list of answers, or None for a failed lookup
+        :param ttl: seconds until the entry expires. Defaults to negative_ttl for failed lookups and default_ttl for
+        answers. A TTL of 0 is not cached
+        """
+        if ttl is None:
+            ttl = self.negative_ttl if answers is None else self.default_ttl
+        if ttl <= 0:
+            return
+        key = self.key(name, dns_type)
+        entry = (time.time() + min(ttl, self.max_ttl), answers)
+        self._remember(key, entry)
+        if self._db is not None:
+            try:
+                self._db.execute("INSERT OR REPLACE INTO dns_cache VALUES (?, ?, ?, ?)", (*key, entry[0],
+                                                                                         json.dumps(answers)))
+            except sqlite3.Error as e:
+                logging.warning(f"Could not write {key} to the DNS cache file: {e}")
+
+    def _remember(self, key, entry):
+        """ Puts an entry in memory, evicting the least recently used entries if there are too many """
+        if not self.maxsize:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def purge(self):
+        """ Drops every expired entry, from memory and from the SQLite file """
+        now = time.time()
+        for key in [key for key, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        if self._db is not None:
+            self._db.execute("DELETE FROM dns_cache WHERE expires <= ?", (now,))
+
+    def clear(self):
+        self._entries.clear()
+        if self._db is not None:
+            self._db.execute("DELETE FROM dns_cache")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        """ Returns a dictionary of the cache's size, hit rate and evictions """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def doh_json_ttl(json_reply: dict):
+    """ Returns how long a DoH JSON reply can be cached for: the lowest TTL of its answers, or for a failed lookup the
+    lower of the SOA record's TTL and minimum field in the authority section (RFC 2308). None if there are neither """
+    if json_reply.get("Answer"):
+        ttls = [record.get("TTL") for record in json_reply["Answer"] if record.get("TTL") is not None]
+    else:
+        ttls = []
+        for record in json_reply.get("Authority") or []:
+            if record.get("TTL") is not None:
+                ttls.append(record["TTL"])
+            fields = str(record.get("data", "")).split()
+            if record.get("type") == 6 and len(fields) == 7 and fields[-1].isdigit():  # SOA
+                ttls.append(int(fields[-1]))
+    return min(ttls) if ttls else None
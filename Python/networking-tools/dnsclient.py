@@ -0,0 +1,410 @@
+"""
+A DNS client that speaks the wire protocol itself, for bulk lookups against one name server.
+Thousands of queries are kept outstanding over a small pool of UDP sockets, each query with a random transaction ID,
+and responses are matched back to their query by ID and question. Timeouts and retransmits are kept on a timer wheel,
+so one loop timer serves every outstanding query instead of one timer each.
+Responses that come back truncated are asked again over TCP, where queries are pipelined on one connection and matched
+by ID as they come back (RFC 7766).
+See stubdns.StubNameServer for a local name server to run it against.
+"""
+
+import asyncio
+import logging
+import math
+import random
+import socket
+import struct
+import time
+
+import dnswire
+
+UDP_PAYLOAD = 1232  # EDNS(0) UDP payload size that avoids IP fragmentation (DNS flag day 2020)
+TCP_LENGTH = struct.Struct("!H")
+RECEIVE_BUFFER = 4 * 1024 * 1024  # bytes of responses the kernel can queue per socket before it drops them
+
+
+def set_receive_buffer(transport, size: int):
+    """ Asks for a larger receive buffer on a UDP transport's socket, so bursts of datagrams are not dropped. The
+    kernel may give less (eg. net.core.rmem_max on linux) """
+    sock = transport.get_extra_info("socket")
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except OSError as e:
+        logging.info(f"Could not set the receive buffer to {size} bytes: {e}")
+
+
+class TimerWheel:
+    """ A hashed timer wheel: timeouts are put in the slot of the tick they expire on, and a single loop timer advances
+    the wheel one slot per tick, firing whatever is in the slot. Adding and removing a timeout are O(1), and the loop
+    only ever has one timer, however many timeouts there are. Timeouts fire up to one tick late """
+
+    def __init__(self, tick: float = 0.05, slots: int = 256):
+        """
+        :param tick: seconds per slot, ie. how precisely timeouts fire
+        :param slots: number of slots. Timeouts further away than a full turn wait for more turns
+        """
+        self.tick = tick
+        self._slots = [dict() for _ in range(slots)]  # [{key: (turns left, callback)}]
+        self._position = 0
+        self._count = 0
+        self._handle = None
+        self._next_at = None  # loop.time() of the next tick
+
+    def add(self, key, delay: float, callback):
+        """ Calls callback() after delay seconds, unless the key is removed first
+
+        :return: the slot the timeout went in, to pass to remove()
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._handle is None:
+            self._next_at = now + self.tick
+            self._handle = loop.call_at(self._next_at, self._advance, loop)
+        # counted from the time of the current slot, which is behind now if the loop is running late
+        ticks = max(math.ceil((now + delay - (self._next_at - self.tick)) / self.tick), 1)
+        slot = (self._position + ticks) % len(self._slots)
+        self._slots[slot][key] = ((ticks - 1) // len(self._slots), callback)
+        self._count += 1
+        return slot
+
+    def remove(self, key, slot: int):
+        if self._slots[slot].pop(key, None) is not None:
+            self._count -= 1
+
+    def _advance(self, loop):
+        # self._handle is left set while the callbacks run, so timeouts they add do not start a second timer
+        self._position = (self._position + 1) % len(self._slots)
+        slot = self._slots[self._position]
+        expired = [key for key, (turns, _) in slot.items() if not turns]
+        for key, (turns, callback) in list(slot.items()):
+            if turns:
+                slot[key] = (turns - 1, callback)
+        for key in expired:
+            _, callback = slot.pop(key)
+            self._count -= 1
+            callback()
+        if self._count:
+            # ticks are counted from the wheel's own schedule, so they do not drift with the loop's lateness
+            self._next_at = max(self._next_at + self.tick, loop.time())
+            self._handle = loop.call_at(self._next_at, self._advance, loop)
+        else:
+            self._handle = None
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            slot.clear()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+
+class _PendingQuery:
+    """ A query waiting for its response """
+    __slots__ = ("future", "packet", "question", "attempts", "slot")
+
+    def __init__(self, future, packet: bytes, question: tuple):
+        self.future = future
+        self.packet = packet
+        self.question = question  # (lowercase name with a trailing dot, type code), to check the response against
+        self.attempts = 1
+        self.slot = None
+
+
+def _matches(message, question):
+    """ Checks a response is for the question that was asked, not a stale or spoofed one that reused its ID """
+    return len(message.questions) == 1 and (message.questions[0].name.lower(), message.questions[0].type) == question
+
+
+class _UDPSocket(asyncio.DatagramProtocol):
+    """ One connected UDP socket of a DNSClient, with the queries outstanding on it """
+
+    def __init__(self, client, index: int):
+        self.client = client
+        self.index = index
+        self.transport = None
+        self.pending = dict()  # {transaction ID: _PendingQuery}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # the socket is connected, so the kernel already drops datagrams that are not from the server
+        client = self.client
+        try:
+            message_id = dnswire.peek_id(data)
+        except struct.error:
+            client.dropped += 1
+            return
+        pending = self.pending.get(message_id)
+        if pending is None:  # a late answer to a query that was already answered or timed out
+            client.dropped += 1
+            return
+        try:
+            message = dnswire.decode_message(data)
+        except dnswire.DNSWireError:
+            client.dropped += 1
+            return
+        if not _matches(message, pending.question):
+            client.dropped += 1
+            return
+        del self.pending[message_id]
+        client.wheel.remove((self.index, message_id), pending.slot)
+        if message.truncated and client.tcp_fallback:
+            client.truncated += 1
+            client.loop.create_task(client._ask_tcp(pending))
+        elif not pending.future.done():
+            pending.future.set_result(message)
+
+    def error_received(self, exc):
+        # eg. ICMP port unreachable. Which query it was for is not known, so the queries are left to time out
+        logging.warning(f"UDP error from {self.client.server}: {exc!r}")
+
+    def connection_lost(self, exc):
+        for pending in self.pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(ConnectionError(f"UDP socket to {self.client.server} closed"))
+        self.pending.clear()
+
+
+class _TCPConnection:
+    """ A TCP connection to the name server, with any number of queries pipelined on it """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = dict()  # {transaction ID: _PendingQuery}
+        self._writer = None
+        self._reader_task = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, self._writer = await asyncio.open_connection(self.client.host, self.client.port)
+                self._reader_task = asyncio.ensure_future(self._read(reader))
+        return self._writer
+
+    async def ask(self, pending: _PendingQuery):
+        writer = await self._connect()
+        message_id = _free_id(self.pending)
+        self.pending[message_id] = pending
+        packet = bytearray(pending.packet)
+        struct.pack_into("!H", packet, 0, message_id)  # a new ID, unique on this connection
+        writer.write(TCP_LENGTH.pack(len(packet)) + packet)
+        try:
+            await asyncio.wait_for(asyncio.shield(pending.future), self.client.timeout * (self.client.retries + 1))
+        except asyncio.TimeoutError:
+            if not pending.future.done():
+                pending.future.set_exception(asyncio.TimeoutError(f"No TCP response from {self.client.server}"))
+        finally:
+            self.pending.pop(message_id, None)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                length, = TCP_LENGTH.unpack(await reader.readexactly(TCP_LENGTH.size))
+                data = await reader.readexactly(length)
+                try:
+                    message = dnswire.decode_message(data)
+                except dnswire.DNSWireError:
+                    self.client.dropped += 1
+                    continue
+                pending = self.pending.pop(message.id, None)
+                if pending is None or not _matches(message, pending.question):
+                    self.client.dropped += 1
+                    continue
+                if not pending.future.done():
+                    pending.future.set_result(message)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = e
+        except asyncio.CancelledError:
+            error = ConnectionError("TCP connection closed")
+        for pending in self.pending.values():
+            if not pending.future.done():
+                pending.future.set_exception(ConnectionError(f"TCP connection to {self.client.server} lost: {error!r}"))
+        self.pending.clear()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+
+
+def _free_id(pending: dict):
+    """ Returns a random transaction ID that is not outstanding yet """
+    while True:
+        message_id = random.getrandbits(16)
+        if message_id not in pending:
+            return message_id
+
+
+class DNSClient:
+    """ Sends queries to one name server over a pool of UDP sockets, falling back to TCP for truncated responses """
+
+    def __init__(self, server: str, port: int = 53, *, sockets: int = 4, timeout: float = 1.0, retries: int = 2,
+                 max_in_flight: int = 1000, tick: float = 0.05, edns_payload: int = UDP_PAYLOAD,
+                 tcp_fallback: bool = True):
+        """
+        :param server: IP of the name server, optionally with a port, eg. "127.0.0.1:5353"
+        :param port: port of the name server, if server does not give one
+        :param sockets: UDP sockets to spread the queries over
+        :param timeout: seconds to wait for a response before sending the query again. It doubles every retransmit
+        :param retries: how many times to send a query again before giving up
+        :param max_in_flight: maximum queries outstanding at once, the rest wait for a free slot
+        :param tick: precision of the timeouts in seconds, see TimerWheel
+        :param edns_payload: UDP payload size to advertise with EDNS(0), or None to not send an OPT record (and get
+        responses truncated at 512 bytes)
+        :param tcp_fallback: ask again over TCP when a response is truncated, instead of returning the truncated one
+        """
+        host, _, given_port = server.rpartition(":") if server.count(":") == 1 else (server, None, None)
+        self.server = server
+        self.host = host
+        self.port = int(given_port) if given_port else port
+        self.timeout = timeout
+        self.retries = retries
+        self.edns_payload = edns_payload
+        self.tcp_fallback = tcp_fallback
+        self.loop = None
+        self.wheel = TimerWheel(tick)
+        self._socket_count = max(sockets, 1)
+        self._sockets = []
+        self._next_socket = 0
+        self._tcp = None
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._start_lock = None
+        self.sent = self.answered = self.retransmits = self.timeouts = self.truncated = self.dropped = 0
+
+    async def start(self):
+        """ Opens the sockets. Called by the first query if need be """
+        if self._sockets:
+            return
+        self.loop = asyncio.get_running_loop()
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._sockets:
+                return
+            sockets = []
+            for index in range(self._socket_count):
+                transport, protocol = await self.loop.create_datagram_endpoint(lambda: _UDPSocket(self, index),
+                                                                               remote_addr=(self.host, self.port))
+                set_receive_buffer(transport, RECEIVE_BUFFER)
+                sockets.append(protocol)
+            self._sockets = sockets
+            self._tcp = _TCPConnection(self)
+
+    async def close(self):
+        self.wheel.close()
+        for protocol in self._sockets:
+            protocol.transport.close()
+        self._sockets = []
+        if self._tcp is not None:
+            await self._tcp.close()
+            self._tcp = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def query(self, name: str, dns_type="A"):
+        """ Asks the name server about a name
+
+        :param name: the domain name
+        :param dns_type: the record type, as a name (eg. "A") or a number
+        :return: the response, a dnswire.Message
+        :raises asyncio.TimeoutError: if no response came after every retransmit
+        :raises ConnectionError: if the socket was closed while waiting
+        """
+        if not self._sockets:
+            await self.start()
+        question = (name.rstrip(".").lower() + ".", dnswire.type_code(dns_type))
+        async with self._slots:
+            protocol = self._sockets[self._next_socket]
+            self._next_socket = (self._next_socket + 1) % len(self._sockets)
+            message_id = _free_id(protocol.pending)
+            packet = dnswire.encode_query(name, dns_type, message_id=message_id, edns_payload=self.edns_payload)
+            pending = _PendingQuery(self.loop.create_future(), packet, question)
+            protocol.pending[message_id] = pending
+            self._send(protocol, message_id, pending)
+            try:
+                message = await pending.future
+            finally:
+                if protocol.pending.get(message_id) is pending:  # the caller was cancelled
+                    del protocol.pending[message_id]
+                    self.wheel.remove((protocol.index, message_id), pending.slot)
+        self.answered += 1
+        return message
+
+    def _send(self, protocol: _UDPSocket, message_id: int, pending: _PendingQuery):
+        protocol.transport.sendto(pending.packet)
+        self.sent += 1
+        delay = self.timeout * 2 ** (pending.attempts - 1)
+        pending.slot = self.wheel.add((protocol.index, message_id), delay,
+                                      lambda: self._expired(protocol, message_id, pending))
+
+    def _expired(self, protocol: _UDPSocket, message_id: int, pending: _PendingQuery):
+        """ Called by the timer wheel when a query has had no response in time: sends it again, or gives up """
+        if protocol.pending.get(message_id) is not pending:
+            return
+        if pending.attempts <= self.retries:
+            pending.attempts += 1
+            self.retransmits += 1
+            self._send(protocol, message_id, pending)
+            return
+        del protocol.pending[message_id]
+        self.timeouts += 1
+        if not pending.future.done():
+            pending.future.set_exception(asyncio.TimeoutError(f"No response from {self.server} for "
+                                                              f"{pending.question[0]} after {pending.attempts} tries"))
+
+    async def _ask_tcp(self, pending: _PendingQuery):
+        """ Asks a query again over TCP, after its UDP response came back truncated """
+        try:
+            await self._tcp.ask(pending)
+        except Exception as e:  # could not connect, so the caller gets the error instead of the truncated response
+            if not pending.future.done():
+                pending.future.set_exception(e)
+
+    def in_flight(self):
+        return sum(len(protocol.pending) for protocol in self._sockets) + \
+            (len(self._tcp.pending) if self._tcp is not None else 0)
+
+    def stats(self):
+        """ Returns a dictionary of how many packets were sent, answered, sent again, timed out, truncated (and asked
+        again over TCP) or dropped (late, malformed or not matching their query) """
+        return {"server": self.server, "sent": self.sent, "answered": self.answered, "retransmits": self.retransmits,
+                "timeouts": self.timeouts, "truncated": self.truncated, "dropped": self.dropped,
+                "in_flight": self.in_flight()}
+
+
+async def test_dns_client(queries: int = 20000):
+    from stubdns import StubNameServer
+
+    async with StubNameServer({f"host{i}.test": [f"10.0.{i // 256 % 256}.{i % 256}"] for i in range(1000)},
+                              drop_every=100, truncate_every=50) as stub:
+        async with DNSClient(stub.address) as client:
+            start = time.monotonic()
+            results = await asyncio.gather(*[client.query(f"host{i % 1000}.test") for i in range(queries)],
+                                           return_exceptions=True)
+            elapsed = time.monotonic() - start
+        errors = [result for result in results if isinstance(result, Exception)]
+        print(f"{queries} queries in {elapsed:.2f}s ({queries / elapsed:.0f}/s), {len(errors)} failed")
+        print(results[0].answer_data() if not isinstance(results[0], Exception) else results[0])
+        print(client.stats())
+        print(stub.stats())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(test_dns_client())
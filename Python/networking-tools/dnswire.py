@@ -0,0 +1,331 @@
+"""
+Encodes and decodes DNS messages in their wire format (RFC 1035), as sent by DoH with application/dns-message
+(RFC 8484) and by plain DNS over UDP and TCP.
+Messages are decoded straight out of a memoryview of the packet with struct.unpack_from, so nothing is copied apart
+from the names and record data that end up in the result, and compressed names are followed through their pointers.
+Encoded names are compressed too: a name, or the end of one, that is already in the message is written as a pointer
+to it.
+Record data is turned into the same strings as the JSON DoH APIs give (eg. "93.184.216.34", "example.com." or
+"10 mail.example.com."), so answers look the same whichever way they were looked up.
+"""
+
+import base64
+import socket
+import struct
+from collections import namedtuple
+
+TYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15, "TXT": 16, "AAAA": 28, "SRV": 33, "OPT": 41,
+         "CAA": 257, "ANY": 255}
+TYPE_NAMES = {code: name for name, code in TYPES.items()}
+CLASS_IN = 1
+
+HEADER = struct.Struct("!HHHHHH")  # id, flags, questions, answers, authority records, additional records
+QUESTION = struct.Struct("!HH")  # type, class
+RECORD = struct.Struct("!HHIH")  # type, class, TTL, length of the data
+SOA = struct.Struct("!IIIII")  # serial, refresh, retry, expire, minimum
+SRV = struct.Struct("!HHH")  # priority, weight, port
+UINT16 = struct.Struct("!H")
+
+FLAG_QR = 0x8000  # the message is a response
+FLAG_TC = 0x0200  # the response was truncated, ask again over TCP
+FLAG_RD = 0x0100  # recursion desired
+
+NOERROR, SERVFAIL, NXDOMAIN, REFUSED = 0, 2, 3, 5
+
+MAX_POINTERS = 64  # compression pointers followed in one name before it is taken to be a loop
+
+Question = namedtuple("Question", "name type cls")
+Record = namedtuple("Record", "name type cls ttl data")
+
+
+class DNSWireError(ValueError):
+    """ Raised when a packet is not a well formed DNS message """
+
+
+class Message:
+    """ A decoded DNS message """
+
+    def __init__(self, message_id: int = 0, flags: int = 0, questions: list = None, answers: list = None,
+                 authority: list = None, additional: list = None):
+        """
+        :param message_id: the transaction ID
+        :param flags: the header's flags, with the response code in the lowest 4 bits
+        :param questions: list of Questions
+        :param answers: list of Records
+        :param authority: list of Records, eg. the SOA record of a failed lookup
+        :param additional: list of Records
+        """
+        self.id = message_id
+        self.flags = flags
+        self.questions = questions or []
+        self.answers = answers or []
+        self.authority = authority or []
+        self.additional = additional or []
+
+    @property
+    def rcode(self):
+        """ The response code, eg. NOERROR or NXDOMAIN """
+        return self.flags & 0xF
+
+    @property
+    def truncated(self):
+        return bool(self.flags & FLAG_TC)
+
+    def answer_data(self):
+        """ Returns the data of every answer record, like the JSON DoH APIs' Answer """
+        return [record.data for record in self.answers]
+
+    def ttl(self):
+        """ Returns how long the message can be cached for: the lowest TTL of its answers, or for a failed lookup the
+        lower of the SOA record's TTL and minimum field in the authority section (RFC 2308). None if there are
+        neither """
+        if self.answers:
+            return min(record.ttl for record in self.answers)
+        ttls = []
+        for record in self.authority:
+            ttls.append(record.ttl)
+            if record.type == TYPES["SOA"]:
+                ttls.append(int(record.data.rsplit(" ", 1)[-1]))
+        return min(ttls) if ttls else None
+
+    def __repr__(self):
+        return f"Message(id={self.id}, rcode={self.rcode}, questions={self.questions}, answers={self.answers})"
+
+
+def type_code(dns_type):
+    """ Returns the numeric code of a record type given as a name (eg. "AAAA") or a number """
+    if isinstance(dns_type, int):
+        return dns_type
+    try:
+        return TYPES[dns_type.upper()]
+    except KeyError:
+        if dns_type.upper().startswith("TYPE") and dns_type[4:].isdigit():  # RFC 3597, eg. TYPE65
+            return int(dns_type[4:])
+        raise ValueError(f"Unknown record type {dns_type!r}")
+
+
+""" Decoding """
+
+
+def decode_name(packet: memoryview, offset: int):
+    """ Reads a possibly compressed name
+
+    :return: (name with a trailing dot, offset just past the name where it started)
+    """
+    labels = []
+    end = None
+    pointers = 0
+    while True:
+        try:
+            length = packet[offset]
+        except IndexError:
+            raise DNSWireError("Name runs past the end of the message") from None
+        if length >= 0xC0:  # a pointer to the rest of the name
+            if offset + 1 >= len(packet):
+                raise DNSWireError("Name runs past the end of the message")
+            pointers += 1
+            if pointers > MAX_POINTERS:
+                raise DNSWireError("Compression pointer loop")
+            if end is None:
+                end = offset + 2
+            offset = (length & 0x3F) << 8 | packet[offset + 1]
+            continue
+        if length > 63:
+            raise DNSWireError(f"Bad label length {length}")
+        offset += 1
+        if not length:
+            break
+        if offset + length > len(packet):
+            raise DNSWireError("Name runs past the end of the message")
+        labels.append(str(packet[offset:offset + length], "ascii", "backslashreplace"))
+        offset += length
+    return ".".join(labels) + ".", offset if end is None else end
+
+
+def _decode_data(packet: memoryview, offset: int, length: int, record_type: int):
+    """ Turns a record's data into the string the JSON DoH APIs would give for it """
+    end = offset + length
+    if record_type == 1 and length == 4:
+        return socket.inet_ntop(socket.AF_INET, packet[offset:end])
+    if record_type == 28 and length == 16:
+        return socket.inet_ntop(socket.AF_INET6, packet[offset:end])
+    if record_type in (2, 5, 12):  # NS, CNAME, PTR
+        return decode_name(packet, offset)[0]
+    if record_type == 15:  # MX
+        return f"{UINT16.unpack_from(packet, offset)[0]} {decode_name(packet, offset + 2)[0]}"
+    if record_type == 6:  # SOA
+        mname, offset = decode_name(packet, offset)
+        rname, offset = decode_name(packet, offset)
+        return " ".join((mname, rname, *map(str, SOA.unpack_from(packet, offset))))
+    if record_type == 33:  # SRV
+        return " ".join((*map(str, SRV.unpack_from(packet, offset)), decode_name(packet, offset + 6)[0]))
+    if record_type == 16:  # TXT, one or more length prefixed strings
+        strings = []
+        while offset < end:
+            size = packet[offset]
+            strings.append(str(packet[offset + 1:offset + 1 + size], "utf-8", "backslashreplace"))
+            offset += 1 + size
+        return "".join(strings)
+    return bytes(packet[offset:end])
+
+
+def decode_message(packet):
+    """ Decodes a DNS message
+
+    :param packet: bytes, bytearray or memoryview of the whole message
+    :return: Message
+    :raises DNSWireError: if the message is cut short or malformed
+    """
+    packet = memoryview(packet)
+    if len(packet) < HEADER.size:
+        raise DNSWireError(f"Message of {len(packet)} bytes is shorter than a header")
+    message_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(packet)
+    offset = HEADER.size
+    try:
+        questions = []
+        for _ in range(qdcount):
+            name, offset = decode_name(packet, offset)
+            questions.append(Question(name, *QUESTION.unpack_from(packet, offset)))
+            offset += QUESTION.size
+        sections = []
+        for count in (ancount, nscount, arcount):
+            records = []
+            for _ in range(count):
+                name, offset = decode_name(packet, offset)
+                record_type, cls, ttl, length = RECORD.unpack_from(packet, offset)
+                offset += RECORD.size
+                if offset + length > len(packet):
+                    raise DNSWireError("Record data runs past the end of the message")
+                data = _decode_data(packet, offset, length, record_type) if record_type != 41 else None
+                records.append(Record(name, record_type, cls, ttl, data))
+                offset += length
+            sections.append(records)
+    except struct.error as e:
+        raise DNSWireError(f"Message is cut short: {e}") from None
+    return Message(message_id, flags, questions, *sections)
+
+
+def peek_id(packet):
+    """ Returns the transaction ID of a message without decoding it """
+    return UINT16.unpack_from(packet)[0]
+
+
+""" Encoding """
+
+
+class Encoder:
+    """ Writes a DNS message into a bytearray, compressing names against the ones already written """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._names = dict()  # {lowercase name or end of one: offset it was written at}
+
+    def write_name(self, name: str):
+        labels = [label for label in name.rstrip(".").split(".") if label] if name not in ("", ".") else []
+        for i in range(len(labels)):
+            suffix = ".".join(labels[i:]).lower()
+            offset = self._names.get(suffix)
+            if offset is not None:
+                self.buffer += UINT16.pack(0xC000 | offset)
+                return
+            if len(self.buffer) < 0x4000:  # pointers can only reach the first 16KB
+                self._names[suffix] = len(self.buffer)
+            label = labels[i].encode("idna" if not labels[i].isascii() else "ascii")
+            if len(label) > 63:
+                raise DNSWireError(f"Label {labels[i]!r} is longer than 63 bytes")
+            self.buffer.append(len(label))
+            self.buffer += label
+        self.buffer.append(0)
+
+    def write_header(self, message_id: int, flags: int, qdcount: int, ancount: int = 0, nscount: int = 0,
+                     arcount: int = 0):
+        self.buffer += HEADER.pack(message_id, flags, qdcount, ancount, nscount, arcount)
+
+    def write_question(self, name: str, dns_type, cls: int = CLASS_IN):
+        self.write_name(name)
+        self.buffer += QUESTION.pack(type_code(dns_type), cls)
+
+    def write_record(self, name: str, dns_type, ttl: int, data, cls: int = CLASS_IN):
+        """ Writes a resource record. data is given the way decode_message returns it, eg. "93.184.216.34" for an A
+        record, "10 mail.example.com." for an MX record, or bytes for any record type """
+        record_type = type_code(dns_type)
+        self.write_name(name)
+        self.buffer += RECORD.pack(record_type, cls, ttl, 0)
+        start = len(self.buffer)
+        self._write_data(record_type, data)
+        UINT16.pack_into(self.buffer, start - 2, len(self.buffer) - start)
+
+    def write_opt(self, payload_size: int):
+        """ Writes an EDNS(0) OPT record (RFC 6891), telling the server how large a UDP response we can take """
+        self.buffer += b"\x00" + RECORD.pack(TYPES["OPT"], payload_size, 0, 0)
+
+    def _write_data(self, record_type: int, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.buffer += data
+        elif record_type == 1:
+            self.buffer += socket.inet_pton(socket.AF_INET, data)
+        elif record_type == 28:
+            self.buffer += socket.inet_pton(socket.AF_INET6, data)
+        elif record_type in (2, 5, 12):
+            self.write_name(data)
+        elif record_type == 15:
+            preference, exchange = data.split()
+            self.buffer += UINT16.pack(int(preference))
+            self.write_name(exchange)
+        elif record_type == 6:
+            mname, rname, *fields = data.split()
+            self.write_name(mname)
+            self.write_name(rname)
+            self.buffer += SOA.pack(*map(int, fields))
+        elif record_type == 33:
+            *fields, target = data.split()
+            self.buffer += SRV.pack(*map(int, fields))
+            self.write_name(target)
+        elif record_type == 16:
+            text = data.encode()
+            for i in range(0, len(text), 255):
+                chunk = text[i:i + 255]
+                self.buffer.append(len(chunk))
+                self.buffer += chunk
+        else:
+            raise DNSWireError(f"Can not encode data of record type {record_type} from {data!r}, give it as bytes")
+
+
+def encode_query(name: str, dns_type="A", *, message_id: int = 0, recursion_desired: bool = True,
+                 edns_payload: int = None):
+    """ Encodes a query for one name
+
+    :param name: the domain name
+    :param dns_type: the record type, as a name (eg. "A") or a number
+    :param message_id: the transaction ID. RFC 8484 asks DoH clients to use 0, so responses can be HTTP cached
+    :param recursion_desired: ask the server to resolve the name fully
+    :param edns_payload: add an EDNS(0) OPT record advertising this UDP payload size, eg. 1232
+    :return: bytes of the query
+    """
+    encoder = Encoder()
+    encoder.write_header(message_id, FLAG_RD if recursion_desired else 0, 1, arcount=1 if edns_payload else 0)
+    encoder.write_question(name, dns_type)
+    if edns_payload:
+        encoder.write_opt(edns_payload)
+    return bytes(encoder.buffer)
+
+
+def encode_message(message: Message):
+    """ Encodes a whole message, eg. a response for a stub name server. Records' data is given the way decode_message
+    returns it. OPT records in the additional section are written from their class (the payload size) """
+    encoder = Encoder()
+    encoder.write_header(message.id, message.flags, len(message.questions), len(message.answers),
+                         len(message.authority), len(message.additional))
+    for question in message.questions:
+        encoder.write_question(question.name, question.type, question.cls)
+    for record in (*message.answers, *message.authority, *message.additional):
+        if record.type == TYPES["OPT"]:
+            encoder.write_opt(record.cls)
+        else:
+            encoder.write_record(record.name, record.type, record.ttl, record.data, record.cls)
+    return bytes(encoder.buffer)
+
+
+def doh_get_param(query: bytes):
+    """ Returns the dns parameter of an RFC 8484 GET request: the query in unpadded base64url """
+    return base64.urlsafe_b64encode(query).rstrip(b"=").decode("ascii")
@@ -0,0 +1,294 @@
+"""
+A cache of IP lookup results (eg. ip-api's geolocation), shared by every IPResolver that is given it.
+IPv4 results are kept as sorted, non-overlapping ranges of integer IPs, so a lookup is a binary search, and with
+aggregate=24 one result answers for its whole /24, since neighbouring addresses are almost always in the same place.
+Every range is 16 bytes (start, end, result and expiry as uint32s) and identical results are only stored once.
+Entries expire after a TTL, and save()/load() keep the cache in a snapshot file that is memory mapped on load, so a warm
+cache of millions of ranges is ready straight away instead of being parsed.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import compress
+from ipaddress import ip_address
+
+DEFAULT_TTL = 86400  # geolocation rarely changes, so cache results for a day
+SNAPSHOT_MAGIC = b"IPC1"
+SNAPSHOT_HEADER = struct.Struct("<4sII")  # magic, number of IPv4 ranges, bytes of JSON after the ranges
+
+
+class IPCache:
+    """ Caches IP lookup results by integer IP until their TTL runs out. Not thread-safe. """
+
+    def __init__(self, maxsize: int = 65536, *, ttl: int or float = DEFAULT_TTL, aggregate: int = None):
+        """
+        :param maxsize: maximum ranges (and IPv6 addresses) to keep. The ones closest to expiring are evicted first
+        :param ttl: seconds to cache results for
+        :param aggregate: prefix length to cache IPv4 results for, eg. 24 to answer for the result's whole /24. None
+        caches every IP on its own
+        """
+        self.maxsize = max(maxsize, 0)
+        self.ttl = ttl
+        self.aggregate = aggregate
+        # IPv4 ranges, sorted by start: starts[i] to ends[i] (inclusive) has the result results[values[i]] until
+        # expires[i] (unix time). Memoryviews of a snapshot after load(), until the first change
+        self._starts = array("I")
+        self._ends = array("I")
+        self._values = array("I")
+        self._expires = array("I")
+        self._mmap = None
+        self._v6 = OrderedDict()  # {integer IPv6 address: (expires, value)}
+        self.results = []  # every distinct result, without its "query" field
+        self._result_ids = dict()  # {result as JSON: index in self.results}
+        self.hits = self.misses = self.evictions = 0
+
+    def _result_id(self, result: dict):
+        key = _result_key(result)
+        value = self._result_ids.get(key)
+        if value is None:
+            value = self._result_ids[key] = len(self.results)
+            self.results.append(result)
+        return value
+
+    def _range(self, address: int, prefix: int = None):
+        """ Returns the (start, end) of the range an IPv4 address is cached as """
+        prefix = self.aggregate if prefix is None else prefix
+        if prefix is None or prefix >= 32:
+            return address, address
+        host_bits = (1 << (32 - prefix)) - 1
+        return address & ~host_bits & 0xFFFFFFFF, address | host_bits
+
+    def get(self, ip: str):
+        """ Returns the cached result of an IP (with "query" set to the IP), or None if there is no fresh one """
+        try:
+            address = ip_address(ip)
+        except ValueError:
+            return None
+        now = time.time()
+        value = None
+        if address.version == 4:
+            address = int(address)
+            index = bisect_right(self._starts, address) - 1
+            if index >= 0 and self._ends[index] >= address and self._expires[index] > now:
+                value = self._values[index]
+        else:
+            entry = self._v6.get(int(address))
+            if entry is not None and entry[0] > now:
+                value = entry[1]
+                self._v6.move_to_end(int(address))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(self.results[value], query=ip)
+
+    def set(self, ip: str, result: dict, ttl: int or float = None, prefix: int = None):
+        """ Caches the result of an IP for ttl seconds, replacing any cached ranges it overlaps
+
+        :param ip: the IP that was looked up
+        :param result: its result, eg. ip-api's {"status": "success", "countryCode": "US", "query": ip}
+        :param ttl: seconds to cache it for, defaults to the cache's ttl
+        :param prefix: prefix length to cache an IPv4 result for, defaults to the cache's aggregate
+        """
+        try:
+            address = ip_address(ip)
+        except ValueError:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or not self.maxsize:
+            return
+        expires = min(int(time.time() + ttl), 0xFFFFFFFF)
+        value = self._result_id({key: field for key, field in result.items() if key != "query"})
+        if address.version == 6:
+            self._v6[int(address)] = (expires, value)
+            self._v6.move_to_end(int(address))
+        else:
+            self._make_writable()
+            start, end = self._range(int(address), prefix)
+            first = bisect_right(self._starts, start) - 1
+            if first < 0 or self._ends[first] < start:
+                first += 1
+            last = bisect_right(self._starts, end)  # ranges first to last - 1 overlap the new one
+            ranges = [(start, end, value, expires)]
+            if first < last and self._starts[first] < start:  # keep the parts of the overlapped ranges either side
+                ranges.insert(0, (self._starts[first], start - 1, self._values[first], self._expires[first]))
+            if first < last and self._ends[last - 1] > end:
+                ranges.append((end + 1, self._ends[last - 1], self._values[last - 1], self._expires[last - 1]))
+            for column, items in zip((self._starts, self._ends, self._values, self._expires), zip(*ranges)):
+                column[first:last] = array("I", items)
+        if len(self) > self.maxsize:
+            self._evict()
+
+    def _make_writable(self):
+        """ Copies the ranges of a memory mapped snapshot into arrays, so they can be changed """
+        if self._mmap is None:
+            return
+        columns = []
+        for view in (self._starts, self._ends, self._values, self._expires):
+            column = array("I")
+            column.frombytes(view.cast("B"))
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            view.release()
+        self._starts, self._ends, self._values, self._expires = columns
+        self._mmap.close()
+        self._mmap = None
+
+    def _keep(self, mask):
+        """ Drops every IPv4 range whose item of mask (a sequence of a bool per range) is False. The columns are
+        filtered by itertools.compress, so they are copied in C instead of an index at a time """
+        self._make_writable()
+        self._starts, self._ends, self._values, self._expires = (
+            array("I", compress(column, mask)) for column in (self._starts, self._ends, self._values, self._expires))
+
+    def _evict(self):
+        """ Drops the expired entries, and then the tenth of the entries closest to expiring if there are still too
+        many. A tenth at a time, so evicting (which copies every range) does not happen on every set() """
+        self.purge()
+        if len(self) <= self.maxsize:
+            return
+        drop = len(self) - self.maxsize * 9 // 10
+        # expiries are whole seconds and a batch of results shares one, so exactly drop entries are picked by index
+        # (a stable sort, so ties go IPv4 by address, then IPv6 least recently used first) instead of by a cutoff time
+        ipv4 = len(self._expires)
+        v6_entries = list(self._v6.items())
+        everything = list(self._expires) + [expires for _, (expires, _) in v6_entries]
+        mask = bytearray(b"\x01") * ipv4
+        for index in sorted(range(len(everything)), key=everything.__getitem__)[:drop]:
+            if index < ipv4:
+                mask[index] = 0
+            else:
+                del self._v6[v6_entries[index - ipv4][0]]
+        self._keep(mask)
+        self.evictions += drop
+
+    def purge(self):
+        """ Drops every expired entry """
+        now = time.time()
+        if self._expires and min(self._expires) <= now:
+            self._keep(bytes(expires > now for expires in self._expires))
+        for address in [address for address, (expires, _) in self._v6.items() if expires <= now]:
+            del self._v6[address]
+
+    def clear(self):
+        self._make_writable()
+        for column in (self._starts, self._ends, self._values, self._expires):
+            del column[:]
+        self._v6.clear()
+        self.results.clear()
+        self._result_ids.clear()
+
+    def save(self, path: str):
+        """ Writes the fresh entries to a snapshot file: the IPv4 ranges as four little endian uint32 arrays, followed
+        by the distinct results and the IPv6 entries as JSON. Written to a temporary file first, so a crash never
+        leaves half a snapshot """
+        self.purge()
+        trailer = json.dumps({"results": self.results,
+                              "v6": [[str(address), expires, value] for address, (expires, value) in self._v6.items()]
+                              }).encode()
+        with open(path + ".tmp", "wb") as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(self._starts), len(trailer)))
+            for column in (self._starts, self._ends, self._values, self._expires):
+                column = array("I", column)
+                if sys.byteorder == "big":
+                    column.byteswap()
+                file.write(column.tobytes())
+            file.write(trailer)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str, maxsize: int = 65536, **kwargs):
+        """ Returns a cache with the entries of a snapshot file written by save(). The IPv4 ranges are memory mapped
+        and searched in place, and only copied into memory once the cache is changed
+
+        :param path: the snapshot file
+        :param maxsize: and the other keyword arguments are IPCache's
+        :raises ValueError: if the file is not a snapshot
+        """
+        cache = cls(maxsize, **kwargs)
+        with open(path, "rb") as file:
+            header = file.read(SNAPSHOT_HEADER.size)
+            if len(header) < SNAPSHOT_HEADER.size or header[:4] != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not an IP cache snapshot")
+            _, count, trailer_size = SNAPSHOT_HEADER.unpack(header)
+            if count == 0:
+                trailer = json.loads(file.read(trailer_size))
+            else:
+                cache._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(cache._mmap)
+                offset = SNAPSHOT_HEADER.size
+                columns = []
+                for _ in range(4):
+                    columns.append(view[offset:offset + 4 * count].cast("I"))
+                    offset += 4 * count
+                trailer = json.loads(bytes(view[offset:offset + trailer_size]))
+                view.release()
+                cache._starts, cache._ends, cache._values, cache._expires = columns
+                if sys.byteorder == "big":  # the arrays are little endian, so they can not be used in place
+                    cache._make_writable()
+        cache.results = trailer["results"]
+        cache._result_ids = {_result_key(result): value for value, result in enumerate(cache.results)}
+        for address, expires, value in trailer["v6"]:
+            cache._v6[int(address)] = (expires, value)
+        return cache
+
+    def close(self):
+        """ Releases the memory mapped snapshot, if there is one, keeping its entries """
+        self._make_writable()
+
+    def stats(self):
+        """ Returns a dictionary of the cache's size, hit rate and evictions """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "maxsize": self.maxsize,
+            "distinct_results": len(self.results),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._starts) + len(self._v6)
+
+
+def _result_key(result: dict):
+    """ Returns a hashable key of a result, the same for equal results """
+    try:
+        return tuple(sorted(result.items()))
+    except TypeError:  # some fields are not hashable (or comparable)
+        return json.dumps(result, sort_keys=True)
+
+
+def test_eviction():
+    # a batch of results is cached at once, so they share one expiry second
+    cache = IPCache(100)
+    for i in range(500):
+        cache.set(f"10.0.{i // 256}.{i % 256}", {"status": "success", "countryCode": "US"})
+        assert len(cache) == (i + 1 if i < 100 else 90 + (i - 100) % 11), (i, len(cache))
+    assert cache.evictions == 500 - len(cache)
+    assert cache.get("10.0.1.243") is not None  # the last one set is kept
+
+    # the entries closest to expiring go first, IPv6 ones included
+    cache = IPCache(10)
+    for i in range(5):
+        cache.set(f"10.1.0.{i}", {"status": "success"}, ttl=60)
+        cache.set(f"2001:db8::{i}", {"status": "success"}, ttl=3600)
+    cache.set("10.1.0.5", {"status": "success"}, ttl=3600)
+    assert len(cache) == 9 and cache.evictions == 2
+    assert cache.get("10.1.0.0") is None and cache.get("10.1.0.1") is None and cache.get("10.1.0.2") is not None
+    assert all(cache.get(f"2001:db8::{i}") is not None for i in range(5))
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    test_eviction()
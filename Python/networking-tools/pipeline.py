@@ -0,0 +1,225 @@
+"""
+Resolves domains and geolocates their IPs in one streaming pipeline, writing one NDJSON record per (domain, IP).
+Domains are read as a stream (from stdin or a file) and resolved by DNSResolver.stream_query, their IPs go straight on
+to IPResolver.stream_query_ip_api, which sends a batch to ip-api once it fills, or once its first IP has waited linger
+seconds (1 by default, see --linger), and every result is written out as soon as its batch comes back. So records of
+a slow input, eg. tail -f domains | python pipeline.py, come out at most about linger seconds (plus the lookups) after
+their domain is written. The stages are joined by bounded queues, so they run at the same time instead of one after the
+other, and a slow stage slows down the ones before it instead of filling memory.
+
+Usage:
+python pipeline.py [domains file, defaults to stdin] [--output file] [--transport doh|wire|dns|raw] ...
+(see python pipeline.py --help)
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from ipaddress import ip_address
+
+from DNSResolver import DNSResolver, DNS_ENDPOINTS, DOH_REST_ENDPOINTS, DOH_WIRE_ENDPOINTS
+from IPResolver import IPResolver, IP_REST_ENDPOINTS, IP_API_BATCH_SIZE, _ip_key
+from dnscache import DNSCache
+from ipcache import IPCache
+
+DEFAULT_FIELDS = "status,message,country,countryCode,regionName,city,lat,lon,isp,org,as,query"
+QUEUE_SIZE = 1000  # items each queue between two stages can hold
+_DONE = object()  # put on a queue once its stage has finished
+
+
+class GeoPipeline:
+    """ Streams domains through DNSResolver and IPResolver, yielding a record per (domain, IP) """
+
+    def __init__(self, dns_resolver: DNSResolver, ip_resolver: IPResolver, *, dns_type: str = "A", doh: bool = True,
+                 dns_concurrency: int = 100, rate=20, max_tokens=20, batch_size: int = IP_API_BATCH_SIZE,
+                 ip_concurrency: int = 2, fields: str = DEFAULT_FIELDS, queue_size: int = QUEUE_SIZE,
+                 linger: float = 1.0):
+        """
+        :param dns_resolver: started DNSResolver to resolve the domains with
+        :param ip_resolver: started IPResolver to geolocate the IPs with
+        :param dns_type: record type to look up, "A" or "AAAA"
+        :param doh: resolve over DoH, or over traditional DNS if False
+        :param dns_concurrency: maximum DNS lookups in flight at once
+        :param rate: maximum DoH requests per second
+        :param max_tokens: maximum DoH requests in a burst
+        :param batch_size: IPs per ip-api batch request
+        :param ip_concurrency: maximum ip-api batches in flight at once
+        :param fields: the fields ip-api should return for every IP
+        :param queue_size: IPs (and records) that can wait between two stages before the stage before them waits too
+        :param linger: seconds an IP waits for its ip-api batch to fill up before a partial batch is sent, or None to
+        only send full batches (and the last one)
+        """
+        self.dns_resolver = dns_resolver
+        self.ip_resolver = ip_resolver
+        self.dns_options = {"dns_type": dns_type, "doh": doh, "concurrency": dns_concurrency, "rate": rate,
+                            "max_tokens": max_tokens}
+        self.ip_options = {"batch_size": batch_size, "concurrency": ip_concurrency, "fields": fields,
+                           "linger": linger}
+        self.queue_size = queue_size
+        self.domains = self.unresolved = self.ips = self.records = 0
+
+    async def run(self, domains):
+        """ Resolves and geolocates domains from any iterable or async iterable, yielding a record per (domain, IP) as
+        soon as it is ready. Leaving the loop early stops every stage.
+
+        :param domains: iterable or async iterable of domains. Whitespace around them and blank lines are skipped
+        :return: async generator of {"domain", "ip", "dns_server", "geo"} dictionaries, where geo is ip-api's result.
+        Domains without an IP get a single record with "ip" None and an "error"
+        """
+        loop = asyncio.get_running_loop()
+        ip_queue = asyncio.Queue(self.queue_size)
+        records = asyncio.Queue(self.queue_size)
+        waiting = defaultdict(list)  # {IP's key: [(domain, server)] waiting for the IP's result}
+
+        async def resolve():
+            async for domain, answers, _, server in self.dns_resolver.stream_query(domains, **self.dns_options):
+                self.domains += 1
+                ips = [answer for answer in answers or [] if _is_ip(answer)]  # leave out the CNAME chain
+                if not ips:
+                    self.unresolved += 1
+                    await records.put({"domain": domain, "ip": None, "dns_server": server,
+                                       "error": "no addresses" if answers is not None else "not resolved"})
+                for ip in ips:
+                    key = _ip_key(ip)
+                    waiting[key].append((domain, server))
+                    if len(waiting[key]) == 1:  # otherwise its result is already on the way
+                        self.ips += 1
+                        await ip_queue.put(ip)
+            await ip_queue.put(_DONE)
+
+        async def geolocate():
+            # every IP is only sent once at a time, and the ones seen before are answered from the IPResolver's cache
+            async for result in self.ip_resolver.stream_query_ip_api(_drain(ip_queue), dedupe=False,
+                                                                     **self.ip_options):
+                for domain, server in waiting.pop(_ip_key(result.get("query")), ()):
+                    await records.put({"domain": domain, "ip": result.get("query"), "dns_server": server,
+                                       "geo": result})
+            await records.put(_DONE)
+
+        async def stage(coroutine):
+            try:
+                await coroutine
+            except Exception as e:  # handed to the consumer, so it is raised where the records are read
+                await records.put(e)
+
+        tasks = [loop.create_task(stage(resolve())), loop.create_task(stage(geolocate()))]
+        try:
+            while True:
+                record = await records.get()
+                if record is _DONE:
+                    break
+                if isinstance(record, Exception):
+                    raise record
+                self.records += 1
+                yield record
+        finally:  # finished, the consumer stopped early, or something went wrong
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {"domains": self.domains, "unresolved": self.unresolved, "ips": self.ips, "records": self.records,
+                "dns": self.dns_resolver.stats(), "ip": self.ip_resolver.stats()}
+
+
+def _is_ip(answer):
+    try:
+        ip_address(answer)
+    except ValueError:
+        return False
+    return True
+
+
+async def _drain(queue: asyncio.Queue):
+    """ Yields the items of a queue until the stage before it is done """
+    while True:
+        item = await queue.get()
+        if item is _DONE:
+            return
+        yield item
+
+
+async def read_lines(stream, size_hint: int = 65536):
+    """ Reads the lines of a blocking file or stdin on a thread, so the event loop keeps running while it waits for
+    more input. Regular files are read about size_hint bytes at a time, and pipes and terminals a line at a time, so
+    a domain written to a pipe is passed on to the DNS stage as soon as the line is complete (how long its records
+    take after that is up to the stages, see GeoPipeline's linger) """
+    loop = asyncio.get_running_loop()
+    if stream.seekable():
+        read = lambda: stream.readlines(size_hint)
+    else:
+        read = lambda: [line for line in (stream.readline(),) if line]
+    while True:
+        lines = await loop.run_in_executor(None, read)
+        if not lines:
+            return
+        for line in lines:
+            yield line
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Resolve domains and geolocate their IPs, writing NDJSON records")
+    parser.add_argument("input", nargs="?", default="-", help="file of domains, one per line (default: stdin)")
+    parser.add_argument("--output", "-o", default="-", help="NDJSON file to write (default: stdout)")
+    parser.add_argument("--transport", choices=("doh", "wire", "dns", "raw"), default="doh",
+                        help="DoH with JSON, DoH with RFC 8484 messages, DNS with aiodns, or DNS with the multiplexed "
+                             "UDP client (default: doh)")
+    parser.add_argument("--name-servers", help="comma separated DNS name servers, eg. 1.1.1.1,8.8.8.8:53")
+    parser.add_argument("--dns-type", choices=("A", "AAAA"), default="A")
+    parser.add_argument("--dns-concurrency", type=int, default=100, help="DNS lookups in flight at once")
+    parser.add_argument("--rate", type=float, default=20, help="DoH requests per second")
+    parser.add_argument("--batch-size", type=int, default=IP_API_BATCH_SIZE, help="IPs per ip-api batch")
+    parser.add_argument("--ip-concurrency", type=int, default=2, help="ip-api batches in flight at once")
+    parser.add_argument("--linger", type=float, default=1.0,
+                        help="seconds an IP waits for its ip-api batch to fill before a partial batch is sent "
+                             "(default: 1, 0 sends what is there whenever the input pauses)")
+    parser.add_argument("--fields", default=DEFAULT_FIELDS, help="fields ip-api returns for every IP")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="items held between two stages")
+    parser.add_argument("--dns-cache", help="SQLite file to keep DNS answers in between runs")
+    parser.add_argument("--ip-cache", help="snapshot file to load geolocation results from and save them to")
+    parser.add_argument("--stats", action="store_true", help="print the stages' statistics to stderr at the end")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    return parser.parse_args(args)
+
+
+async def main(options):
+    name_servers = options.name_servers.split(",") if options.name_servers else DNS_ENDPOINTS
+    doh_endpoints = {"doh": DOH_REST_ENDPOINTS, "wire": DOH_WIRE_ENDPOINTS}.get(options.transport, [])
+    dns_cache = DNSCache(path=options.dns_cache) if options.dns_cache else None
+    ip_cache = IPCache.load(options.ip_cache) if options.ip_cache and os.path.exists(options.ip_cache) else None
+    input_stream = sys.stdin if options.input == "-" else open(options.input)
+    output = sys.stdout if options.output == "-" else open(options.output, "w")
+    start = time.monotonic()
+    try:
+        async with DNSResolver(name_servers, doh_endpoints, cache=dns_cache, raw_dns=options.transport == "raw") \
+                as dns_resolver, IPResolver(IP_REST_ENDPOINTS, cache=ip_cache) as ip_resolver:
+            pipeline = GeoPipeline(dns_resolver, ip_resolver, dns_type=options.dns_type,
+                                   doh=options.transport in ("doh", "wire"), dns_concurrency=options.dns_concurrency,
+                                   rate=options.rate, max_tokens=max(int(options.rate), 1),
+                                   batch_size=options.batch_size, ip_concurrency=options.ip_concurrency,
+                                   fields=options.fields, queue_size=options.queue_size, linger=options.linger)
+            async for record in pipeline.run(read_lines(input_stream)):
+                output.write(json.dumps(record, separators=(",", ":")) + "\n")
+            if options.ip_cache:
+                ip_resolver.cache.save(options.ip_cache)
+            if options.stats:
+                print(json.dumps(pipeline.stats(), default=str), file=sys.stderr)
+    finally:
+        output.flush()
+        if output is not sys.stdout:
+            output.close()
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if dns_cache is not None:
+            dns_cache.close()
+    logging.info(f"Done in {time.monotonic() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    logging.basicConfig(level=logging.INFO if arguments.verbose else logging.WARNING)
+    asyncio.run(main(arguments))
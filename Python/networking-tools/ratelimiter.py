@@ -3,98 +3,627 @@ Using code made by Quentin Pradet (https://github.com/pquentin)/ . Full credits
 Code from https://gist.github.com/pquentin/5d8f5408cdad73e589d85ba509091741, discussed in
 https://quentin.pradet.me/blog/how-do-you-rate-limit-calls-with-aiohttp.html.
 Much thanks for their extremely useful code and clear explanation.
+
+The token buckets no longer poll: when a bucket is empty, the exact time its next token is available is worked out,
+and callers wait in line (first come, first served) for a single timer to hand the tokens out.
+The limits also follow the server's quota headers and back off when it says we are going too fast, see RateLimiter.
+SharedTokenBucket and BudgetedClient keep a budget that several processes (eg. the workers of a ShardedRunner) take
+their requests out of together.
 """
 
 import asyncio
+import multiprocessing
+import threading
 import time
 import logging
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 START = time.monotonic()
 
 
+def url_host(url):
+    """ Returns the host (and port, if given) of a url, which is what requests are rate limited by """
+    return urlsplit(str(url)).netloc.lower()
+
+
+async def iterate(items):
+    """ Iterates over an iterable or an async iterable, so bulk lookups can take either (eg. a list, or lines read from
+    a file as they come) """
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def map_as_completed(items, start, concurrency: int):
+    """ Runs start(item) as a task for every item of an iterable or async iterable, keeping at most concurrency tasks in
+    flight, and yields each task's result as soon as it finishes, in whatever order that is.
+    The next item is read in a task of its own while the others run, so a slow source never holds finished results
+    back, and only once there is room for another task, so memory stays flat however many items there are. Leaving the
+    loop early cancels the tasks in flight.
+
+    :param items: iterable or async iterable
+    :param start: function of an item that returns the coroutine to run for it, or None to skip the item
+    :param concurrency: maximum tasks in flight at once
+    """
+    loop = asyncio.get_running_loop()
+    source = iterate(items)
+    reading = None  # task reading the next item
+    in_flight = set()
+    try:
+        while True:
+            if reading is None and source is not None and len(in_flight) < concurrency:
+                reading = asyncio.ensure_future(source.__anext__())
+            if reading is None and not in_flight:
+                return
+            done, _ = await asyncio.wait(in_flight | {reading} if reading is not None else in_flight,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if reading in done:
+                task, reading = reading, None
+                try:
+                    item = task.result()
+                except StopAsyncIteration:
+                    source = None
+                else:
+                    coroutine = start(item)
+                    if coroutine is not None:
+                        in_flight.add(loop.create_task(coroutine))
+            finished = done & in_flight
+            in_flight -= finished
+            for task in finished:
+                yield task.result()
+    finally:  # the consumer stopped early, or something went wrong
+        for task in in_flight:
+            task.cancel()
+        if reading is not None:
+            reading.cancel()
+
+
+class TokenBucket:
+    """ A token bucket for one host. Callers that find it empty wait in a FIFO queue, and are woken one by one by a
+    single timer that fires exactly when the next token is available. Not thread-safe, use it from one event loop """
+
+    def __init__(self, rate: int or float, max_tokens: int or float):
+        """
+        :param rate: tokens added per second
+        :param max_tokens: most tokens the bucket can hold, ie. the largest burst of requests
+        """
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated_at = None  # loop.time() of the last refill, set on first use
+        self._waiters = deque()  # futures of callers waiting for a token, in arrival order
+        self._timer = None  # the asyncio.TimerHandle that wakes the first waiter
+        self.waited = 0.0  # total seconds callers spent waiting for tokens
+        self.acquired = 0
+        self.max_rate = self.min_rate = self.step = rate  # bounds and step of RateLimiter's rate adjustments
+
+    def _refill(self, now):
+        if self.updated_at is not None:
+            self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.max_tokens)
+        self.updated_at = now
+
+    def next_token_at(self):
+        """ Returns the loop.time() at which the bucket will next hold a whole token """
+        return self.updated_at + max(1 - self.tokens, 0) / self.rate
+
+    async def acquire(self):
+        """ Takes a token, waiting in line for one if the bucket is empty """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._refill(now)
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self.acquired += 1
+            return
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        self._schedule(loop)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # the token was handed over just as the caller was cancelled, so give it back for the next in line
+            if waiter.done() and not waiter.cancelled():
+                self.tokens += 1
+                self._schedule(loop)
+            raise
+        self.waited += loop.time() - now
+        self.acquired += 1
+
+    def set_rate(self, rate: int or float):
+        """ Changes how fast tokens are added. Tokens earned so far are counted at the old rate, and the timer is reset
+        so waiters are woken at the new rate """
+        loop = asyncio.get_running_loop()
+        self._refill(loop.time())
+        self.rate = rate
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._schedule(loop)
+
+    def _schedule(self, loop):
+        """ Sets the timer for the next token, unless it is already set or nobody is waiting """
+        if self._timer is None and self._waiters:
+            self._timer = loop.call_at(self.next_token_at(), self._wake, loop)
+
+    def _wake(self, loop):
+        """ Hands out every token that is available to the waiters at the front of the line, then sets the timer for
+        the next token if anyone is still waiting """
+        self._timer = None
+        self._refill(loop.time())
+        while self._waiters and self.tokens >= 1 - 1e-9:  # allow for the timer firing a hair early
+            waiter = self._waiters.popleft()
+            if waiter.done():  # cancelled while waiting
+                continue
+            self.tokens = max(self.tokens - 1, 0.0)
+            waiter.set_result(None)
+        while self._waiters and self._waiters[0].done():
+            self._waiters.popleft()
+        self._schedule(loop)
+
+    def __len__(self):
+        """ Returns the number of callers waiting for a token """
+        return len(self._waiters)
+
+
+def retry_after_seconds(value: str):
+    """ Parses a Retry-After header, which is either a number of seconds or an HTTP date, into seconds from now """
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        when = parsedate_to_datetime(value)  # raises ValueError (TypeError on older pythons) if it is not a date
+        return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+# {header: type} of the quota headers read from every response. X-Rl is the requests left in the current window, X-Ttl
+# the seconds until the window resets (ip-api's names), and Retry-After how long to back off for after a 429/503
+QUOTA_HEADERS = {
+    "X-Rl": int,
+    "X-Ttl": int,
+    "Retry-After": retry_after_seconds,
+}
+THROTTLE_STATUSES = (429, 503)  # statuses that mean we are going too fast
+
+
+def parse_headers(headers, types: dict):
+    """ Returns {header: value} of the headers in types that are present and parse with their type """
+    values = dict()
+    for name, parse in types.items():
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            values[name] = parse(value)
+        except (TypeError, ValueError):
+            logging.warning(f"Could not parse {name}: {value!r}")
+    return values
+
+
+class Quota:
+    """ A host's request quota: how many requests are left before the quota window resets, and when it does """
+
+    def __init__(self, limit: int, window: int or float):
+        self.limit = limit  # requests allowed per window, the quota is refilled to this
+        self.limit_known = False  # False while limit is only the guess we were given
+        self.window = window  # seconds a window lasts, used until the server tells us when it resets
+        self.remaining = limit
+        self.reset_at = None  # time.monotonic() when the window resets, set on first use
+        self.in_flight = 0  # requests sent that have not been answered yet
+        self.throttled = 0.0  # total seconds callers spent waiting for the quota to reset
+        self.throttles = 0  # calls that had to wait for the quota to reset
+        self.rejected = 0  # responses that said we went too fast (429/503)
+        self.probed = None  # asyncio.Event set once the first request has been answered, see RateLimiter.wait_for_ttl
+
+
+class _ObservedRequest:
+    """ Wraps the request returned by client.get()/post()/put(), so the rate limiter sees the response whether it is
+    awaited or used as 'async with' """
+
+    def __init__(self, limiter, host: str, request):
+        self._limiter = limiter
+        self._host = host
+        self._request = request
+
+    async def _send(self, send):
+        quota = self._limiter.quota(self._host)
+        quota.in_flight += 1
+        try:
+            response = await send()
+            self._limiter.observe(self._host, response)
+            return response
+        finally:
+            quota.in_flight -= 1
+            quota.probed.set()
+
+    def __await__(self):
+        return self._send(lambda: self._request).__await__()
+
+    async def __aenter__(self):
+        return await self._send(self._request.__aenter__)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._request.__aexit__(exc_type, exc, tb)
+
+
 class RateLimiter:
     """Rate limits an HTTP client that would make get() and post() calls.
-    Calls are rate-limited by host.
+    Calls are rate-limited by host: each host gets its own token bucket and quota.
     https://quentin.pradet.me/blog/how-do-you-rate-limit-calls-with-aiohttp.html
-    This class is not thread-safe."""
 
-    def __init__(self, client, *, rate: int or float = 1, max_tokens: int = 10, x_ttl: int or float = 60, x_rl: int = 1500):
+    The limits adapt to what the server says. Every response's quota headers (X-Rl, X-Ttl and Retry-After by default)
+    update the host's quota, so requests wait for the quota window to reset instead of being sent and rejected. The
+    request rate is adjusted AIMD style: each successful response adds a little to it (up to max_rate), and each 429
+    or 503 halves it and pauses the host for as long as the server asked.
+    This class is not thread-safe, see ThreadSafeRateLimiter for that."""
+
+    def __init__(self, client, *, rate: int or float = 1, max_tokens: int = 10, x_ttl: int or float = 60,
+                 x_rl: int = 1500, host_limits: dict = None, response_headers: dict = None,
+                 max_rate: int or float = None, min_rate: int or float = None, increase: float = 0.1,
+                 decrease: float = 0.5):
         """
         :param client: aiohttp client
-        :param rate: maximum requests per second
-        :param max_tokens: maximum open requests at any time
+        :param rate: maximum requests per second, per host, to start with
+        :param max_tokens: maximum open requests at any time, per host
+        :param x_ttl: seconds a quota window lasts, until the server says otherwise
+        :param x_rl: requests allowed per quota window, until the server says otherwise
+        :param host_limits: optional {host: (rate, max_tokens)} for hosts that need different limits
+        :param response_headers: {header: type} of the quota headers to read from responses, defaults to QUOTA_HEADERS
+        :param max_rate: the rate never goes above this, defaults to each host's starting rate
+        :param min_rate: the rate never goes below this, defaults to a sixteenth of each host's starting rate
+        :param increase: fraction of the starting rate added to the rate after each successful response
+        :param decrease: the rate is multiplied by this after a 429 or 503
         """
         self.client = client
         self.MAX_TOKENS = max_tokens
         self.RATE = rate
-        self.tokens = max_tokens
-        self.updated_at = time.monotonic()
+        self.host_limits = host_limits or dict()
+        self.response_headers = QUOTA_HEADERS if response_headers is None else response_headers
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.buckets = dict()  # {host: TokenBucket}
+        self.quotas = dict()  # {host: Quota}
         self._x_ttl = x_ttl  # x_ttl is time (in seconds)a left to refresh quota
-        self._x_updated_at = time.monotonic()
         self.X_RL = x_rl
-        self._x_rl = x_rl  # X_rl is sends left.
+        self._last_host = None
 
     @property
     def x_rl(self):
-        return self._x_rl
+        """ Requests left in the current quota window of the last host asked """
+        quota = self.quotas.get(self._last_host)
+        return quota.remaining if quota is not None else self.X_RL
 
     @property
     def x_ttl(self):
-        return self._x_ttl
+        """ Seconds until the quota window of the last host asked resets """
+        quota = self.quotas.get(self._last_host)
+        if quota is None or quota.reset_at is None:
+            return self._x_ttl
+        return max(quota.reset_at - time.monotonic(), 0)
 
     @x_ttl.setter
     def x_ttl(self, value):
         self._x_ttl = value
 
+    def bucket(self, host: str):
+        """ Returns the token bucket of a host, creating it on first use """
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            rate, max_tokens = self.host_limits.get(host, (self.RATE, self.MAX_TOKENS))
+            bucket = self.buckets[host] = TokenBucket(rate, max_tokens)
+            bucket.max_rate = self.max_rate or rate
+            bucket.min_rate = min(self.min_rate or rate / 16, bucket.max_rate)
+            bucket.step = rate * self.increase
+        return bucket
+
+    def quota(self, host: str):
+        """ Returns the quota of a host, creating it on first use """
+        quota = self.quotas.get(host)
+        if quota is None:
+            quota = self.quotas[host] = Quota(self.X_RL, self._x_ttl)
+        return quota
+
     async def get(self, *args, **kwargs):
-        await self.wait_for_token()
-        await self.wait_for_ttl()
-        # now = time.monotonic() - START
-        # logging.info(f'{now:.0f}s: ask {args[0]}')
-        logging.info(f"Tokens left: {self.tokens}")
-        return self.client.get(*args, **kwargs)
+        return await self.request("get", *args, **kwargs)
 
     async def post(self, *args, **kwargs):
-        await self.wait_for_token()
-        # now = time.monotonic() - START
-        # logging.info(f'{now:.0f}s: ask {args[0]}')
-        logging.info(f"Tokens left: {self.tokens}")
-        return self.client.post(*args, **kwargs)
+        return await self.request("post", *args, **kwargs)
 
     async def put(self, *args, **kwargs):
-        await self.wait_for_token()
+        return await self.request("put", *args, **kwargs)
+
+    async def request(self, method: str, *args, **kwargs):
+        """ Waits for a token and for the host's quota, then returns client.<method>(*args, **kwargs) """
+        host = url_host(args[0])
+        await self.wait_for_token(host)
+        await self.wait_for_ttl(host)
         # now = time.monotonic() - START
         # logging.info(f'{now:.0f}s: ask {args[0]}')
-        logging.info(f"Tokens left: {self.tokens}")
-        return self.client.put(*args, **kwargs)
+        return _ObservedRequest(self, host, getattr(self.client, method)(*args, **kwargs))
 
-    async def wait_for_token(self):
-        while self.tokens < 1:
-            self.add_new_tokens()
-            await asyncio.sleep(0.1)
+    async def wait_for_token(self, host: str = ""):
+        bucket = self.bucket(host)
+        await bucket.acquire()
+        logging.info(f"Tokens left for {host}: {bucket.tokens:.2f}")
 
-        self.tokens -= 1
+    async def wait_for_ttl(self, host: str = ""):
+        """ Takes one request from the host's quota, first waiting (in one sleep) for the window to reset if the quota
+        has run out.
+        The quota of a new host is only a guess until it answers, so the first request is sent on its own and the rest
+        wait for its quota headers (or for a window, if it never answers) """
+        self._last_host = host
+        quota = self.quota(host)
+        start = time.monotonic()
+        waited = False
+        if quota.probed is None:
+            quota.probed = asyncio.Event()
+        elif not quota.probed.is_set():
+            waited = True
+            try:
+                await asyncio.wait_for(quota.probed.wait(), quota.window)
+            except asyncio.TimeoutError:
+                quota.probed.set()
+        while True:
+            now = time.monotonic()
+            if quota.reset_at is None or now >= quota.reset_at:
+                quota.remaining = max(quota.remaining, quota.limit)
+                quota.reset_at = now + quota.window
+            if quota.remaining >= 1:
+                break
+            waited = True
+            await asyncio.sleep(quota.reset_at - now)
+        quota.remaining -= 1
+        if waited:
+            quota.throttles += 1
+            quota.throttled += time.monotonic() - start
 
-    async def wait_for_ttl(self):
+    def observe(self, host: str, response):
+        """ Updates a host's quota and rate from a response's status and quota headers """
+        quota = self.quota(host)
+        bucket = self.bucket(host)
+        values = parse_headers(response.headers, self.response_headers)
         now = time.monotonic()
-        time_since_update = now - self._x_updated_at
-        if self._x_rl < 1:
-            while time_since_update < self._x_ttl:
-                await asyncio.sleep(0.5)
-                time_since_update += time.monotonic()
-            self._x_rl = self.X_RL
-        self._x_updated_at = time.monotonic()
-        self._x_rl -= 1
-
-    def add_new_tokens(self):
+        others = quota.in_flight - 1  # requests sent before this response that the server may not have counted yet
+        if "X-Ttl" in values:
+            reset_at = now + values["X-Ttl"]
+            if quota.reset_at is None or reset_at > quota.reset_at + 1:  # the server has started a new window
+                quota.remaining = values.get("X-Rl", quota.limit) - others
+            quota.reset_at = reset_at
+        if "X-Rl" in values:
+            if quota.limit_known:  # responses can arrive out of order, so only ever lower what is left in a window
+                quota.remaining = min(quota.remaining, values["X-Rl"] - others)
+            else:  # until now it was only a guess
+                quota.remaining = values["X-Rl"] - others
+            # the most left we have ever seen (plus the request that was answered) is the closest we get to the limit
+            quota.limit = max(quota.limit, values["X-Rl"] + 1) if quota.limit_known else values["X-Rl"] + 1
+            quota.limit_known = True
+        if response.status in THROTTLE_STATUSES:
+            quota.rejected += 1
+            pause = values.get("Retry-After", values.get("X-Ttl", quota.window))
+            quota.remaining = 0
+            quota.reset_at = max(quota.reset_at or 0, now + pause)
+            bucket.set_rate(max(bucket.rate * self.decrease, bucket.min_rate))
+            logging.warning(f"{host} answered {response.status}, pausing it for {pause}s and slowing down to "
+                            f"{bucket.rate:.3f} requests/s")
+        elif response.status < 400 and bucket.rate < bucket.max_rate:
+            bucket.set_rate(min(bucket.rate + bucket.step, bucket.max_rate))
+
+    def throttled(self):
+        """ Returns the total seconds callers have spent waiting, for tokens and for quotas, over every host """
+        return sum(bucket.waited for bucket in self.buckets.values()) + \
+            sum(quota.throttled for quota in self.quotas.values())
+
+    def stats(self):
+        """ Returns a dictionary of every host's rate, tokens, quota and time spent waiting """
         now = time.monotonic()
-        time_since_update = now - self.updated_at
-        new_tokens = time_since_update * self.RATE
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.MAX_TOKENS)
+        report = dict()
+        for host, bucket in self.buckets.items():
+            quota = self.quota(host)
+            report[host] = {"rate": bucket.rate, "tokens": bucket.tokens, "waiting": len(bucket),
+                            "acquired": bucket.acquired, "token_wait": bucket.waited,
+                            "quota_remaining": quota.remaining,
+                            "quota_reset_in": max(quota.reset_at - now, 0) if quota.reset_at is not None else None,
+                            "quota_wait": quota.throttled, "quota_throttles": quota.throttles,
+                            "rejected": quota.rejected}
+        return report
+
+
+class ThreadSafeTokenBucket:
+    """ A token bucket that can be shared by threads, eg. the workers of a ThreadPoolExecutor. Each caller reserves
+    the next free slot while holding the lock, so callers are served in the order they arrived, and then sleeps
+    exactly until its slot without holding the lock """
+
+    def __init__(self, rate: int or float, max_tokens: int or float):
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens  # may go below 0: each missing token is a slot reserved by a sleeping caller
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.acquired = 0
+
+    def acquire(self, timeout: float = None):
+        """ Takes a token, blocking until one is available
+
+        :param timeout: give up if the token would not be available within this many seconds
+        :return: True if a token was taken, False if it timed out (without taking a token)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.max_tokens)
             self.updated_at = now
+            wait = max(1 - self.tokens, 0) / self.rate
+            if timeout is not None and wait > timeout:
+                return False
+            self.tokens -= 1
+            self.acquired += 1
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+class ThreadSafeRateLimiter:
+    """ Rate limits a blocking HTTP client (eg. a requests.Session) shared by several threads, by host. get(), post()
+    and put() block until a token is available and then make the request """
+
+    def __init__(self, client, *, rate: int or float = 1, max_tokens: int = 10, host_limits: dict = None):
+        """
+        :param client: a blocking HTTP client with get(), post() and put() methods
+        :param rate: maximum requests per second, per host
+        :param max_tokens: maximum burst of requests, per host
+        :param host_limits: optional {host: (rate, max_tokens)} for hosts that need different limits
+        """
+        self.client = client
+        self.MAX_TOKENS = max_tokens
+        self.RATE = rate
+        self.host_limits = host_limits or dict()
+        self.buckets = dict()
+        self._lock = threading.Lock()  # guards self.buckets
+
+    def bucket(self, host: str):
+        with self._lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                rate, max_tokens = self.host_limits.get(host, (self.RATE, self.MAX_TOKENS))
+                bucket = self.buckets[host] = ThreadSafeTokenBucket(rate, max_tokens)
+            return bucket
+
+    def wait_for_token(self, host: str = ""):
+        self.bucket(host).acquire()
+
+    def get(self, *args, **kwargs):
+        self.wait_for_token(url_host(args[0]))
+        return self.client.get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        self.wait_for_token(url_host(args[0]))
+        return self.client.post(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        self.wait_for_token(url_host(args[0]))
+        return self.client.put(*args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {host: {"tokens": bucket.tokens, "acquired": bucket.acquired, "waited": bucket.waited}
+                    for host, bucket in self.buckets.items()}
+
+
+class SharedTokenBucket:
+    """ A token bucket kept in shared memory, so processes can share one budget. Like ThreadSafeTokenBucket, each
+    caller reserves the next free slot under the lock and then sleeps until it without holding the lock. Create it in
+    the parent and hand it to the processes when they are started """
+
+    def __init__(self, rate: int or float, max_tokens: int or float, *, context=None):
+        """
+        :param rate: tokens added per second, over every process
+        :param max_tokens: most tokens the bucket can hold, ie. the largest burst of requests over every process
+        :param context: multiprocessing context the processes are started with, defaults to the default one
+        """
+        self.rate = rate
+        self.max_tokens = max_tokens
+        # tokens (may go below 0, like ThreadSafeTokenBucket) and the time.monotonic() they were counted at. The
+        # monotonic clock is the same for every process on the machine
+        self._state = (context or multiprocessing).Array("d", [max_tokens, time.monotonic()])
+
+    def reserve(self):
+        """ Takes a token, and returns how many seconds to wait before using it """
+        with self._state.get_lock():
+            tokens, updated_at = self._state
+            now = time.monotonic()
+            tokens = min(tokens + (now - updated_at) * self.rate, self.max_tokens)
+            self._state[0], self._state[1] = tokens - 1, now
+        return max(1 - tokens, 0) / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class _BudgetedRequest:
+    """ Wraps the request returned by client.get()/post()/put(), so it takes a token from the budget before it is
+    sent, whether it is awaited or used as 'async with' """
+
+    def __init__(self, bucket, request):
+        self._bucket = bucket
+        self._request = request
+
+    async def _send(self, send):
+        if self._bucket is not None:
+            await self._bucket.acquire()
+        return await send()
+
+    def __await__(self):
+        return self._send(lambda: self._request).__await__()
+
+    async def __aenter__(self):
+        return await self._send(self._request.__aenter__)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._request.__aexit__(exc_type, exc, tb)
+
+
+class BudgetedClient:
+    """ Wraps an aiohttp client so that every request to a host takes a token from that host's SharedTokenBucket
+    first. Put a RateLimiter in front of it as usual: the RateLimiter keeps this process's own limits, and the shared
+    buckets keep every process together within the global ones """
+
+    def __init__(self, client, budgets: dict):
+        """
+        :param client: aiohttp client
+        :param budgets: {host: SharedTokenBucket}. Hosts that are not in it are not limited
+        """
+        self.client = client
+        self.budgets = budgets
+
+    def get(self, *args, **kwargs):
+        return self.request("get", *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.request("post", *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.request("put", *args, **kwargs)
+
+    def request(self, method: str, *args, **kwargs):
+        return _BudgetedRequest(self.budgets.get(url_host(args[0])), getattr(self.client, method)(*args, **kwargs))
+
+    async def close(self):
+        await self.client.close()
+
+
+async def test_quota_headers():
+    class Response:
+        def __init__(self, status, headers):
+            self.status = status
+            self.headers = headers
+
+    class Client:
+        def __init__(self, *responses):
+            self.responses = list(responses)
+
+        async def get(self, url):
+            return self.responses.pop(0)
+
+    # the first real X-Rl replaces the guess, even when the guess was lower
+    limiter = RateLimiter(Client(Response(200, {"X-Rl": "44", "X-Ttl": "60"}), Response(200, {"X-Rl": "50"})),
+                          rate=100, x_rl=10)
+    await (await limiter.get("http://ip-api.com/batch"))
+    quota = limiter.quota("ip-api.com")
+    assert quota.limit_known and quota.limit == 45 and quota.remaining == 44, vars(quota)
+    # after that, responses that arrive out of order only ever lower what is left
+    await (await limiter.get("http://ip-api.com/batch"))
+    assert quota.limit == 51 and quota.remaining == 43, vars(quota)
+    print(limiter.stats())
 
 
-# class HTTPRateLimiter(RateLimiter):
-#     def __init__(self, client, *, rate: int or float = 1, max_tokens: int = 10):
-#         super(HTTPRateLimiter, self).__init__(client, rate=rate, max_tokens=max_tokens)
+if __name__ == "__main__":
+    asyncio.run(test_quota_headers())
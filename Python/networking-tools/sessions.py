@@ -0,0 +1,176 @@
+"""
+A managed HTTP client for the DoH and ip-api upstreams. Every upstream host gets its own aiohttp session and connection
+pool, sized for that host, with keep-alive, explicit connect and read timeouts and the host's DNS lookups cached, and
+every pool shares one SSL context so certificates are only loaded once.
+Pools can be warmed up at startup so the first queries do not pay for the TCP and TLS handshakes, and stats() reports
+how full every pool is and how often a request found it full and had to wait for a connection.
+"""
+
+import asyncio
+import logging
+import ssl
+import time
+
+import aiohttp
+
+from ratelimiter import url_host
+
+DEFAULT_LIMIT = 32  # connections per upstream host
+KEEPALIVE_TIMEOUT = 30  # seconds an idle connection is kept open for
+CONNECT_TIMEOUT = 5  # seconds to open a connection (including TLS), or to wait for a free one in the pool
+READ_TIMEOUT = 15  # seconds to wait for more of the response
+DNS_CACHE_TTL = 300  # seconds the upstream hosts' own addresses are cached for
+
+
+class ManagedClient:
+    """ An aiohttp-like client (get(), post(), put(), close()) that sends each request through the pool of its host """
+
+    def __init__(self, upstreams: dict = None, *, limit: int = DEFAULT_LIMIT,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, total_timeout: float = None, dns_cache_ttl: int = DNS_CACHE_TTL,
+                 ssl_context: ssl.SSLContext = None):
+        """
+        :param upstreams: {url or host: options} of the upstreams to pool and warm up, where options can override any
+        of the keyword arguments below for that host, eg. {"http://ip-api.com/batch": {"limit": 4}}, and "warm": False
+        leaves the upstream out of warm_up(), for upstreams with a request quota. Hosts that are not given get a pool
+        with the defaults on first use
+        :param limit: connections per host, more requests wait for a free one
+        :param keepalive_timeout: seconds an idle connection is kept open for
+        :param connect_timeout: seconds to get a connection, from the pool or by opening one
+        :param read_timeout: seconds to wait for more of a response
+        :param total_timeout: seconds a whole request may take, None for no limit
+        :param dns_cache_ttl: seconds the hosts' addresses are cached for
+        :param ssl_context: SSL context of every connection, defaults to ssl.create_default_context()
+        """
+        self.defaults = {"limit": limit, "keepalive_timeout": keepalive_timeout, "connect_timeout": connect_timeout,
+                         "read_timeout": read_timeout, "total_timeout": total_timeout, "dns_cache_ttl": dns_cache_ttl}
+        self.urls = dict()  # {host: url to warm the host's pool up with}
+        self.options = dict()  # {host: options}
+        for upstream, options in (upstreams or dict()).items():
+            host = url_host(upstream) if "://" in upstream else upstream.lower()
+            if "://" in upstream and (options or dict()).get("warm", True):
+                self.urls[host] = upstream
+            self.options[host] = {**self.defaults, **(options or dict())}
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.sessions = dict()  # {host: aiohttp.ClientSession}
+        self.requests = dict()  # {host: requests sent}
+        self.saturated = dict()  # {host: requests that found every connection of the pool in use}
+        self.peak = dict()  # {host: most connections in use at once, as seen when requests were sent}
+        self.closed = False
+
+    @classmethod
+    def for_endpoints(cls, endpoints: list, **kwargs):
+        """ Returns a client for a list of endpoints like DOH_REST_ENDPOINTS or IP_REST_ENDPOINTS, with the pool options
+        of each endpoint's "pool" entry, eg. {"url": ..., "pool": {"limit": 4}}
+
+        :param kwargs: the defaults of every pool, see __init__
+        """
+        return cls({endpoint.get("url"): endpoint.get("pool") for endpoint in endpoints}, **kwargs)
+
+    def session(self, host: str):
+        """ Returns the session of a host, creating it (and its pool) on first use """
+        session = self.sessions.get(host)
+        if session is None:
+            if self.closed:
+                raise RuntimeError("The client is closed")
+            options = self.options.setdefault(host, dict(self.defaults))
+            connector = aiohttp.TCPConnector(limit=options["limit"], limit_per_host=options["limit"],
+                                             keepalive_timeout=options["keepalive_timeout"], use_dns_cache=True,
+                                             ttl_dns_cache=options["dns_cache_ttl"], ssl=self.ssl_context)
+            timeout = aiohttp.ClientTimeout(total=options["total_timeout"], connect=options["connect_timeout"],
+                                            sock_read=options["read_timeout"])
+            session = self.sessions[host] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.requests[host] = self.saturated[host] = self.peak[host] = 0
+        return session
+
+    async def start(self, *, warm: int = 1):
+        """ Creates the pools of every upstream, and opens warm connections to each of them """
+        for host in self.options:
+            self.session(host)
+        if warm:
+            await self.warm_up(connections=warm)
+
+    async def warm_up(self, urls: list = None, *, connections: int = 1):
+        """ Opens connections to upstreams ahead of the first queries, with HEAD requests whose connections go back to
+        the pool. Upstreams that can not be reached are logged, and left to fail on their first query
+
+        :param urls: urls of the upstreams to warm up, defaults to every upstream given as a url without "warm": False
+        :param connections: connections to open to each upstream, at most its pool's limit
+        """
+        urls = urls if urls is not None else list(self.urls.values())
+
+        async def open_connection(url):
+            try:
+                async with self.head(url, allow_redirects=False) as resp:
+                    await resp.read()  # read to the end, so the connection is kept alive and goes back to the pool
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                logging.warning(f"Could not warm up {url}: {e!r}")
+
+        start = time.monotonic()
+        opens = [open_connection(url) for url in urls
+                 for _ in range(min(connections, self.options.get(url_host(url), self.defaults)["limit"]))]
+        await asyncio.gather(*opens)
+        logging.info(f"Warmed up {len(urls)} upstreams in {time.monotonic() - start:.2f}s")
+
+    def get(self, *args, **kwargs):
+        return self.request("get", *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.request("post", *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.request("put", *args, **kwargs)
+
+    def head(self, *args, **kwargs):
+        return self.request("head", *args, **kwargs)
+
+    def request(self, method: str, *args, **kwargs):
+        """ Returns session.<method>(*args, **kwargs) of the url's host, which can be awaited or used as
+        'async with' """
+        host = url_host(args[0])
+        session = self.session(host)
+        in_use, limit, _ = _pool_usage(session.connector)
+        self.requests[host] += 1
+        self.peak[host] = max(self.peak[host], in_use)
+        if limit and in_use >= limit:
+            self.saturated[host] += 1
+        return getattr(session, method)(*args, **kwargs)
+
+    async def close(self):
+        self.closed = True
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def stats(self):
+        """ Returns a dictionary of every host's pool: its limit, connections in use and idle, requests waiting for a
+        connection, the peak in use, and how many requests found the pool full """
+        report = dict()
+        for host, session in self.sessions.items():
+            in_use, limit, waiting = _pool_usage(session.connector)
+            report[host] = {"limit": limit, "in_use": in_use, "idle": _idle_connections(session.connector),
+                            "waiting": waiting, "peak": self.peak[host], "requests": self.requests[host],
+                            "saturated": self.saturated[host],
+                            "saturation": in_use / limit if limit else 0.0}
+        return report
+
+
+def _pool_usage(connector):
+    """ Returns (connections in use, limit, requests waiting for a connection) of an aiohttp connector. aiohttp does not
+    make these public, so they are read from its attributes, and count as 0 if they are not there """
+    limit = getattr(connector, "limit", 0) or 0
+    in_use = len(getattr(connector, "_acquired", ()))
+    waiting = sum(len(waiters) for waiters in getattr(connector, "_waiters", dict()).values())
+    return in_use, limit, waiting
+
+
+def _idle_connections(connector):
+    return sum(len(connections) for connections in getattr(connector, "_conns", dict()).values())
@@ -0,0 +1,296 @@
+"""
+Runs DNSResolver or IPResolver lookups on several cores: ShardedRunner starts a worker process per core, each with its
+own event loop, resolver and HTTP session, so JSON decoding and logging are spread over every core instead of
+saturating one.
+Domains and IPs are sent to workers by consistent hashing, so the same name (or the same /24) always goes to the same
+worker and its cache stays warm for its slice, and adding a worker only moves a small share of the names.
+Rate limits that are global (eg. ip-api's quota per client IP) are kept by the parent: it owns a SharedTokenBucket per
+host that every worker takes its requests out of.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import traceback
+from bisect import bisect
+from collections import defaultdict, deque
+from ipaddress import ip_address
+
+from ratelimiter import BudgetedClient, SharedTokenBucket, iterate
+
+
+class ConsistentHashRing:
+    """ Maps keys to shards with consistent hashing: every shard gets replicas points on a ring of 64 bit hashes, and a
+    key belongs to the shard of the first point after the key's hash """
+
+    def __init__(self, shards: int, *, replicas: int = 64):
+        """
+        :param shards: number of shards, the keys are mapped to 0 to shards - 1
+        :param replicas: points per shard on the ring. More points spread the keys more evenly
+        """
+        points = sorted((_hash(f"{shard}-{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, key: str):
+        """ Returns the shard a key belongs to """
+        return self._shards[bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+def _hash(key: str):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def ip_shard_key(ip: str):
+    """ Shards IPv4 addresses by their /24, so the IPs an IPCache with aggregate=24 answers together go to the same
+    worker. Anything else is sharded by itself """
+    try:
+        address = ip_address(ip)
+    except ValueError:
+        return ip
+    return str(int(address) >> 8) if address.version == 4 else str(address)
+
+
+def domain_shard_key(domain: str):
+    return domain.rstrip(".").lower()
+
+
+class WorkerError(RuntimeError):
+    """ Raised by ShardedRunner.run when a worker fails or dies """
+
+
+class ShardedRunner:
+    """ Looks domains (with DNSResolver) or IPs (with IPResolver) up on a pool of worker processes """
+
+    def __init__(self, kind: str, *, workers: int = None, resolver_options: dict = None, query_options: dict = None,
+                 budgets: dict = None, shard_key=None, chunk_size: int = 64, queue_size: int = 16,
+                 log_level: int = logging.WARNING, context=None):
+        """
+        :param kind: "dns" to resolve domains with DNSResolver.stream_query, or "ip" to geolocate IPs with
+        IPResolver.stream_query_ip_api
+        :param workers: number of worker processes, defaults to the number of CPUs
+        :param resolver_options: keyword arguments of every worker's resolver, eg. {"dns_name_servers": [...],
+        "doh_name_servers": [...]} for DNSResolver. Defaults to DNS_ENDPOINTS and DOH_REST_ENDPOINTS, or
+        IP_REST_ENDPOINTS
+        :param query_options: keyword arguments of every worker's stream_query or stream_query_ip_api, eg.
+        {"concurrency": 50}. Their rate limits are per worker
+        :param budgets: {host: (rate, max_tokens)} limits shared by every worker together, eg.
+        {"ip-api.com": (0.25, 2)}
+        :param shard_key: function of an item that returns the string it is sharded by. Defaults to the lowercase
+        domain, or the /24 of an IPv4 address
+        :param chunk_size: items (and results) sent between processes at once
+        :param queue_size: chunks that can wait for each worker before the input is read further
+        :param log_level: logging level of the workers. Logging on the hot path is expensive, so only warnings by
+        default
+        :param context: multiprocessing context to start the workers with, defaults to the default one
+        """
+        if kind not in ("dns", "ip"):
+            raise ValueError(f"Unknown kind {kind!r}, expected 'dns' or 'ip'")
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.resolver_options = resolver_options or dict()
+        self.query_options = query_options or dict()
+        self._context = context or multiprocessing.get_context()
+        self.budgets = {host: SharedTokenBucket(rate, max_tokens, context=self._context)
+                        for host, (rate, max_tokens) in (budgets or dict()).items()}
+        self.shard_key = shard_key or (domain_shard_key if kind == "dns" else ip_shard_key)
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.log_level = log_level
+        self.ring = ConsistentHashRing(self.workers)
+        self.worker_stats = dict()  # {worker: its resolver's stats()}, filled in as workers finish
+
+    async def run(self, items, *, ordered: bool = False):
+        """ Looks items up from any iterable or async iterable (eg. an open file, read line by line), and yields the
+        results as they come back from the workers.
+        Items are only read as fast as the workers take them, so memory stays flat however many there are. Leaving the
+        loop early stops the workers.
+
+        :param items: iterable or async iterable of domains or IPs. Whitespace around them and blank lines are skipped
+        :param ordered: yield the results in the order of the items. Otherwise they are yielded as soon as they come
+        back, which holds fewer results in memory when some lookups are slow
+        :return: async generator of (item, result) tuples. For "dns" the result is (answers, server) like
+        DNSResolver.resolve, and for "ip" it is ip-api's result dictionary
+        :raises WorkerError: if a worker fails
+        """
+        loop = asyncio.get_running_loop()
+        inboxes = [self._context.Queue(self.queue_size) for _ in range(self.workers)]
+        outbox = self._context.Queue()
+        processes = [self._context.Process(target=_run_worker, name=f"{self.kind}-worker-{index}", daemon=True,
+                                           args=(index, self.kind, self.resolver_options, self.query_options,
+                                                 self.budgets, self.log_level, inboxes[index], outbox))
+                     for index in range(self.workers)]
+        for process in processes:
+            process.start()
+        items_by_seq = dict()  # {sequence number: item} of the items sent that have no result yet
+        feeder = loop.create_task(self._feed(items, inboxes, items_by_seq))
+        running = self.workers
+        reorder = dict()  # {sequence number: result} that came back before an earlier one, if ordered
+        next_seq = 0
+        try:
+            while running:
+                try:
+                    message = await loop.run_in_executor(None, outbox.get, True, 0.5)
+                except queue.Empty:
+                    if feeder.done() and not feeder.cancelled() and feeder.exception() is not None:
+                        raise feeder.exception()
+                    dead = [process.name for process in processes if process.exitcode not in (None, 0)]
+                    if dead:
+                        raise WorkerError(f"{', '.join(dead)} died")
+                    continue
+                kind, index, payload = message
+                if kind == "error":
+                    raise WorkerError(f"Worker {index} failed:\n{payload}")
+                if kind == "done":
+                    self.worker_stats[index] = payload
+                    running -= 1
+                    continue
+                for seq, result in payload:
+                    if not ordered:
+                        yield items_by_seq.pop(seq), result
+                        continue
+                    reorder[seq] = result
+                    while next_seq in reorder:
+                        yield items_by_seq.pop(next_seq), reorder.pop(next_seq)
+                        next_seq += 1
+            await feeder
+        finally:  # finished, the consumer stopped early, or something went wrong
+            feeder.cancel()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join(1)
+            for inbox in (*inboxes, outbox):
+                inbox.cancel_join_thread()  # do not hang on chunks no worker will read
+                inbox.close()
+
+    async def _feed(self, items, inboxes: list, items_by_seq: dict):
+        """ Reads the items, numbers them and sends them to their workers in chunks, then tells the workers there is
+        nothing more. Waits whenever a worker's queue is full """
+        loop = asyncio.get_running_loop()
+        chunks = [[] for _ in inboxes]
+        seq = 0
+        async for item in iterate(items):
+            item = item.strip()
+            if not item:
+                continue
+            items_by_seq[seq] = item
+            index = self.ring.shard(self.shard_key(item))
+            chunks[index].append((seq, item))
+            seq += 1
+            if len(chunks[index]) >= self.chunk_size:
+                await _put(inboxes[index], chunks[index])
+                chunks[index] = []
+        for index, inbox in enumerate(inboxes):
+            if chunks[index]:
+                await _put(inbox, chunks[index])
+            await _put(inbox, None)
+
+    async def run_all(self, items, *, ordered: bool = True):
+        """ Returns the list of (item, result) tuples of every item """
+        return [result async for result in self.run(items, ordered=ordered)]
+
+
+def _run_worker(index: int, kind: str, resolver_options: dict, query_options: dict, budgets: dict, log_level: int,
+                inbox, outbox):
+    """ Entry point of a worker process """
+    logging.basicConfig(level=log_level)
+    logging.getLogger().setLevel(log_level)
+    try:
+        stats = asyncio.run(_worker(index, kind, resolver_options, query_options, budgets, inbox, outbox))
+        outbox.put(("done", index, stats))
+    except BaseException:
+        outbox.put(("error", index, traceback.format_exc()))
+
+
+async def _worker(index: int, kind: str, resolver_options: dict, query_options: dict, budgets: dict, inbox, outbox,
+                  flush_interval: float = 0.05, chunk_size: int = 64):
+    """ Looks up the items sent to this worker with its own resolver, and sends the results back in chunks """
+    # imported in the workers only, the parent does not need them
+    from sessions import ManagedClient
+    if kind == "dns":
+        from DNSResolver import DNSResolver, DNS_ENDPOINTS, DOH_REST_ENDPOINTS
+        key = domain_shard_key
+        options = {"dns_name_servers": DNS_ENDPOINTS, "doh_name_servers": DOH_REST_ENDPOINTS, **resolver_options}
+        endpoints = options["doh_name_servers"]
+    else:
+        from IPResolver import IPResolver, IP_REST_ENDPOINTS, _ip_key
+        key = _ip_key  # ip-api may write an IP differently from how it was given, eg. IPv6 ones
+        options = {"ip_rest_endpoints": IP_REST_ENDPOINTS, **resolver_options}
+        endpoints = options["ip_rest_endpoints"]
+    loop = asyncio.get_running_loop()
+    seqs = defaultdict(deque)  # {item's key: sequence numbers of the items waiting for a result, in order}
+    results = []
+
+    async def items():
+        while True:
+            chunk = await loop.run_in_executor(None, inbox.get)
+            if chunk is None:
+                return
+            for seq, item in chunk:
+                seqs[key(item)].append(seq)
+                yield item
+
+    def add_result(item, result):
+        results.append((seqs[key(item)].popleft(), result))
+        if len(results) >= chunk_size:
+            flush()
+
+    def flush():
+        if results:
+            outbox.put(("results", index, list(results)))
+            results.clear()
+
+    async def flush_regularly():  # so results do not wait for a full chunk when lookups are slow
+        while True:
+            await asyncio.sleep(flush_interval)
+            flush()
+
+    managed_client = ManagedClient.for_endpoints(endpoints or [])
+    await managed_client.start()
+    client = BudgetedClient(managed_client, budgets)
+    flusher = loop.create_task(flush_regularly())
+    try:
+        if kind == "dns":
+            resolver = DNSResolver(doh_client=client, **options)
+            async for domain, answers, _, server in resolver.stream_query(items(), **query_options):
+                add_result(domain, (answers, server))
+        else:
+            resolver = IPResolver(http_client=client, **options)
+            # every item needs its own result, so duplicates are looked up (or found in the cache) again
+            async for result in resolver.stream_query_ip_api(items(), **{**query_options, "dedupe": False}):
+                add_result(result.get("query"), result)
+        flush()
+        return {**resolver.stats(), "pools": managed_client.stats()}
+    finally:
+        flusher.cancel()
+        await client.close()
+
+
+async def _put(inbox, chunk):
+    """ Puts a chunk in a worker's queue, waiting while it is full. Waits in short steps, so no thread is left blocked
+    on a queue whose worker was stopped """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return await loop.run_in_executor(None, inbox.put, chunk, True, 0.5)
+        except queue.Full:
+            continue
+
+
+async def test_sharding():
+    from IPResolver import IP_API_BATCH_QUOTA, IP_API_QUOTA_WINDOW
+
+    runner = ShardedRunner("ip", workers=2, budgets={"ip-api.com": (IP_API_BATCH_QUOTA / IP_API_QUOTA_WINDOW, 2)})
+    async for ip, result in runner.run(["208.80.152.201", "8.8.8.8", "1.1.1.1", "8.8.4.4"], ordered=True):
+        print(ip, result)
+    print(runner.worker_stats)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(test_sharding())
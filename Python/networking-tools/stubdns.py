@@ -0,0 +1,141 @@
+"""
+A tiny authoritative name server on localhost, for trying DNSClient (and DNSResolver with raw_dns) out without
+touching a real name server. It answers over UDP and TCP from a dictionary of records, and can drop or truncate some
+UDP responses on purpose to exercise retransmits and the TCP fallback.
+"""
+
+import asyncio
+import logging
+import struct
+
+import dnswire
+from dnsclient import RECEIVE_BUFFER, set_receive_buffer
+
+TCP_LENGTH = struct.Struct("!H")
+STUB_SOA = "ns.stub. hostmaster.stub. 1 3600 600 86400 60"
+
+
+class StubNameServer:
+    """ Answers queries from a dictionary of records, over UDP and TCP on the same port """
+
+    def __init__(self, records: dict, *, host: str = "127.0.0.1", port: int = 0, ttl: int = 300,
+                 drop_every: int = None, truncate_every: int = None):
+        """
+        :param records: {name: [A record addresses]} or {(name, type): [record data]}, eg.
+        {"example.test": ["10.0.0.1"], ("example.test", "MX"): ["10 mail.example.test."]}. Other names get NXDOMAIN
+        :param host: address to listen on
+        :param port: port to listen on, 0 picks a free one (see address)
+        :param ttl: TTL of every answer
+        :param drop_every: ignore every nth UDP query, to make the client send it again
+        :param truncate_every: send every nth UDP response truncated and without answers, to make the client ask
+        again over TCP
+        """
+        self.records = dict()  # {(lowercase name with a trailing dot, type code): [record data]}
+        for key, answers in records.items():
+            name, dns_type = key if isinstance(key, tuple) else (key, "A")
+            self.records[(name.rstrip(".").lower() + ".", dnswire.type_code(dns_type))] = list(answers)
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.drop_every = drop_every
+        self.truncate_every = truncate_every
+        self._transport = None
+        self._tcp_server = None
+        self.udp_queries = self.tcp_queries = self.dropped = self.truncated = 0
+
+    @property
+    def address(self):
+        """ "host:port" of the server, as DNSClient takes it """
+        return f"{self.host}:{self.port}"
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        server = self
+
+        class Protocol(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                response = server._answer_udp(data)
+                if response is not None:
+                    self.transport.sendto(response, addr)
+
+        self._transport, _ = await loop.create_datagram_endpoint(Protocol, local_addr=(self.host, self.port))
+        set_receive_buffer(self._transport, RECEIVE_BUFFER)
+        self.port = self._transport.get_extra_info("sockname")[1]
+        # TCP on the same port as UDP, like a real name server
+        self._tcp_server = await asyncio.start_server(self._serve_tcp, self.host, self.port)
+
+    async def stop(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+            await self._tcp_server.wait_closed()
+            self._tcp_server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def answer(self, query: dnswire.Message):
+        """ Returns the response to a query """
+        flags = dnswire.FLAG_QR | query.flags & dnswire.FLAG_RD
+        response = dnswire.Message(query.id, flags, query.questions)
+        if len(query.questions) != 1:
+            response.flags |= 1  # FORMERR
+            return response
+        question = query.questions[0]
+        name = question.name.lower()
+        answers = self.records.get((name, question.type))
+        if answers is not None:
+            response.answers = [dnswire.Record(question.name, question.type, dnswire.CLASS_IN, self.ttl, data)
+                                for data in answers]
+        elif not any(key[0] == name for key in self.records):
+            response.flags |= dnswire.NXDOMAIN
+        if not response.answers:  # NXDOMAIN, or the name has no records of this type
+            response.authority = [dnswire.Record("stub.", dnswire.TYPES["SOA"], dnswire.CLASS_IN, self.ttl, STUB_SOA)]
+        return response
+
+    def _answer_udp(self, data):
+        try:
+            query = dnswire.decode_message(data)
+        except dnswire.DNSWireError:
+            return None
+        self.udp_queries += 1
+        if self.drop_every and self.udp_queries % self.drop_every == 0:
+            self.dropped += 1
+            return None
+        response = self.answer(query)
+        if self.truncate_every and self.udp_queries % self.truncate_every == 0:
+            self.truncated += 1
+            response.flags |= dnswire.FLAG_TC
+            response.answers, response.authority = [], []
+        return dnswire.encode_message(response)
+
+    async def _serve_tcp(self, reader, writer):
+        try:
+            while True:
+                length, = TCP_LENGTH.unpack(await reader.readexactly(TCP_LENGTH.size))
+                try:
+                    query = dnswire.decode_message(await reader.readexactly(length))
+                except dnswire.DNSWireError:
+                    break
+                self.tcp_queries += 1
+                response = dnswire.encode_message(self.answer(query))
+                writer.write(TCP_LENGTH.pack(len(response)) + response)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):  # the client or server closed
+            pass
+        except Exception as e:
+            logging.warning(f"Stub name server: {e!r}")
+        finally:
+            writer.close()
+
+    def stats(self):
+        return {"udp_queries": self.udp_queries, "tcp_queries": self.tcp_queries, "dropped": self.dropped,
+                "truncated": self.truncated}
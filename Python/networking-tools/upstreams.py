@@ -0,0 +1,183 @@
+"""
+Picks which upstream server (DoH endpoint or DNS name server) to send each query to.
+Keeps an exponentially weighted moving average (EWMA) of every server's latency and error rate, sends each query to
+the server that is expected to answer fastest, and hedges: if that server has not answered by the time it usually
+has (a percentile of its recent latencies), the same query is raced against the next best server, and the first answer
+wins.
+Servers that keep failing are put on a circuit breaker and skipped until a cooldown has passed.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+import aiohttp
+
+
+class UpstreamError(Exception):
+    """ Raised by a query to tell the scheduler that the server failed (eg. SERVFAIL, REFUSED or a 5xx status), so
+    another server should be tried """
+
+
+SERVER_ERRORS = (UpstreamError, aiohttp.ClientError, OSError, asyncio.TimeoutError)  # errors that are the server's fault
+
+
+class UpstreamStats:
+    """ Latency and error statistics of a single upstream server """
+
+    def __init__(self, server, samples: int = 64):
+        self.server = server
+        self.latency = None  # EWMA of successful queries' latency in seconds, None until the first success
+        self.error_rate = 0.0  # EWMA of failures, 0 (never fails) to 1 (always fails)
+        self.recent_latencies = deque(maxlen=samples)
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # the circuit breaker is open (the server is skipped) until this time.monotonic()
+        self.successes = self.failures = 0
+
+    def expected_latency(self):
+        """ How long a query is expected to take, counting the failed tries on the way. Servers that have not been
+        tried yet come first, so every server gets measured, and servers that have only ever failed come last """
+        if self.latency is None:
+            return float("inf") if self.failures else 0.0
+        return self.latency / max(1.0 - self.error_rate, 0.05)
+
+    def percentile(self, fraction: float):
+        """ Returns the given percentile (0 to 1) of the recent latencies, or None if there are none """
+        if not self.recent_latencies:
+            return None
+        ordered = sorted(self.recent_latencies)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class UpstreamScheduler:
+    """ Sends queries to the fastest healthy server, hedging slow ones with a second server """
+
+    def __init__(self, servers: list, *, alpha: float = 0.2, hedge_percentile: float = 0.9,
+                 default_hedge_delay: float = 0.5, min_hedge_delay: float = 0.02, breaker_failures: int = 3,
+                 breaker_cooldown: float = 30):
+        """
+        :param servers: list of hashable server names, eg. DoH URLs or name server IPs
+        :param alpha: weight of the newest sample in the moving averages
+        :param hedge_percentile: how far into a server's latencies to wait before hedging, eg. 0.9 for the 90th
+        percentile
+        :param default_hedge_delay: seconds to wait before hedging a server that has no latencies yet
+        :param min_hedge_delay: never hedge sooner than this many seconds
+        :param breaker_failures: consecutive failures that open a server's circuit breaker
+        :param breaker_cooldown: seconds a server is skipped for once its circuit breaker opens. After that it gets a
+        query again, and goes straight back on the breaker if that fails too
+        """
+        self.alpha = alpha
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.servers = {server: UpstreamStats(server) for server in servers}
+        self.hedges = 0
+
+    def ranked(self):
+        """ Returns the servers from best to worst. Servers whose circuit breaker is open come last, so they are only
+        used when every other server has failed too """
+        now = time.monotonic()
+        return sorted(self.servers, key=lambda server: (self.servers[server].open_until > now,
+                                                        self.servers[server].expected_latency()))
+
+    def hedge_delay(self, server):
+        """ Returns how many seconds to wait for a server before racing another one against it """
+        delay = self.servers[server].percentile(self.hedge_percentile)
+        return max(delay if delay is not None else self.default_hedge_delay, self.min_hedge_delay)
+
+    def record_success(self, server, latency: float):
+        stats = self.servers[server]
+        stats.latency = latency if stats.latency is None else (1 - self.alpha) * stats.latency + self.alpha * latency
+        stats.error_rate *= 1 - self.alpha
+        stats.recent_latencies.append(latency)
+        stats.consecutive_failures = 0
+        stats.open_until = 0.0
+        stats.successes += 1
+
+    def record_failure(self, server):
+        stats = self.servers[server]
+        stats.error_rate = (1 - self.alpha) * stats.error_rate + self.alpha
+        stats.consecutive_failures += 1
+        stats.failures += 1
+        if stats.consecutive_failures >= self.breaker_failures:
+            if stats.open_until <= time.monotonic():
+                logging.warning(f"Circuit breaker opened for {server} after {stats.consecutive_failures} failures")
+            stats.open_until = time.monotonic() + self.breaker_cooldown
+
+    def back_off(self, server, seconds: float):
+        """ Skips a server for the given number of seconds, eg. after it asked us to slow down """
+        stats = self.servers[server]
+        stats.open_until = max(stats.open_until, time.monotonic() + seconds)
+
+    async def race(self, query, *, hedge: bool = True, retry: bool = True, servers: list = None):
+        """ Runs query(server) on the best server. If it fails, the next best server is tried, and if it is slower
+        than its hedge delay, the next best server is raced against it. Whichever answers first wins, and the rest are
+        cancelled.
+
+        :param query: async function of a server, that returns its answer or raises UpstreamError. Only
+        SERVER_ERRORS count as the server failing, anything else (eg. a ValueError for a bad argument) is raised
+        straight away without trying another server
+        :param hedge: race a second server against slow ones
+        :param retry: try other servers after a failure. If False only the best server is asked
+        :param servers: only race these servers, eg. the ones that speak a certain protocol. Defaults to every server
+        :return: (server, answer)
+        :raises UpstreamError: if every server that was tried failed
+        """
+        servers = [server for server in self.ranked() if servers is None or server in servers]
+        if not retry:
+            servers = servers[:1]
+        if not servers:
+            raise UpstreamError("No upstream servers")
+        pending = dict()  # {task: (server, start time)}
+        tried = 0
+        last_error = None
+
+        def launch():
+            nonlocal tried
+            server = servers[tried]
+            tried += 1
+            pending[asyncio.ensure_future(query(server))] = (server, time.monotonic())
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if hedge and tried < len(servers):
+                    last_server, last_start = servers[tried - 1], max(start for _, start in pending.values())
+                    timeout = max(last_start + self.hedge_delay(last_server) - time.monotonic(), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:  # nobody answered in time, so race the next server
+                    self.hedges += 1
+                    launch()
+                    continue
+                for task in done:
+                    server, start = pending.pop(task)
+                    try:
+                        answer = task.result()
+                    except SERVER_ERRORS as e:  # the server failed, or the query could not reach it at all
+                        logging.warning(f"Err: {e!r} from {server}")
+                        self.record_failure(server)
+                        last_error = e
+                        continue
+                    self.record_success(server, time.monotonic() - start)
+                    return server, answer
+                if not pending and tried < len(servers):
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        if isinstance(last_error, UpstreamError):
+            raise last_error
+        raise UpstreamError(f"Every server failed: {last_error!r}")
+
+    def report(self):
+        """ Returns a dictionary of every server's statistics """
+        now = time.monotonic()
+        return {str(server): {"latency": stats.latency, "error_rate": stats.error_rate,
+                              "p%d" % (self.hedge_percentile * 100): stats.percentile(self.hedge_percentile),
+                              "successes": stats.successes, "failures": stats.failures,
+                              "breaker_open": stats.open_until > now}
+                for server, stats in self.servers.items()}